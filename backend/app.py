@@ -1,227 +1,162 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from PIL import Image
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
-from vision_process import process_vision_info
 from pydantic import BaseModel
-from typing import Dict, Optional, List
-from collections import Counter
-from annoy import AnnoyIndex
+from typing import Optional, List
+from batching import MicroBatcher
+from sharding import ShardedBackend
+from convnext_init import ImageEncoder, load_image
+from search_engine import (ImageSearchEngine, SearchOptions, PredictionResult, SEARCH_BACKEND,
+                           PREDICT_RESULTS, PREDICT_CANDIDATES, ADAPTIVE_SEARCH,
+                           COLLAPSE_DUPLICATES, PREVIEW_MODE, PREDICT_MODE)
+from query_cache import QueryCache, content_hash, perceptual_hash
+from metrics import (REGISTRY, RequestTimings, current_timings, timed, resident_memory_bytes,
+                     proportional_memory_bytes)
+from vlm import (VLMDescriber, CAPTION_PROMPT, CATEGORY_QUESTION,
+                 build_choice_prompt, parse_choice, describe_cache_key)
+from pathlib import Path
 import numpy as np
 import logging
 import traceback
-import pickle
-import base64
-import math
-import io
+import time
 import os
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; LOG_LEVEL=INFO or higher keeps DEBUG records off the hot path
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "DEBUG").upper())
 logger = logging.getLogger(__name__)
 
-class ImagePreview(BaseModel):
-    image_path: str
-    preview_path: str
-    category: str
-    similarity: float
-    distance: float
+# Micro-batching of ConvNeXt forward passes across concurrent requests
+PREDICT_MAX_BATCH_SIZE = int(os.getenv("PREDICT_MAX_BATCH_SIZE", "16"))
+PREDICT_MAX_WAIT_MS = float(os.getenv("PREDICT_MAX_WAIT_MS", "10"))
 
-class PredictionResult(BaseModel):
-    image_path: str
-    recs: str
-    model_used: str
-    confidence_score: float
-    top_matches: List[ImagePreview]
-    category: str
-    closest_distance: float
-    category_count: int
-
-class ImageSearchEngine:
-    def __init__(self):
-        self.encoder = None
-        self.annoy_index = None
-        self.qwen_model = None
-        self.qwen_processor = None
-        self.embeddings_dict = {}
-        self.file_mapping = {}
-        self.class_mapping = {}
-        self.embedding_dim = None
-        
-    def load_search_data(self, data_dir="./data"):
-        """Load search index and mappings"""
-        try:
-            # Load processed data
-            with open(f"{data_dir}/processed_data.pkl", "rb") as f:
-                data = pickle.load(f)
-                self.embeddings_dict = data['embeddings']
-                self.file_mapping = data['file_mapping']
-                self.class_mapping = data['class_mapping']
-            
-            # Initialize Annoy index
-            first_embedding = next(iter(self.embeddings_dict.values()))
-            self.embedding_dim = len(first_embedding)
-            self.annoy_index = AnnoyIndex(self.embedding_dim, 'angular')
-            self.annoy_index.load(f"{data_dir}/image_index.ann")
-            
-            return True
-        except Exception as e:
-            logger.error(f"Error loading search data: {str(e)}")
-            return False
-
-    def get_image_preview(self, image_path: str, size=(150, 150)) -> Optional[str]:
-        """Create thumbnail and return base64 encoded image"""
-        try:
-            with Image.open(f"dataset/{image_path}.jpg") as img:
-                img.thumbnail(size)
-                buffered = io.BytesIO()
-                img.save(buffered, format="JPEG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-                return f"data:image/jpeg;base64,{img_str}"
-        except Exception as e:
-            logger.error(f"Error creating preview for {image_path}: {e}")
-            return None
-
-    def find_similar_images(self, embedding, n_candidates=30) -> tuple:
-        """Get similar images using Annoy index"""
-        similar_idx, distances = self.annoy_index.get_nns_by_vector(
-            embedding, n_candidates, include_distances=True
-        )
-        similarities = [1 - (dist * 2 / math.pi) for dist in distances]
-        
-        candidates = [
-            (idx, self.class_mapping[idx], sim) 
-            for idx, sim in zip(similar_idx, similarities)
-        ]
-        
-        return candidates, similarities
+# Upper bounds on the per-request search budget, so a client cannot ask for a
+# scan of most of the catalog on every request; defaults are in search_engine.py
+MAX_PREDICT_CANDIDATES = int(os.getenv("MAX_PREDICT_CANDIDATES", "1000"))
+MAX_SEARCH_K = int(os.getenv("MAX_SEARCH_K", "100000"))
+MAX_NPROBE = int(os.getenv("MAX_NPROBE", "64"))
+MAX_RERANK = int(os.getenv("MAX_RERANK", "5000"))
 
-    def select_recommendations(self, candidates, similarities) -> tuple:
-        """Select top 10 recommendations using improved strategy"""
-        # Get category distribution in top 10
-        top_10_categories = [cat for _, cat, _ in candidates[:10]]
-        category_counts = Counter(top_10_categories)
-        
-        majority_category, majority_count = category_counts.most_common(1)[0] if category_counts else (None, 0)
-        
-        # Initialize result variables
-        result_category = None
-        selected_recommendations = []
-        confidence_score = similarities[0] if similarities else 0
-        
-        # Strategy selection based on similarity and category pattern
-        if similarities and similarities[0] > 0.7:
-            # Very close visual match - use same category
-            result_category = candidates[0][1]
-            confidence_score = similarities[0]
-            selected_recommendations = self._get_category_recommendations(
-                candidates, result_category, limit=10
-            )
-            
-        elif majority_count > 7:
-            # Strong category pattern - use majority category
-            result_category = majority_category
-            selected_recommendations = self._get_category_recommendations(
-                candidates, majority_category, limit=10
-            )
-            
-            # Adjust confidence based on category matches
-            category_similarities = [
-                sim for _, cat, sim in candidates[:10] 
-                if cat == majority_category
-            ]
-            confidence_score = np.mean(category_similarities) if category_similarities else similarities[0]
-            
-        else:
-            # Mixed case - use top matches regardless of category
-            result_category = candidates[0][1]
-            confidence_score = similarities[0]
-            selected_recommendations = [
-                self.file_mapping[idx] for idx, _, _ in candidates[:10]
-            ]
-        
-        # Ensure we have exactly 10 recommendations
-        if len(selected_recommendations) < 10:
-            selected_recommendations = self._pad_recommendations(
-                selected_recommendations, result_category, 
-                majority_count > 7 or similarities[0] > 0.7
-            )
-            
-        return (
-            selected_recommendations[:10], 
-            result_category,
-            confidence_score,
-            1 - similarities[0] if similarities else 1.0,
-            majority_count
-        )
+# Live index updates: compact once this many rows were added or deleted
+COMPACT_THRESHOLD = int(os.getenv("COMPACT_THRESHOLD", "1000"))
 
-    def _get_category_recommendations(self, candidates, category, limit=10):
-        """Get recommendations from specific category"""
-        recommendations = []
-        
-        # First, get matches from candidates
-        for idx, cat, _ in candidates:
-            if cat == category and len(recommendations) < limit:
-                recommendations.append(self.file_mapping[idx])
-                
-        # If needed, add more from the same category
-        if len(recommendations) < limit:
-            for idx, cat in self.class_mapping.items():
-                if len(recommendations) >= limit:
-                    break
-                if cat == category and self.file_mapping[idx] not in recommendations:
-                    recommendations.append(self.file_mapping[idx])
-                    
-        return recommendations
-
-    def _pad_recommendations(self, recommendations, category, use_category_padding=True):
-        """Pad recommendations to ensure exactly 10 items"""
-        if use_category_padding:
-            # Add more from same category
-            additional = set()
-            for idx, cat in self.class_mapping.items():
-                if len(recommendations) + len(additional) >= 10:
-                    break
-                if cat == category and self.file_mapping[idx] not in recommendations:
-                    additional.add(self.file_mapping[idx])
-            recommendations.extend(list(additional))
-            
-        # If still not enough, duplicate last item
-        while len(recommendations) < 10:
-            recommendations.append(
-                recommendations[-1] if recommendations else "placeholder"
-            )
-            
-        return recommendations
-
-    def create_preview_candidates(self, candidates, result_category, 
-                                majority_count, similarity_threshold=0.7):
-        """Create preview candidates for top matches"""
-        preview_candidates = (
-            [(idx, cat, sim) for idx, cat, sim in candidates[:3] 
-             if cat == result_category]
-            if (majority_count > 7 or candidates[0][2] > similarity_threshold)
-            else candidates[:3]
-        )
-        
-        top_previews = []
-        for idx, cat, sim in preview_candidates:
-            preview = self.get_image_preview(self.file_mapping[idx])
-            if preview:
-                top_previews.append(ImagePreview(
-                    image_path=self.file_mapping[idx],
-                    preview_path=preview,
-                    category=cat,
-                    similarity=float(sim),
-                    distance=float(1 - sim)
-                ))
-                
-        return top_previews
+# Repeat queries: embeddings and finished results keyed by upload content hash,
+# optionally also by perceptual hash so re-encoded near-duplicates hit too
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_PHASH = os.getenv("QUERY_CACHE_PHASH", "0") == "1"
+
+# Worker processes serving the app, set by serve.py. Live index updates only
+# reach the worker that received them, so they are refused with several
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "1"))
+
+# Server-Timing header with the per-stage breakdown: sent when the request has
+# "X-Timing: 1", or on every response with TIMING_HEADERS=1
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "0") == "1"
+
+# ConvNeXt inference: "eager", "torchscript" or "quantized" (int8 Linear layers)
+ENCODER_MODE = os.getenv("ENCODER_MODE", "eager")
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0")) or None
+ENCODER_CHANNELS_LAST = os.getenv("ENCODER_CHANNELS_LAST", "0") == "1"
+
+# Qwen2-VL loading: "background" after search is up, "lazy" on first use,
+# "eager" before serving, or "disabled"
+VLM_LOAD = os.getenv("VLM_LOAD", "background")
+
+# /describe generation limits and batching
+VLM_MAX_NEW_TOKENS = int(os.getenv("VLM_MAX_NEW_TOKENS", "64"))
+VLM_MAX_BATCH_SIZE = int(os.getenv("VLM_MAX_BATCH_SIZE", "4"))
+VLM_MAX_WAIT_MS = float(os.getenv("VLM_MAX_WAIT_MS", "50"))
+VLM_CACHE_SIZE = int(os.getenv("VLM_CACHE_SIZE", "4096"))
+
+# Weight of caption similarity in hybrid search, 0 searches on images only
+HYBRID_TEXT_WEIGHT = float(os.getenv("HYBRID_TEXT_WEIGHT", "0"))
+
+class DescribeResult(BaseModel):
+    image_path: str
+    task: str
+    text: str
+    category: Optional[str] = None
+    cached: bool
+    generated_tokens: int
 
 # Initialize FastAPI app and search engine
 app = FastAPI()
 search_engine = ImageSearchEngine()
+describer = VLMDescriber(search_engine.vlm, max_new_tokens=VLM_MAX_NEW_TOKENS,
+                         cache_size=VLM_CACHE_SIZE)
+describe_batcher = MicroBatcher(
+    describer.generate_batch,
+    max_batch_size=VLM_MAX_BATCH_SIZE,
+    max_wait_ms=VLM_MAX_WAIT_MS,
+    name="describe",
+)
+query_embeddings = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+query_results = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+embedding_batcher = MicroBatcher(
+    lambda images: search_engine.encoder.get_image_embeddings(images),
+    max_batch_size=PREDICT_MAX_BATCH_SIZE,
+    max_wait_ms=PREDICT_MAX_WAIT_MS,
+    name="embedding",
+)
+
+# Request and resource metrics for /metrics, stage histograms live in metrics.py
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "Requests served", ["method", "path", "status"]
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "End-to-end request latency", ["path"]
+)
+IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "Requests being served")
+REGISTRY.gauge(
+    "model_load_seconds", "Time taken to load each model", ["model"],
+    function=lambda: {
+        ("convnext",): search_engine.startup_timings.get("encoder_seconds"),
+        ("search_data",): search_engine.startup_timings.get("search_data_seconds"),
+        ("qwen2_vl",): search_engine.vlm.load_seconds,
+    },
+)
+REGISTRY.gauge("process_resident_memory_bytes", "Resident memory", function=resident_memory_bytes)
+REGISTRY.gauge("process_proportional_memory_bytes",
+               "Resident memory with shared pages split between the processes sharing them",
+               function=proportional_memory_bytes)
+REGISTRY.gauge("index_items", "Searchable catalog images",
+               function=lambda: len(search_engine.index) if search_engine.index is not None else 0)
+REGISTRY.gauge(
+    "batcher_queue_depth", "Items waiting in a micro-batcher queue", ["batcher"],
+    function=lambda: {(batcher.name,): batcher.stats()["queued"]
+                      for batcher in (embedding_batcher, describe_batcher)},
+)
+for field in ("hits", "misses", "entries"):
+    REGISTRY.gauge(
+        f"query_cache_{field}", f"Query cache {field}", ["cache"],
+        function=lambda field=field: {(name,): cache.stats()[field] for name, cache
+                                      in (("embeddings", query_embeddings), ("results", query_results))},
+    )
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    """Request counts and latency, plus the opt-in Server-Timing breakdown"""
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        IN_FLIGHT.dec()
+        current_timings.reset(token)
+        # Route templates, not raw URLs, keep the label set small
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.inc(method=request.method, path=path, status=status)
+        HTTP_SECONDS.observe(time.perf_counter() - timings.start, path=path)
+    if TIMING_HEADERS or request.headers.get("x-timing") == "1":
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
 
 # Configure CORS and static files
 app.mount("/dataset", StaticFiles(directory="dataset"), name="dataset")
@@ -233,162 +168,418 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def load_models():
+    """Load the encoder, the search data and an eager VLM.
+
+    Skips whatever is already loaded, so serve.py can call it in the parent
+    process and the workers it forks find everything in place.
+    """
+    if search_engine.encoder is None:
+        start = time.perf_counter()
+        search_engine.encoder = ImageEncoder(
+            mode=ENCODER_MODE,
+            num_threads=ENCODER_THREADS,
+            channels_last=ENCODER_CHANNELS_LAST,
+        )
+        search_engine.startup_timings["encoder_seconds"] = round(time.perf_counter() - start, 2)
+    
+    if search_engine.index is None:
+        start = time.perf_counter()
+        if not search_engine.load_search_data():
+            raise Exception("Failed to load search data")
+        search_engine.startup_timings["search_data_seconds"] = round(time.perf_counter() - start, 2)
+    
+    if VLM_LOAD == "eager":
+        search_engine.vlm.load()
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize search engine on startup"""
     try:
         logger.info("Starting initialization...")
+        load_models()
+        embedding_batcher.start()
         
-        # Initialize ConvNeXT
-        from convnext_init import ImageEncoder
-        search_engine.encoder = ImageEncoder()
-        
-        # Load search data
-        if not search_engine.load_search_data():
-            raise Exception("Failed to load search data")
-        
-        # Initialize Qwen
-        search_engine.qwen_model = Qwen2VLForConditionalGeneration.from_pretrained(
-            "Qwen/Qwen2-VL-2B-Instruct",
-        ).to('cpu')
-        search_engine.qwen_processor = AutoProcessor.from_pretrained(
-            "Qwen/Qwen2-VL-2B-Instruct"
-        )
+        # Qwen is not needed for search, so by default it loads after serving starts
+        if VLM_LOAD == "background":
+            search_engine.vlm.start_background()
         
         logger.info("Initialization completed successfully")
     except Exception as e:
         logger.error(f"Error in startup: {str(e)}")
         logger.error(traceback.format_exc())
 
-# @app.post("/predict", response_model=PredictionResult)
-# async def predict(file: UploadFile = File(...)):
-#     """Endpoint for image search predictions"""
-#     try:
-#         if not file.content_type.startswith("image/"):
-#             raise HTTPException(status_code=400, detail="File must be an image")
+def check_mode(mode: Optional[str]) -> str:
+    mode = mode or PREDICT_MODE
+    if mode not in ("raw", "category", "classify"):
+        raise HTTPException(status_code=400, detail="mode must be 'raw', 'category' or 'classify'")
+    return mode
 
-#         # Process uploaded image
-#         contents = await file.read()
-#         image = Image.open(io.BytesIO(contents))
-        
-#         temp_path = "temp_image.jpg"
-#         image.save(temp_path)
-        
-#         try:
-#             # Get image embedding
-#             embedding = search_engine.encoder.get_embedding(temp_path)
-            
-#             if embedding is None:
-#                 raise HTTPException(status_code=500, detail="Failed to get embedding")
-                
-#             # Find similar images
-#             candidates, similarities = search_engine.find_similar_images(embedding)
-            
-#             # Select recommendations
-#             (recommendations, category, confidence_score, 
-#              closest_distance, majority_count) = search_engine.select_recommendations(
-#                 candidates, similarities
-#             )
-            
-#             # Create previews
-#             top_previews = search_engine.create_preview_candidates(
-#                 candidates, category, majority_count
-#             )
-            
-#             return PredictionResult(
-#                 image_path=file.filename,
-#                 recs=",".join(recommendations),
-#                 model_used='convnext',
-#                 confidence_score=float(confidence_score),
-#                 top_matches=top_previews,
-#                 category=category,
-#                 closest_distance=float(closest_distance),
-#                 category_count=majority_count
-#             )
-            
-#         finally:
-#             if os.path.exists(temp_path):
-#                 os.remove(temp_path)
+def check_preview_mode(preview_mode: Optional[str]) -> str:
+    preview_mode = preview_mode or PREVIEW_MODE
+    if preview_mode not in ("inline", "url"):
+        raise HTTPException(status_code=400, detail="preview_mode must be 'inline' or 'url'")
+    return preview_mode
+
+def check_text_weight(text_weight: Optional[float]) -> float:
+    text_weight = HYBRID_TEXT_WEIGHT if text_weight is None else text_weight
+    if not 0 <= text_weight <= 1:
+        raise HTTPException(status_code=400, detail="text_weight must be between 0 and 1")
+    if text_weight > 0 and search_engine.hybrid is None:
+        raise HTTPException(status_code=400, detail="Index was built without text embeddings")
+    return text_weight
+
+def check_search_options(k: Optional[int], candidates: Optional[int], search_k: Optional[int],
+                         nprobe: Optional[int], rerank: Optional[int],
+                         adaptive: Optional[bool], collapse: Optional[bool] = None,
+                         category: Optional[str] = None) -> SearchOptions:
+    k = PREDICT_RESULTS if k is None else k
+    if not 1 <= k <= MAX_PREDICT_CANDIDATES:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_PREDICT_CANDIDATES}")
+    candidates = max(PREDICT_CANDIDATES, k) if candidates is None else candidates
+    if not k <= candidates <= MAX_PREDICT_CANDIDATES:
+        raise HTTPException(status_code=400,
+                            detail=f"candidates must be between k and {MAX_PREDICT_CANDIDATES}")
+    if search_k is not None and not (1 <= search_k <= MAX_SEARCH_K or search_k == -1):
+        raise HTTPException(status_code=400,
+                            detail=f"search_k must be between 1 and {MAX_SEARCH_K}, or -1 for annoy's default")
+    if nprobe is not None and not 1 <= nprobe <= MAX_NPROBE:
+        raise HTTPException(status_code=400, detail=f"nprobe must be between 1 and {MAX_NPROBE}")
+    if rerank is not None and not 1 <= rerank <= MAX_RERANK:
+        raise HTTPException(status_code=400, detail=f"rerank must be between 1 and {MAX_RERANK}")
+    if collapse and search_engine.duplicate_of is None:
+        raise HTTPException(status_code=400, detail="Index has no duplicate clusters, run dedup.py")
+    if category is not None and category not in search_engine.categories:
+        raise HTTPException(status_code=400, detail=f"Unknown category {category}")
+    search_params = {"search_k": search_k, "nprobe": nprobe, "rerank": rerank}
+    return SearchOptions(
+        k=k,
+        candidates=candidates,
+        search_params=tuple((name, value) for name, value in search_params.items() if value is not None),
+        adaptive=ADAPTIVE_SEARCH if adaptive is None else adaptive,
+        collapse=COLLAPSE_DUPLICATES if collapse is None else collapse,
+        category=list(search_engine.categories).index(category) if category is not None else None,
+    )
+
+async def caption_embeddings(images, text_weight):
+    """Caption vectors for hybrid search, None per image when it is off"""
+    if text_weight <= 0:
+        return [None] * len(images)
+    _, text_embeddings = await run_in_threadpool(search_engine.caption_embedder.embed_images, images)
+    return list(text_embeddings)
+
+async def read_upload(file: UploadFile) -> bytes:
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    with timed("read"):
+        return await file.read()
+
+async def decode_upload(file: UploadFile, contents: bytes) -> Image.Image:
+    """Decode an upload in memory, off the event loop"""
+    try:
+        with timed("decode"):
+            return await run_in_threadpool(load_image, contents)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cannot decode image {file.filename}: {str(e)}")
+
+async def read_upload_image(file: UploadFile) -> Image.Image:
+    return await decode_upload(file, await read_upload(file))
+
+async def cached_embeddings(keys, images, compute, stage="embed"):
+    """Vectors for images, computing (in one batch) only those whose keys all miss"""
+    vectors = []
+    for image_keys in keys:
+        vector = None
+        for key in image_keys:
+            vector = query_embeddings.get(key)
+            if vector is not None:
+                break
+        vectors.append(vector)
+    
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        with timed(stage):
+            computed = await compute([images[i] for i in missing])
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+            for key in keys[i]:
+                query_embeddings.put(key, vector)
+    return vectors
+
+async def predict_uploads(files, mode, preview_mode, text_weight, search_options=SearchOptions()):
+    """Predictions for uploads, answering repeats from the query cache.
+
+    Results are tied to the index generation they were computed on, so any
+    update or swap of the index invalidates them; embeddings only depend on
+    the image and stay valid.
+    """
+    engine = search_engine.snapshot()
+    options = (mode, preview_mode, text_weight, search_options)
+    results = [None] * len(files)
+    pending = []
+    for i, file in enumerate(files):
+        contents = await read_upload(file)
+        with timed("cache"):
+            keys = [content_hash(contents)]
+            result = query_results.get((keys[0], options), engine.generation)
+        if result is None:
+            image = await decode_upload(file, contents)
+            if QUERY_CACHE_PHASH:
+                with timed("cache"):
+                    keys.append(f"phash:{await run_in_threadpool(perceptual_hash, image)}")
+                    result = query_results.get((keys[1], options), engine.generation)
+        if result is not None:
+            results[i] = result.model_copy(update={"image_path": file.filename})
+        else:
+            pending.append((i, file, image, keys))
+    if not pending:
+        return results
+    
+    images = [image for _, _, image, _ in pending]
+    keys = [image_keys for _, _, _, image_keys in pending]
+    # Concurrent requests share one batched forward pass
+    embeddings = await cached_embeddings(keys, images, embedding_batcher.submit_many)
+    if text_weight > 0:
+        text_embeddings = await cached_embeddings(
+            [[f"text:{key}" for key in image_keys] for image_keys in keys], images,
+            lambda missing: caption_embeddings(missing, text_weight), stage="caption",
+        )
+    else:
+        text_embeddings = [None] * len(pending)
+    
+    searched = await run_in_threadpool(lambda: [
+        engine.search(embedding, file.filename, mode=mode, preview_mode=preview_mode,
+                      text_embedding=text_embedding, text_weight=text_weight, options=search_options)
+        for (_, file, _, _), embedding, text_embedding in zip(pending, embeddings, text_embeddings)
+    ])
+    for (i, _, _, image_keys), result in zip(pending, searched):
+        results[i] = result
+        for key in image_keys:
+            query_results.put((key, options), result, engine.generation)
+    return results
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await embedding_batcher.stop()
+    await describe_batcher.stop()
+    if isinstance(search_engine.base_index, ShardedBackend):
+        search_engine.base_index.close()
+
+@app.post("/predict", response_model=PredictionResult)
+async def predict(file: UploadFile = File(...), mode: Optional[str] = None,
+                  preview_mode: Optional[str] = None, text_weight: Optional[float] = None,
+                  k: Optional[int] = None, candidates: Optional[int] = None,
+                  search_k: Optional[int] = None, nprobe: Optional[int] = None,
+                  rerank: Optional[int] = None, adaptive: Optional[bool] = None,
+                  collapse: Optional[bool] = None, category: Optional[str] = None):
+    """Endpoint for image search predictions: raw, category-aware, or
+    classify for the category alone.
+
+    k, candidates and the backend's search parameters (search_k for annoy,
+    nprobe for ivf, rerank for compressed) override the configured search
+    budget for this request; adaptive toggles the two-pass search. collapse
+    returns one image per duplicate cluster and category restricts the
+    search to one category.
+    """
+    try:
+        mode = check_mode(mode)
+        preview_mode = check_preview_mode(preview_mode)
+        text_weight = check_text_weight(text_weight)
+        search_options = check_search_options(k, candidates, search_k, nprobe, rerank, adaptive,
+                                              collapse, category)
+        return (await predict_uploads([file], mode, preview_mode, text_weight, search_options))[0]
                 
-#     except Exception as e:
-#         logger.error(f"Error processing request: {str(e)}")
-#         logger.error(traceback.format_exc())
-#         raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/predict/batch", response_model=List[PredictionResult])
+async def predict_batch(files: List[UploadFile] = File(...), mode: Optional[str] = None,
+                        preview_mode: Optional[str] = None, text_weight: Optional[float] = None,
+                        k: Optional[int] = None, candidates: Optional[int] = None,
+                        search_k: Optional[int] = None, nprobe: Optional[int] = None,
+                        rerank: Optional[int] = None, adaptive: Optional[bool] = None,
+                        collapse: Optional[bool] = None, category: Optional[str] = None):
+    """Image search predictions for many images in one request"""
+    try:
+        mode = check_mode(mode)
+        preview_mode = check_preview_mode(preview_mode)
+        text_weight = check_text_weight(text_weight)
+        search_options = check_search_options(k, candidates, search_k, nprobe, rerank, adaptive,
+                                              collapse, category)
+        return await predict_uploads(files, mode, preview_mode, text_weight, search_options)
         
-@app.post("/predict", response_model=PredictionResult)
-async def predict(file: UploadFile = File(...)):
-    """Endpoint for raw image search predictions without post-processing"""
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing batch request: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/describe", response_model=DescribeResult)
+async def describe(file: UploadFile = File(...), task: str = "caption",
+                   max_new_tokens: Optional[int] = None):
+    """Caption an image, or pick its catalog category, with Qwen2-VL"""
     try:
+        if task not in ("caption", "category"):
+            raise HTTPException(status_code=400, detail="task must be 'caption' or 'category'")
         if not file.content_type.startswith("image/"):
             raise HTTPException(status_code=400, detail="File must be an image")
-
-        # Process uploaded image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        
-        temp_path = "temp_image.jpg"
-        image.save(temp_path)
-        
-        try:
-            # Get image embedding
-            embedding = search_engine.encoder.get_embedding(temp_path)
-            
-            if embedding is None:
-                raise HTTPException(status_code=500, detail="Failed to get embedding")
-                
-            # Get raw search results (top 10)
-            similar_idx, distances = search_engine.annoy_index.get_nns_by_vector(
-                embedding, 10, include_distances=True
-            )
-            
-            # Convert distances to similarities
-            similarities = [1 - (dist * 2 / math.pi) for dist in distances]
-            
-            # Get recommendations and categories
-            recommendations = [search_engine.file_mapping[idx] for idx in similar_idx]
-            categories = [search_engine.class_mapping[idx] for idx in similar_idx]
+        if VLM_LOAD == "disabled":
+            raise HTTPException(status_code=503, detail="VLM is disabled")
             
-            # Create preview info for top 3
-            top_previews = []
-            for idx, sim, cat in list(zip(similar_idx, similarities, categories))[:3]:
-                preview = search_engine.get_image_preview(search_engine.file_mapping[idx])
-                if preview:
-                    top_previews.append(ImagePreview(
-                        image_path=search_engine.file_mapping[idx],
-                        preview_path=preview,
-                        category=cat,
-                        similarity=float(sim),
-                        distance=float(1 - sim)
-                    ))
+        choices = list(search_engine.categories)
+        if task == "category" and not choices:
+            raise HTTPException(status_code=503, detail="Search index is not loaded")
+        prompt = (
+            CAPTION_PROMPT if task == "caption"
+            else build_choice_prompt(CATEGORY_QUESTION, choices)
+        )
+        max_new_tokens = describer.cap_tokens(max_new_tokens)
+        
+        # Repeat queries are answered from the cache without touching the model
+        contents = await file.read()
+        key = describe_cache_key(contents, prompt, max_new_tokens)
+        cached = describer.get_cached(key)
+        if cached is None:
+            try:
+                image = await run_in_threadpool(load_image, contents, False)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Cannot decode image {file.filename}: {str(e)}")
+            try:
+                await run_in_threadpool(search_engine.vlm.load)
+            except Exception as e:
+                raise HTTPException(status_code=503, detail=f"VLM unavailable: {str(e)}")
             
-            return PredictionResult(
-                image_path=file.filename,
-                recs=",".join(recommendations),
-                model_used='convnext',
-                confidence_score=float(similarities[0]) if similarities else 0.0,
-                top_matches=top_previews,
-                category=categories[0] if categories else "",
-                closest_distance=float(distances[0]) if distances else 1.0,
-                category_count=len(set(categories))
-            )
+            with timed("generate"):
+                text, generated_tokens = await describe_batcher.submit((image, prompt, max_new_tokens))
+            describer.put_cached(key, (text, generated_tokens))
+        else:
+            text, generated_tokens = cached
             
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                
+        return DescribeResult(
+            image_path=file.filename,
+            task=task,
+            text=text,
+            category=parse_choice(text, choices) if task == "category" else None,
+            cached=cached is not None,
+            generated_tokens=generated_tokens,
+        )
+        
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error processing request: {str(e)}")
+        logger.error(f"Error processing describe request: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+def check_single_worker():
+    if SERVE_WORKERS > 1:
+        raise HTTPException(status_code=409, detail="Index updates need a single worker process; "
+                                                    f"this server runs {SERVE_WORKERS}")
+
+def check_item_name(name: str, what: str) -> str:
+    if not name or name in (".", "..") or os.path.basename(name) != name:
+        raise HTTPException(status_code=400, detail=f"Invalid {what} {name!r}")
+    return name
+
+@app.post("/index/items")
+async def add_index_items(files: List[UploadFile] = File(...), category: str = Query(...)):
+    """Embed new images and make them searchable without a rebuild"""
+    try:
+        check_single_worker()
+        check_item_name(category, "category")
+        names = [check_item_name(os.path.basename(file.filename or ""), "file name") for file in files]
+        stems = [Path(name).stem for name in names]
+        for stem in stems:
+            if search_engine.is_live(stem):
+                raise HTTPException(status_code=409, detail=f"{stem} is already indexed")
+        
+        images = [await read_upload_image(file) for file in files]
+        embeddings = await embedding_batcher.submit_many(images)
+        
+        # Keep the originals in the dataset, so previews and full rebuilds find them
+        paths = []
+        for file, name in zip(files, names):
+            os.makedirs(os.path.join("dataset", category), exist_ok=True)
+            path = os.path.join("dataset", category, name)
+            await file.seek(0)
+            with open(path, "wb") as f:
+                f.write(await file.read())
+            paths.append(path)
+        
+        ids = search_engine.add_items(np.stack(embeddings), stems, [category] * len(stems), paths)
+        if search_engine.pending_changes() >= COMPACT_THRESHOLD:
+            search_engine.start_compaction()
+        return {
+            "added": [{"id": idx, "image_path": stem, "category": category}
+                      for idx, stem in zip(ids, stems)],
+            "live_index": search_engine.live_stats(),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error adding index items: {str(e)}")
         logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.delete("/index/items")
+async def delete_index_items(image_path: List[str] = Query(...)):
+    """Remove images from search results right away; files are left in the dataset"""
+    check_single_worker()
+    ids = search_engine.delete_items(image_path)
+    if not ids:
+        raise HTTPException(status_code=404, detail="No indexed images with these names")
+    if search_engine.pending_changes() >= COMPACT_THRESHOLD:
+        search_engine.start_compaction()
+    return {"deleted": len(ids), "live_index": search_engine.live_stats()}
+
+@app.post("/index/compact")
+async def compact_index():
+    """Fold pending additions and deletions into a rebuilt index in the background"""
+    check_single_worker()
+    if isinstance(search_engine.base_index, ShardedBackend):
+        raise HTTPException(status_code=400, detail="Sharded indexes cannot be compacted in place")
+    return {"started": search_engine.start_compaction(), "live_index": search_engine.live_stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text exposition of request, stage, model and cache metrics"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/status")
 async def get_status():
     """Get service status"""
     return {
-        "convnext_ready": search_engine.encoder is not None and search_engine.annoy_index is not None,
-        "qwen_ready": search_engine.qwen_model is not None and search_engine.qwen_processor is not None,
-        "index_size": len(search_engine.file_mapping) if search_engine.file_mapping else 0,
+        "convnext_ready": search_engine.encoder is not None and search_engine.index is not None,
+        "qwen_ready": search_engine.vlm.ready,
+        "qwen": search_engine.vlm.status(),
+        "describe": {**describer.stats(), "batching": describe_batcher.stats()},
+        "startup_timings": search_engine.startup_timings,
+        "index_size": len(search_engine.file_mapping),
         "embedding_dim": search_engine.embedding_dim,
+        "search_backend": SEARCH_BACKEND,
+        "search_defaults": SearchOptions()._asdict(),
+        "shards": search_engine.base_index.stats()
+        if isinstance(search_engine.base_index, ShardedBackend) else None,
+        "live_index": search_engine.live_stats(),
+        "encoder_mode": ENCODER_MODE,
+        "worker": {"pid": os.getpid(), "workers": SERVE_WORKERS},
+        "batching": embedding_batcher.stats(),
+        "thumbnails_ready": search_engine.thumbnails is not None,
+        "hybrid_ready": search_engine.hybrid is not None,
+        "category_prototypes": len(search_engine.prototypes.prototypes)
+        if search_engine.prototypes is not None else 0,
+        "duplicates": len(search_engine.duplicate_rows),
+        "preview_cache": search_engine.preview_cache.stats(),
+        "query_cache": {
+            "index_generation": search_engine.generation,
+            "embeddings": query_embeddings.stats(),
+            "results": query_results.stats(),
+        },
     }
 
 if __name__ == "__main__":
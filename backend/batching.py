@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "batcher_queue_wait_seconds", "Time items wait in a micro-batcher queue", ["batcher"]
+)
+BATCH_SECONDS = REGISTRY.histogram(
+    "batcher_batch_seconds", "Time to process one micro-batch", ["batcher"]
+)
+BATCH_SIZE = REGISTRY.histogram(
+    "batcher_batch_size", "Items per micro-batch", ["batcher"], buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+class MicroBatcher:
+    """Merge concurrent requests into batched calls of process_batch.
+
+    Items submitted from any coroutine are queued; a single background task
+    collects up to max_batch_size of them (waiting at most max_wait_ms after
+    the first one arrives) and runs process_batch(items) in an executor, so
+    the event loop never blocks on inference. process_batch must return one
+    result per item, in order.
+    """
+
+    def __init__(self, process_batch, max_batch_size=16, max_wait_ms=10, executor=None, name="default"):
+        self.process_batch = process_batch
+        self.name = name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="batcher")
+        self.queue = None
+        self.worker = None
+        self.batches = 0
+        self.items = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def start(self):
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def submit(self, item):
+        """Queue one item and wait for its result"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def submit_many(self, items):
+        return await asyncio.gather(*(self.submit(item) for item in items))
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Skip requests whose callers already went away
+            batch = [entry for entry in batch if not entry[1].cancelled()]
+            if not batch:
+                continue
+            items = [item for item, _, _ in batch]
+            started = time.perf_counter()
+            waits = [started - enqueued for _, _, enqueued in batch]
+            self.queue_wait_total += sum(waits)
+            self.queue_wait_max = max(self.queue_wait_max, *waits)
+            for wait in waits:
+                QUEUE_WAIT_SECONDS.observe(wait, batcher=self.name)
+            BATCH_SIZE.observe(len(items), batcher=self.name)
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, items)
+                BATCH_SECONDS.observe(time.perf_counter() - started, batcher=self.name)
+            except Exception as e:
+                logger.error(f"Batch of {len(items)} failed: {str(e)}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(items)
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "avg_queue_wait_ms": round(1000 * self.queue_wait_total / self.items, 2) if self.items else 0.0,
+            "max_queue_wait_ms": round(1000 * self.queue_wait_max, 2),
+        }
@@ -0,0 +1,357 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw, ImageFilter
+from pathlib import Path
+import urllib.request
+import numpy as np
+import subprocess
+import argparse
+import colorsys
+import logging
+import shutil
+import json
+import time
+import sys
+import os
+import io
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _percentiles(values_ms):
+    values_ms = np.asarray(values_ms, dtype=np.float64)
+    if not len(values_ms):
+        return {"mean_ms": None, "p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {
+        "mean_ms": round(float(values_ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(values_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(values_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(values_ms, 99)), 3),
+    }
+
+def make_synthetic_image(category, n_categories, rng, size=256):
+    """Image whose palette and shape family depend on the category, with
+    random layout, so categories are separable but instances are not copies"""
+    hue = category / n_categories
+    background = tuple(int(255 * c) for c in colorsys.hsv_to_rgb(hue, 0.25, 0.9))
+    image = Image.new("RGB", (size, size), background)
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(3, 7)):
+        color = colorsys.hsv_to_rgb((hue + rng.normal(0, 0.03)) % 1.0, rng.uniform(0.5, 1), rng.uniform(0.3, 1))
+        color = tuple(int(255 * c) for c in color)
+        x, y = rng.integers(0, size, 2)
+        r = int(rng.integers(size // 10, size // 3))
+        box = [x - r, y - r, x + r, y + r]
+        kind = category % 3
+        if kind == 0:
+            draw.ellipse(box, fill=color)
+        elif kind == 1:
+            draw.rectangle(box, fill=color)
+        else:
+            draw.polygon([(x, y - r), (x - r, y + r), (x + r, y + r)], fill=color)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+def perturb(image, rng):
+    """Crop, flip and re-encode: a query that should find its source image"""
+    width, height = image.size
+    scale = rng.uniform(0.8, 0.95)
+    w, h = int(width * scale), int(height * scale)
+    x, y = rng.integers(0, width - w + 1), rng.integers(0, height - h + 1)
+    image = image.crop((x, y, x + w, y + h)).resize((width, height))
+    if rng.random() < 0.5:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=int(rng.integers(60, 90)))
+    return buffered.getvalue()
+
+def make_synthetic_catalog(workdir, n_categories=10, per_category=50, n_queries=200, size=256, seed=0):
+    """Write workdir/dataset/<category>/<category>_<i>.jpg plus perturbed
+    query copies; returns [(query_path, source_name, category)]"""
+    rng = np.random.default_rng(seed)
+    dataset = os.path.join(workdir, "dataset")
+    query_dir = os.path.join(workdir, "queries")
+    shutil.rmtree(dataset, ignore_errors=True)
+    shutil.rmtree(query_dir, ignore_errors=True)
+    os.makedirs(query_dir)
+
+    sources = []
+    for category in range(n_categories):
+        name = f"category_{category:03d}"
+        os.makedirs(os.path.join(dataset, name))
+        for i in range(per_category):
+            image = make_synthetic_image(category, n_categories, rng, size)
+            image.save(os.path.join(dataset, name, f"{name}_{i}.jpg"), quality=90)
+            sources.append((f"{name}_{i}", name))
+
+    queries = []
+    for i in rng.choice(len(sources), min(n_queries, len(sources)), replace=False):
+        source, category = sources[i]
+        with Image.open(os.path.join(dataset, category, f"{source}.jpg")) as image:
+            data = perturb(image.convert("RGB"), rng)
+        path = os.path.join(query_dir, f"{source}.jpg")
+        with open(path, "wb") as f:
+            f.write(data)
+        queries.append((path, source, category))
+    logger.info(f"Synthetic catalog: {len(sources)} images in {n_categories} categories, "
+                f"{len(queries)} queries")
+    return queries
+
+def bench_indexing(workdir, encoder, batch_size=32, num_workers=None):
+    """Embed the catalog and build the default index, timing the whole run"""
+    from convnext_init import process_dataset
+
+    start = time.perf_counter()
+    embeddings, _, _, _, _ = process_dataset(
+        os.path.join(workdir, "dataset"), encoder, save_dir=os.path.join(workdir, "data"),
+        batch_size=batch_size, num_workers=num_workers,
+    )
+    seconds = time.perf_counter() - start
+    return {
+        "images": len(embeddings),
+        "seconds": round(seconds, 2),
+        "images_per_sec": round(len(embeddings) / seconds, 2),
+    }
+
+def embed_queries(queries, encoder, batch_size=32, num_workers=None):
+    from convnext_init import embed_images
+
+    vectors = {}
+    for batch_meta, embeddings in embed_images(
+        [(path, category) for path, _, category in queries], encoder, batch_size, num_workers
+    ):
+        for (path, _), embedding in zip(batch_meta, embeddings):
+            vectors[path] = embedding
+    return np.stack([vectors[path] for path, _, _ in queries])
+
+def bench_backends(data_dir, query_vectors, backends, k=10):
+    """Build time, memory, recall@k against exact search and latency per backend"""
+    from search_backends import build_backend, benchmark
+    from embedding_store import EmbeddingStore
+
+    store = EmbeddingStore.load(data_dir)
+    built, build_seconds = {}, {}
+    for name in backends:
+        start = time.perf_counter()
+        built[name] = build_backend(name, store.embeddings, data_dir)
+        build_seconds[name] = round(time.perf_counter() - start, 3)
+    report = benchmark(built, store.embeddings, query_vectors, k=k)
+    for row in report:
+        row["build_seconds"] = build_seconds[row["backend"]]
+    return report
+
+def bench_categories(workdir, queries, query_vectors, n_candidates=30, k=10):
+    """Category accuracy of the raw top-1, of select_recommendations and of
+    the classify-only prototypes, and how often the query's source image
+    comes back in the raw top k"""
+    from search_engine import ImageSearchEngine
+
+    engine = ImageSearchEngine()
+    if not engine.load_search_data(os.path.join(workdir, "data")):
+        raise RuntimeError("Could not load the benchmark index")
+
+    raw_hits = category_hits = source_hits = prototype_hits = 0
+    for (_, source, category), vector in zip(queries, query_vectors):
+        ids, _ = engine.nearest(vector, k)
+        names = [str(engine.file_mapping[i]) for i in ids]
+        source_hits += source in names
+        raw_hits += bool(len(ids)) and engine.category_of(ids[0]) == category
+        candidates, similarities = engine.find_similar_images(vector, n_candidates)
+        category_hits += engine.select_recommendations(candidates, similarities)[1] == category
+        prototype_hits += engine.categories[engine.prototypes.classify(vector, top=1)[0][0]] == category
+    n = len(queries)
+    return {
+        "n_candidates": n_candidates,
+        "raw_top1_accuracy": round(raw_hits / n, 4),
+        "category_accuracy": round(category_hits / n, 4),
+        "prototype_accuracy": round(prototype_hits / n, 4),
+        f"source_recall@{k}": round(source_hits / n, 4),
+    }
+
+def encode_multipart(field, filename, data, content_type="image/jpeg"):
+    boundary = f"bench{os.urandom(8).hex()}"
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def start_server(workdir, port, env=None):
+    """uvicorn app:app serving the benchmark catalog, VLM and query cache off"""
+    environment = {
+        **os.environ,
+        "PYTHONPATH": BACKEND_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""),
+        "VLM_LOAD": "disabled",
+        "QUERY_CACHE_SIZE": "0",
+        "LOG_LEVEL": "WARNING",
+        **(env or {}),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=environment,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Benchmark server exited during startup")
+        try:
+            with urllib.request.urlopen(f"{url}/status", timeout=2) as response:
+                if json.load(response).get("convnext_ready"):
+                    return process, url
+        except OSError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise TimeoutError("Benchmark server did not become ready")
+
+def load_test(url, payloads, concurrency, n_requests, mode="raw"):
+    """Fire n_requests /predict calls from `concurrency` threads"""
+
+    def send(i):
+        body, content_type = encode_multipart("file", f"q{i}.jpg", payloads[i % len(payloads)])
+        request = urllib.request.Request(
+            f"{url}/predict?mode={mode}", data=body, headers={"Content-Type": content_type}
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                response.read()
+                ok = response.status == 200
+        except OSError:
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(n_requests)))
+    seconds = time.perf_counter() - start
+    latencies = [ms for ms, ok in results if ok]
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": n_requests - len(latencies),
+        "requests_per_sec": round(len(latencies) / seconds, 2),
+        **_percentiles(latencies),
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(args):
+    from convnext_init import ImageEncoder
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+    }
+
+    queries = make_synthetic_catalog(workdir, args.categories, args.per_category, args.queries,
+                                     seed=args.seed)
+    encoder = ImageEncoder(mode=args.encoder_mode, num_threads=args.threads)
+    results["indexing"] = bench_indexing(workdir, encoder, args.batch_size, args.workers)
+
+    start = time.perf_counter()
+    query_vectors = embed_queries(queries, encoder, args.batch_size, args.workers)
+    results["query_embedding"] = {
+        "images_per_sec": round(len(queries) / (time.perf_counter() - start), 2)
+    }
+
+    results["search"] = bench_backends(os.path.join(workdir, "data"), query_vectors,
+                                       args.backends.split(","), args.k)
+    results["categories"] = bench_categories(workdir, queries, query_vectors,
+                                             args.n_candidates, args.k)
+
+    if args.load_test or args.url:
+        del encoder
+        process, url = (None, args.url) if args.url else start_server(workdir, args.port)
+        try:
+            payloads = [Path(path).read_bytes() for path, _, _ in queries]
+            results["predict"] = [
+                load_test(url, payloads, concurrency, args.requests, mode=args.mode)
+                for concurrency in (int(c) for c in args.concurrency.split(","))
+            ]
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+    return results
+
+def _flatten(value, prefix=""):
+    """{"a": {"b": 1}, "c": [{"backend": "x", "d": 2}]} -> {"a.b": 1, "c.x.d": 2}"""
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(_flatten(item, f"{prefix}{key}."))
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            name = item.get("backend", item.get("concurrency", i)) if isinstance(item, dict) else i
+            flat.update(_flatten(item, f"{prefix}{name}."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        flat[prefix.rstrip(".")] = value
+    return flat
+
+def compare(baseline, candidate):
+    """Metric-by-metric change between two result files"""
+    old = _flatten({k: v for k, v in baseline.items() if k != "config"})
+    new = _flatten({k: v for k, v in candidate.items() if k != "config"})
+    rows = []
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / abs(old[name]) if old[name] else None
+        rows.append({"metric": name, "baseline": old[name], "candidate": new[name],
+                     "change": round(change, 4) if change is not None else None})
+    return rows
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Benchmark encoder, index and API on a synthetic catalog")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run")
+    run.add_argument("--workdir", default="./bench")
+    run.add_argument("--output", default=None, help="write results JSON here")
+    run.add_argument("--categories", type=int, default=10)
+    run.add_argument("--per-category", type=int, default=50)
+    run.add_argument("--queries", type=int, default=200)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--encoder-mode", default="eager")
+    run.add_argument("--threads", type=int, default=None)
+    run.add_argument("--batch-size", type=int, default=32)
+    run.add_argument("--workers", type=int, default=None)
+    run.add_argument("--backends", default="exact,annoy,ivf")
+    run.add_argument("--k", type=int, default=10)
+    run.add_argument("--n-candidates", type=int, default=30)
+    run.add_argument("--load-test", action="store_true", help="also load-test /predict")
+    run.add_argument("--url", default=None, help="load-test a running server instead of starting one")
+    run.add_argument("--port", type=int, default=8765)
+    run.add_argument("--concurrency", default="1,4,16")
+    run.add_argument("--requests", type=int, default=200)
+    run.add_argument("--mode", default="raw", choices=["raw", "category"])
+
+    diff = subparsers.add_parser("compare")
+    diff.add_argument("baseline")
+    diff.add_argument("candidate")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_suite(args)
+        text = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text)
+        print(text)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        for row in compare(baseline, candidate):
+            print(json.dumps(row))
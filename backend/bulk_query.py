@@ -0,0 +1,280 @@
+from convnext_init import ImageEncoder, ENCODER_MODES, IMAGE_EXTENSIONS, embed_images
+from search_engine import ImageSearchEngine
+from search_backends import angular_distance
+from pathlib import Path
+import numpy as np
+import argparse
+import logging
+import json
+import math
+import time
+import csv
+import os
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ["path", "image", "recs", "category", "confidence"]
+
+def iter_folder(folder):
+    """Every image under folder, in a stable order"""
+    for path in sorted(Path(folder).rglob("*.*")):
+        if path.suffix.lower() in IMAGE_EXTENSIONS:
+            yield str(path)
+
+def iter_manifest(manifest, root=None):
+    """Paths listed one per line; relative ones are resolved against root,
+    the manifest's own directory by default"""
+    root = Path(root) if root is not None else Path(manifest).parent
+    with open(manifest) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield str(root / line)
+
+class CSVResults:
+    """Rows appended to a CSV file and flushed after every batch"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def done(self):
+        """Paths already written; a row cut off by an interruption is dropped"""
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+        with open(self.path, newline="") as f:
+            return {row["path"] for row in csv.DictReader(f) if row.get("path")}
+
+    def write(self, rows):
+        if self.file is None:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self.file = open(self.path, "a", newline="")
+            self.writer = csv.DictWriter(self.file, COLUMNS)
+            if new:
+                self.writer.writeheader()
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ParquetResults:
+    """Rows written as a directory of Parquet part files.
+
+    A part is only renamed into place once it is complete, so an
+    interrupted run leaves nothing half-written; the rows it had buffered
+    are simply queried again on resume.
+    """
+
+    def __init__(self, path, rows_per_part=10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet output needs pyarrow: pip install pyarrow")
+        self.pyarrow = pyarrow
+        self.parquet = pyarrow.parquet
+        self.path = path
+        self.rows_per_part = rows_per_part
+        self.buffer = []
+        os.makedirs(path, exist_ok=True)
+        self.next_part = len(self.parts())
+
+    def parts(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith(".parquet"))
+
+    def done(self):
+        done = set()
+        for name in self.parts():
+            table = self.parquet.read_table(os.path.join(self.path, name), columns=["path"])
+            done.update(table.column("path").to_pylist())
+        return done
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        table = self.pyarrow.Table.from_pylist(self.buffer)
+        name = os.path.join(self.path, f"part-{self.next_part:05d}.parquet")
+        self.parquet.write_table(table, name + ".tmp")
+        os.replace(name + ".tmp", name)
+        self.next_part += 1
+        self.buffer = []
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.rows_per_part:
+            self._flush()
+
+    def close(self):
+        self._flush()
+
+def open_results(path, output_format, rows_per_part=10000):
+    if output_format == "parquet":
+        return ParquetResults(path, rows_per_part)
+    return CSVResults(path)
+
+def load_engine(data_dir):
+    engine = ImageSearchEngine()
+    if not engine.load_search_data(data_dir):
+        raise SystemExit(f"Could not load the search index from {data_dir}")
+    return engine
+
+def score_batch(engine, paths, embeddings, mode="category", k=10, n_candidates=30,
+                search_params=None, exclude_self=False):
+    """One output row per query image"""
+    if mode == "classify":
+        scores = engine.prototypes.scores(embeddings)
+        best = np.argmax(scores, axis=1)
+        similarities = 1 - angular_distance(scores[np.arange(len(best)), best]) * 2 / math.pi
+        return [
+            {"path": path, "image": os.path.basename(path), "recs": "",
+             "category": engine.categories[category_id], "confidence": round(float(similarity), 6)}
+            for path, category_id, similarity in zip(paths, best, similarities)
+        ]
+
+    # One extra neighbour makes up for a query that is itself in the catalog
+    n_results = (n_candidates if mode == "category" else k) + int(exclude_self)
+    rows = []
+    for path, (ids, distances) in zip(paths, engine.nearest_batch(embeddings, n_results, search_params)):
+        exclude = None
+        if exclude_self:
+            ids, distances = np.asarray(ids, dtype=np.int64), np.asarray(distances)
+            own = np.asarray(engine.file_mapping)[ids] == Path(path).stem
+            # Category padding must not bring the query's own image back either
+            exclude = np.union1d(engine.deleted, ids[own])
+            ids, distances = ids[~own][:n_results - 1], distances[~own][:n_results - 1]
+        if mode == "category":
+            candidates, similarities = engine.to_candidates(ids, distances)
+            recs, category, confidence, _, _ = engine.select_recommendations(
+                candidates, similarities, limit=k, exclude=exclude
+            )
+        else:
+            recs = [str(engine.file_mapping[idx]) for idx in ids[:k]]
+            category = engine.category_of(ids[0]) if len(ids) else None
+            confidence = 1 - distances[0] * 2 / math.pi if len(distances) else 0.0
+        rows.append({"path": path, "image": os.path.basename(path), "recs": ",".join(recs),
+                     "category": category or "", "confidence": round(float(confidence), 6)})
+    return rows
+
+class Progress:
+    """Throughput log lines every `every` seconds and the final summary"""
+
+    def __init__(self, every=10.0, total=None):
+        self.every = every
+        self.total = total
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.images = 0
+        self.search_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def update(self, images):
+        self.images += images
+        now = time.perf_counter()
+        if now - self.last_report >= self.every:
+            self.last_report = now
+            rate = self.images / (now - self.start)
+            eta = f", ~{(self.total - self.images) / rate:.0f}s left" if self.total and rate else ""
+            logger.info(f"{self.images} images, {rate:.1f} images/s{eta}")
+
+    def summary(self, **extra):
+        seconds = time.perf_counter() - self.start
+        return {
+            "images": self.images,
+            "seconds": round(seconds, 2),
+            "images_per_sec": round(self.images / seconds, 2) if seconds else 0.0,
+            # Decoding and embedding overlap, together they are the rest
+            "search_seconds": round(self.search_seconds, 2),
+            "write_seconds": round(self.write_seconds, 2),
+            **extra,
+        }
+
+def run_bulk_query(paths, engine, encoder, results, mode="category", k=10, n_candidates=30,
+                   search_params=None, exclude_self=False, batch_size=32, num_workers=None,
+                   queue_size=256, resume=False, report_every=10.0, total=None):
+    """Stream paths through decode, embed, search and write; returns the summary"""
+    done = results.done() if resume else set()
+    if done:
+        logger.info(f"Resuming, {len(done)} images already have results")
+    submitted = 0
+
+    def tasks():
+        nonlocal submitted
+        for path in paths:
+            if path not in done:
+                submitted += 1
+                yield path, None
+
+    progress = Progress(report_every, total - len(done) if total else None)
+    try:
+        for batch_meta, embeddings in embed_images(tasks(), encoder, batch_size, num_workers, queue_size):
+            batch_paths = [path for path, _ in batch_meta]
+            start = time.perf_counter()
+            rows = score_batch(engine, batch_paths, embeddings, mode, k, n_candidates,
+                               search_params, exclude_self)
+            progress.search_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            results.write(rows)
+            progress.write_seconds += time.perf_counter() - start
+            progress.update(len(rows))
+    finally:
+        results.close()
+    # Images that failed to decode have no row and are retried on resume
+    return progress.summary(skipped=len(done), failed=submitted - progress.images)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Score a folder or manifest of images against the index"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="folder of query images, searched recursively")
+    source.add_argument("--manifest", help="text file with one image path per line")
+    parser.add_argument("--root", default=None, help="base for relative manifest paths")
+    parser.add_argument("--output", required=True, help="CSV file, or directory for --format parquet")
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    parser.add_argument("--resume", action="store_true", help="skip images already in --output")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--mode", default="category", choices=["raw", "category", "classify"])
+    parser.add_argument("--k", type=int, default=10, help="recommendations per image")
+    parser.add_argument("--candidates", type=int, default=30, help="neighbours re-ranked in category mode")
+    parser.add_argument("--search-k", type=int, default=None, help="annoy search_k")
+    parser.add_argument("--nprobe", type=int, default=None, help="ivf lists probed")
+    parser.add_argument("--rerank", type=int, default=None, help="compressed backend re-rank depth")
+    parser.add_argument("--exclude-self", action="store_true",
+                        help="drop catalog images with the query's own file name")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None, help="decode processes")
+    parser.add_argument("--queue-size", type=int, default=256)
+    parser.add_argument("--rows-per-part", type=int, default=10000, help="rows per Parquet part file")
+    parser.add_argument("--encoder-mode", default="eager", choices=ENCODER_MODES)
+    parser.add_argument("--threads", type=int, default=None, help="PyTorch intra-op threads")
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    if os.path.exists(args.output) and not args.resume:
+        raise SystemExit(f"{args.output} exists, pass --resume to continue it or remove it")
+
+    if args.input:
+        paths = list(iter_folder(args.input))
+    else:
+        paths = list(iter_manifest(args.manifest, args.root))
+    search_params = {name: value for name, value in
+                     (("search_k", args.search_k), ("nprobe", args.nprobe), ("rerank", args.rerank))
+                     if value is not None}
+
+    engine = load_engine(args.data_dir)
+    encoder = ImageEncoder(mode=args.encoder_mode, num_threads=args.threads)
+    summary = run_bulk_query(
+        paths, engine, encoder, open_results(args.output, args.format, args.rows_per_part),
+        mode=args.mode, k=args.k, n_candidates=max(args.candidates, args.k),
+        search_params=search_params, exclude_self=args.exclude_self,
+        batch_size=args.batch_size, num_workers=args.workers, queue_size=args.queue_size,
+        resume=args.resume, report_every=args.report_every, total=len(paths),
+    )
+    print(json.dumps(summary, indent=2))
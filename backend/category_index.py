@@ -0,0 +1,201 @@
+from compression import kmeans
+import numpy as np
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CENTROIDS_FILE = "category_centroids.npy"
+POSTINGS_FILE = "category_postings.npy"
+POSTING_OFFSETS_FILE = "category_posting_offsets.npy"
+PROTOTYPES_FILE = "category_prototypes.npy"
+PROTOTYPE_CATEGORIES_FILE = "category_prototype_ids.npy"
+
+def compute_centroids(embeddings, category_ids, n_categories, chunk_size=65536):
+    """Unit-length mean embedding of every category"""
+    sums = np.zeros((n_categories, embeddings.shape[1]), dtype=np.float64)
+    for start in range(0, len(embeddings), chunk_size):
+        block = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        np.add.at(sums, np.asarray(category_ids[start:start + chunk_size]), block)
+    norms = np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return (sums / norms).astype(np.float32)
+
+class CategoryPostings:
+    """Per-category posting lists: the row ids of each category, ordered
+    from most to least similar to the category centroid."""
+
+    def __init__(self, centroids, postings, offsets):
+        self.centroids = centroids
+        self.postings = postings
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, embeddings, category_ids, n_categories, chunk_size=65536):
+        category_ids = np.asarray(category_ids)
+        centroids = compute_centroids(embeddings, category_ids, n_categories, chunk_size)
+        scores = np.empty(len(category_ids), dtype=np.float32)
+        for start in range(0, len(embeddings), chunk_size):
+            block = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            block_ids = category_ids[start:start + chunk_size]
+            scores[start:start + len(block)] = np.einsum("ij,ij->i", block, centroids[block_ids])
+        # Group by category, most central items first
+        postings = np.lexsort((-scores, category_ids)).astype(np.int64)
+        offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(category_ids, minlength=n_categories))]
+        ).astype(np.int64)
+        return cls(centroids, postings, offsets)
+
+    @staticmethod
+    def exists(data_dir):
+        return all(
+            os.path.exists(os.path.join(data_dir, name))
+            for name in (CENTROIDS_FILE, POSTINGS_FILE, POSTING_OFFSETS_FILE)
+        )
+
+    def save(self, data_dir):
+        np.save(os.path.join(data_dir, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(data_dir, POSTINGS_FILE), self.postings)
+        np.save(os.path.join(data_dir, POSTING_OFFSETS_FILE), self.offsets)
+
+    @classmethod
+    def load(cls, data_dir):
+        return cls(
+            np.load(os.path.join(data_dir, CENTROIDS_FILE)),
+            np.load(os.path.join(data_dir, POSTINGS_FILE), mmap_mode="r"),
+            np.load(os.path.join(data_dir, POSTING_OFFSETS_FILE)),
+        )
+
+    def size(self, category_id):
+        """Rows of a category in the posting lists"""
+        if category_id >= len(self.offsets) - 1:
+            return 0
+        return int(self.offsets[category_id + 1] - self.offsets[category_id])
+
+    def items(self, category_id, limit=None):
+        """Row ids of a category, most central first"""
+        if category_id >= len(self.offsets) - 1:
+            # Category added after the postings were built
+            return np.zeros(0, dtype=np.int64)
+        start, end = self.offsets[category_id], self.offsets[category_id + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return np.asarray(self.postings[start:end])
+
+    def fill(self, category_id, selected, limit, exclude=None):
+        """Extend selected ids with the category's most central items up to limit.
+
+        Only the first limit + len(selected) (+ len(exclude)) postings are
+        read, so the cost depends on limit, not on the category size.
+        """
+        selected = np.asarray(selected, dtype=np.int64)
+        missing = limit - len(selected)
+        if missing <= 0:
+            return selected[:limit]
+        skip = selected if exclude is None else np.concatenate([selected, exclude])
+        extra = self.items(category_id, limit + len(skip))
+        extra = extra[~np.isin(extra, skip)][:missing]
+        return np.concatenate([selected, extra])
+
+    def search(self, embeddings, category_id, vector, k, extra_ids=None, exclude=None,
+               chunk_size=65536):
+        """Exact top k within one category, the posting list acting as its
+        sub-index; extra_ids are rows of the category not in the postings yet.
+        Returns (ids, cosine scores), best first."""
+        ids = self.items(category_id)
+        if extra_ids is not None and len(extra_ids):
+            ids = np.concatenate([ids, np.asarray(extra_ids, dtype=np.int64)])
+        if exclude is not None and len(exclude):
+            ids = ids[~np.isin(ids, exclude)]
+        # Sorted ids read the memory-mapped rows front to back
+        ids = np.sort(ids)
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), chunk_size):
+            block = np.asarray(embeddings[ids[start:start + chunk_size]], dtype=np.float32)
+            scores[start:start + len(block)] = block @ vector
+        k = min(k, len(ids))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return ids[top], scores[top]
+
+class CategoryPrototypes:
+    """A few unit vectors per category for classifying without a neighbour search.
+
+    A category scores as its best-matching prototype, so all categories are
+    ranked with one small matrix product. One prototype per category is its
+    centroid; more come from spherical k-means inside the category and
+    cover categories that are visually mixed.
+    """
+
+    def __init__(self, prototypes, prototype_categories, n_categories):
+        # Prototypes of a category are contiguous, reduceat scores each run
+        order = np.argsort(prototype_categories, kind="stable")
+        self.prototypes = np.asarray(prototypes, dtype=np.float32)[order]
+        self.prototype_categories = np.asarray(prototype_categories, dtype=np.int64)[order]
+        self.n_categories = n_categories
+        self.present, self.starts = np.unique(self.prototype_categories, return_index=True)
+
+    @classmethod
+    def from_centroids(cls, centroids):
+        return cls(centroids, np.arange(len(centroids), dtype=np.int64), len(centroids))
+
+    @classmethod
+    def build(cls, embeddings, category_ids, n_categories, per_category=1,
+              sample_size=20000, seed=0):
+        category_ids = np.asarray(category_ids)
+        if per_category <= 1:
+            return cls.from_centroids(compute_centroids(embeddings, category_ids, n_categories))
+        
+        rng = np.random.default_rng(seed)
+        prototypes, prototype_categories = [], []
+        for category_id in range(n_categories):
+            rows = np.flatnonzero(category_ids == category_id)
+            if not len(rows):
+                continue
+            if len(rows) > sample_size:
+                rows = np.sort(rng.choice(rows, sample_size, replace=False))
+            vectors = np.asarray(embeddings[rows], dtype=np.float32)
+            centers = kmeans(vectors, per_category, seed=seed, spherical=True)
+            prototypes.append(centers)
+            prototype_categories.append(np.full(len(centers), category_id, dtype=np.int64))
+        return cls(np.concatenate(prototypes).astype(np.float32),
+                   np.concatenate(prototype_categories), n_categories)
+
+    @property
+    def per_category(self):
+        return int(np.bincount(self.prototype_categories).max()) if len(self.prototype_categories) else 1
+
+    @staticmethod
+    def exists(data_dir):
+        return all(os.path.exists(os.path.join(data_dir, name))
+                   for name in (PROTOTYPES_FILE, PROTOTYPE_CATEGORIES_FILE))
+
+    def save(self, data_dir):
+        np.save(os.path.join(data_dir, PROTOTYPES_FILE), self.prototypes)
+        np.save(os.path.join(data_dir, PROTOTYPE_CATEGORIES_FILE), self.prototype_categories)
+
+    @classmethod
+    def load(cls, data_dir, n_categories):
+        return cls(
+            np.load(os.path.join(data_dir, PROTOTYPES_FILE)),
+            np.load(os.path.join(data_dir, PROTOTYPE_CATEGORIES_FILE)),
+            n_categories,
+        )
+
+    def scores(self, vectors):
+        """(n_vectors, n_categories) best prototype similarity per category,
+        -inf for categories without prototypes"""
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        scores = np.full((len(vectors), self.n_categories), -np.inf, dtype=np.float32)
+        if len(self.prototypes):
+            similarities = vectors @ self.prototypes.T
+            scores[:, self.present] = np.maximum.reduceat(similarities, self.starts, axis=1)
+        return scores
+
+    def classify(self, vector, top=5):
+        """[(category id, score)] for the best categories, best first"""
+        scores = self.scores(vector)[0]
+        order = np.argsort(-scores, kind="stable")[:top]
+        return [(int(i), float(scores[i])) for i in order if np.isfinite(scores[i])]
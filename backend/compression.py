@@ -0,0 +1,142 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def kmeans(vectors, n_clusters, n_iter=20, seed=0, spherical=False):
+    """Plain Euclidean k-means, returns the centroids.
+
+    With spherical=True the centroids are projected back onto the unit
+    sphere every iteration, so unit vectors are clustered by cosine.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Restart empty clusters from random points
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+def assign(vectors, centroids):
+    """Index of the nearest centroid for every vector"""
+    distances = (
+        np.sum(centroids ** 2, axis=1)[None, :]
+        - 2 * vectors @ centroids.T
+    )
+    return np.argmin(distances, axis=1)
+
+class PCAReducer:
+    """PCA to a smaller dimension, optionally whitened.
+
+    Outputs are re-normalized to unit length, so inner products in the
+    reduced space still approximate cosine similarity.
+    """
+
+    def __init__(self, mean, components, scale=None):
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+
+    @property
+    def dim(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, dim, whiten=False, sample_size=50000, seed=0):
+        rng = np.random.default_rng(seed)
+        ids = np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))
+        sample = np.asarray(vectors[ids], dtype=np.float32)
+        mean = sample.mean(axis=0)
+        _, singular_values, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        scale = None
+        if whiten:
+            variance = singular_values[:dim] ** 2 / max(len(sample) - 1, 1)
+            scale = (1.0 / np.sqrt(variance + 1e-8)).astype(np.float32)
+        explained = float(np.sum(singular_values[:dim] ** 2) / np.sum(singular_values ** 2))
+        logger.info(f"PCA to {dim} dims keeps {explained:.1%} of the variance")
+        return cls(mean.astype(np.float32), vt[:dim].astype(np.float32), scale)
+
+    def transform(self, vectors):
+        projected = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+        if self.scale is not None:
+            projected = projected * self.scale
+        return projected / np.maximum(np.linalg.norm(projected, axis=-1, keepdims=True), 1e-12)
+
+    def to_arrays(self):
+        arrays = {"mean": self.mean, "components": self.components}
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["mean"], arrays["components"], arrays.get("scale"))
+
+class ProductQuantizer:
+    """Splits vectors into n_subvectors parts and stores each part as the
+    id of its nearest of 256 sub-centroids, one byte per part."""
+
+    def __init__(self, codebooks):
+        # (n_subvectors, 256, sub_dim)
+        self.codebooks = codebooks
+
+    @property
+    def n_subvectors(self):
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, n_subvectors, sample_size=50000, n_iter=20, seed=0):
+        dim = vectors.shape[1]
+        if dim % n_subvectors:
+            raise ValueError(f"dimension {dim} is not divisible by {n_subvectors} subvectors")
+        rng = np.random.default_rng(seed)
+        ids = np.sort(rng.choice(len(vectors), min(len(vectors), sample_size), replace=False))
+        sample = np.asarray(vectors[ids], dtype=np.float32)
+        sub_dim = dim // n_subvectors
+        n_centroids = min(256, len(sample))
+        codebooks = np.zeros((n_subvectors, 256, sub_dim), dtype=np.float32)
+        for m in range(n_subvectors):
+            part = sample[:, m * sub_dim:(m + 1) * sub_dim]
+            codebooks[m, :n_centroids] = kmeans(part, n_centroids, n_iter=n_iter, seed=seed + m)
+            # Unused slots can never be the nearest centroid
+            codebooks[m, n_centroids:] = np.inf
+        return cls(codebooks)
+
+    def encode(self, vectors, chunk_size=65536):
+        sub_dim = self.codebooks.shape[2]
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), chunk_size):
+            block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            for m in range(self.n_subvectors):
+                codebook = self.codebooks[m]
+                finite = np.isfinite(codebook[:, 0])
+                part = block[:, m * sub_dim:(m + 1) * sub_dim]
+                codes[start:start + len(block), m] = assign(part, codebook[finite])
+        return codes
+
+    def lookup_table(self, query):
+        """Inner product of every sub-centroid with the matching query part"""
+        sub_dim = self.codebooks.shape[2]
+        parts = np.asarray(query, dtype=np.float32).reshape(self.n_subvectors, sub_dim)
+        table = np.einsum("mkd,md->mk", np.nan_to_num(self.codebooks, posinf=0.0), parts)
+        return table.astype(np.float32)
+
+    def scores(self, codes, query, chunk_size=262144):
+        """Asymmetric distance computation: approximate query · vector for every code"""
+        table = self.lookup_table(query)
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), chunk_size):
+            block = np.asarray(codes[start:start + chunk_size])
+            out = scores[start:start + len(block)]
+            for m in range(self.n_subvectors):
+                out += table[m].take(block[:, m])
+        return scores
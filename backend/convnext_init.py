@@ -3,56 +3,232 @@ import torch.nn as nn
 from torchvision import models, transforms
 from pathlib import Path
 import numpy as np
-from annoy import AnnoyIndex
 import pickle
 import os
 from PIL import Image
 import logging
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, deque
+from embedding_cache import EmbeddingCache
+from embedding_store import EmbeddingStore
+from search_backends import build_backend
+from sharding import build_shards
+from thumbnails import build_thumbnails
+from category_index import CategoryPostings, CategoryPrototypes
+import multiprocessing as mp
+import itertools
+import argparse
+import time
+import io
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# Bump whenever the model weights or preprocessing change, so cached
+# embeddings from the old setup are not reused
+ENCODER_VERSION = "convnext_large-imagenet1k:draft236-resize236-bicubic-crop224:v2"
+
+# Short side the transform resizes to
+RESIZE_SIZE = 236
+
+def load_image(source, draft=True):
+    """Open a file path, raw bytes or PIL image as RGB.
+
+    With draft, JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale when the
+    result still covers RESIZE_SIZE on both sides, which skips most of the
+    decode work for large photos.
+    """
+    if isinstance(source, Image.Image):
+        return source.convert('RGB')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    image = Image.open(source)
+    if draft:
+        image.draft('RGB', (RESIZE_SIZE, RESIZE_SIZE))
+    return image.convert('RGB')
+
+def build_transform():
+    """Preprocessing used for both indexing and queries"""
+    return transforms.Compose([
+        transforms.Resize(RESIZE_SIZE, interpolation=transforms.InterpolationMode.BICUBIC),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], 
+                         std=[0.229, 0.224, 0.225])
+    ])
+
+ENCODER_MODES = ["eager", "torchscript", "quantized"]
+
 class ImageEncoder:
-    def __init__(self):
+    """ConvNeXt-large feature extractor.
+
+    mode="eager" runs the fp32 model as is. "torchscript" traces and freezes
+    the graph; "quantized" additionally converts the Linear layers of every
+    ConvNeXt block to dynamic int8 (CPU only). channels_last switches the
+    convolutions to NHWC and num_threads caps PyTorch intra-op threads.
+    """
+
+    def __init__(self, mode="eager", num_threads=None, channels_last=False):
+        if mode not in ENCODER_MODES:
+            raise ValueError(f"Unknown encoder mode {mode!r}, expected one of {ENCODER_MODES}")
+        if num_threads:
+            torch.set_num_threads(num_threads)
+            
         logger.info("Loading ConvNeXT model...")
         self.model = models.convnext_large(pretrained=True)
         self.model = nn.Sequential(*list(self.model.children())[:-1])
         self.model.eval()
         
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = self.model.to(self.device)
+        self.mode = mode
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        
+        if mode == "quantized":
+            # Dynamic quantization kernels only exist for CPU
+            self.device = torch.device("cpu")
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {nn.Linear}, dtype=torch.qint8
+            )
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
         
-        self.transform = transforms.Compose([
-            transforms.Resize(236, interpolation=transforms.InterpolationMode.BICUBIC),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], 
-                             std=[0.229, 0.224, 0.225])
-        ])
-        logger.info(f"Model loaded successfully on {self.device}!")
+        if mode in ("torchscript", "quantized"):
+            example = torch.zeros(1, 3, 224, 224, device=self.device)
+            with torch.no_grad():
+                traced = torch.jit.trace(self.model, example.contiguous(memory_format=self.memory_format))
+            self.model = torch.jit.freeze(traced)
+        
+        self.transform = build_transform()
+        logger.info(f"Model loaded successfully on {self.device} "
+                    f"(mode={mode}, threads={torch.get_num_threads()}, channels_last={channels_last})!")
+
+    @property
+    def version(self):
+        """Embedding cache key; int8 weights shift the embeddings slightly"""
+        return ENCODER_VERSION if self.mode != "quantized" else f"{ENCODER_VERSION}:int8"
+
+    def _forward(self, batch):
+        batch = batch.to(self.device).contiguous(memory_format=self.memory_format)
+        with torch.no_grad():
+            embeddings = self.model(batch)
+        return embeddings.flatten(1).cpu().numpy()
 
     def get_embedding(self, image_path):
+        """Embed one image given as a path, bytes or PIL image"""
         try:
-            image = Image.open(image_path).convert('RGB')
+            image = load_image(image_path)
             image = self.transform(image).unsqueeze(0)
-            image = image.to(self.device)
             
-            with torch.no_grad():
-                embedding = self.model(image)
-                
-            embedding = embedding.squeeze().cpu().numpy()
+            embedding = self._forward(image)[0]
             embedding = embedding / np.linalg.norm(embedding)
             return embedding
         except Exception as e:
-            logger.error(f"Error processing {image_path}: {str(e)}")
+            source = image_path if isinstance(image_path, (str, Path)) else "in-memory image"
+            logger.error(f"Error processing {source}: {str(e)}")
             return None
 
-def process_dataset(dataset_path, encoder, save_dir="./data"):
-    """Process dataset and create index"""
-    dataset_path = Path(dataset_path)
+    def get_image_embeddings(self, images):
+        """Embed a list of paths, bytes or PIL images in one forward pass"""
+        batch = torch.stack([self.transform(load_image(image)) for image in images])
+        return self.get_embeddings(batch)
+
+    def get_embeddings(self, batch):
+        """Run one forward pass over a batch of transformed images"""
+        embeddings = self._forward(torch.as_tensor(batch))
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+_worker_transform = None
+
+def _init_decode_worker():
+    """Set up a decode worker process"""
+    global _worker_transform
+    _worker_transform = build_transform()
+    # Decoding is the only work here, keep torch from spawning extra threads
+    torch.set_num_threads(1)
+
+def _decode_image(task):
+    """Decode and transform a single image, returns None on failure"""
+    image_path, class_name = task
+    try:
+        transform = _worker_transform or build_transform()
+        image = load_image(image_path)
+        return image_path, class_name, transform(image).numpy()
+    except Exception as e:
+        logger.error(f"Error processing {image_path}: {str(e)}")
+        return image_path, class_name, None
+
+def iter_dataset_files(dataset_path):
+    """Yield (image_path, class_name) for every image in the dataset"""
+    for class_dir in tqdm(list(Path(dataset_path).iterdir())):
+        if class_dir.is_dir():
+            class_name = class_dir.name
+            for image_file in class_dir.glob("*.*"):
+                if image_file.suffix.lower() in IMAGE_EXTENSIONS:
+                    yield str(image_file), class_name
+
+def _decode_chunk(tasks):
+    return [_decode_image(task) for task in tasks]
+
+def iter_decoded_images(tasks, num_workers=None, queue_size=256, chunksize=4):
+    """Decode images in worker processes, keeping at most queue_size in flight.
+
+    Chunks are submitted from the consuming thread as results are taken,
+    so when the consumer stops or raises nothing is left waiting on it and
+    the pool is torn down right away.
+    """
+    if num_workers == 0:
+        for task in tasks:
+            yield _decode_image(task)
+        return
     
+    num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+    chunksize = max(1, min(chunksize, queue_size))
+    max_pending = max(1, queue_size // chunksize)
+    tasks = iter(tasks)
+    pending = deque()
+    with mp.Pool(num_workers, initializer=_init_decode_worker) as pool:
+        while True:
+            while len(pending) < max_pending:
+                chunk = list(itertools.islice(tasks, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.apply_async(_decode_chunk, (chunk,)))
+            if not pending:
+                break
+            yield from pending.popleft().get()
+
+def embed_images(tasks, encoder, batch_size=32, num_workers=None, queue_size=256):
+    """Stream (image_path, class_name) tasks into batches of embeddings"""
+    batch, batch_meta = [], []
+    for image_path, class_name, tensor in iter_decoded_images(
+        tasks, num_workers=num_workers, queue_size=queue_size
+    ):
+        if tensor is None:
+            continue
+        batch.append(tensor)
+        batch_meta.append((image_path, class_name))
+        if len(batch) >= batch_size:
+            yield batch_meta, encoder.get_embeddings(np.stack(batch))
+            batch, batch_meta = [], []
+            
+    if batch:
+        yield batch_meta, encoder.get_embeddings(np.stack(batch))
+
+def process_dataset(dataset_path, encoder, save_dir="./data", batch_size=32,
+                    num_workers=None, queue_size=256, cache_path=None,
+                    store_dtype=np.float32, index_backend="annoy", index_params=None,
+                    thumbnails=False, hybrid=False, text_pca_dim=None,
+                    shards=0, shard_by="hash", prototypes=1):
+    """Process dataset and create index.
+
+    With cache_path set, only new or changed files are embedded and
+    embeddings are checkpointed to the cache after every batch. With
+    shards > 1 the index is split into that many shard directories
+    searched by the "sharded" backend, and the returned index is None.
+    prototypes sets how many vectors per category the classify-only mode
+    scores queries against.
+    """
     embeddings_dict = {}
     file_mapping = {}
     class_mapping = {}
@@ -61,28 +237,83 @@ def process_dataset(dataset_path, encoder, save_dir="./data"):
     
     os.makedirs(save_dir, exist_ok=True)
     
-    idx = 0
     logger.info("Processing dataset...")
+    start_time = time.perf_counter()
     
-    for class_dir in tqdm(list(dataset_path.iterdir())):
-        if class_dir.is_dir():
-            class_name = class_dir.name
-            for image_file in class_dir.glob("*.*"):
-                if image_file.suffix.lower() in ['.jpg', '.jpeg', '.png']:
-                    embedding = encoder.get_embedding(str(image_file))
-                    if embedding is not None:
-                        embeddings_dict[idx] = embedding
-                        file_mapping[idx] = image_file.stem
-                        class_mapping[idx] = class_name
-                        reverse_class_mapping[image_file.stem] = class_name
-                        class_stats[class_name] += 1
-                        idx += 1
+    files = list(iter_dataset_files(dataset_path))
+    embeddings_by_path = {}
+    cache = EmbeddingCache(cache_path, encoder.version) if cache_path else None
+    
+    try:
+        pending = files
+        hashes = {}
+        if cache is not None:
+            pending = []
+            for image_path, class_name in files:
+                try:
+                    hashes[image_path] = cache.content_hash(image_path)
+                except OSError as e:
+                    logger.error(f"Error reading {image_path}: {str(e)}")
+                    continue
+                embedding = cache.get(hashes[image_path])
+                if embedding is None:
+                    pending.append((image_path, class_name))
+                else:
+                    embeddings_by_path[image_path] = embedding
+            logger.info(f"Embedding cache: {len(embeddings_by_path)} reused, "
+                        f"{len(pending)} to embed")
+        
+        embedded = 0
+        for batch_meta, embeddings in embed_images(
+            pending, encoder, batch_size=batch_size,
+            num_workers=num_workers, queue_size=queue_size
+        ):
+            for (image_path, _), embedding in zip(batch_meta, embeddings):
+                embeddings_by_path[image_path] = embedding
+            if cache is not None:
+                cache.put_many(
+                    (hashes[image_path], embedding)
+                    for (image_path, _), embedding in zip(batch_meta, embeddings)
+                )
+            embedded += len(batch_meta)
+        
+        if cache is not None:
+            cache.prune(
+                [image_path for image_path, _ in files],
+                [hashes[image_path] for image_path in embeddings_by_path]
+            )
+    finally:
+        if cache is not None:
+            cache.close()
+    
+    elapsed = time.perf_counter() - start_time
+    
+    idx = 0
+    index_paths = []
+    for image_path, class_name in files:
+        embedding = embeddings_by_path.get(image_path)
+        if embedding is None:
+            continue
+        index_paths.append(image_path)
+        stem = Path(image_path).stem
+        embeddings_dict[idx] = embedding
+        file_mapping[idx] = stem
+        class_mapping[idx] = class_name
+        reverse_class_mapping[stem] = class_name
+        class_stats[class_name] += 1
+        idx += 1
     
     logger.info(f"\nTotal images processed: {idx}")
+    logger.info(f"Embedding throughput: {embedded / max(elapsed, 1e-9):.1f} images/sec "
+                f"({embedded} embedded in {elapsed:.1f}s, batch_size={batch_size}, "
+                f"workers={num_workers})")
     logger.info("\nClass distribution:")
     for class_name, count in class_stats.items():
         logger.info(f"{class_name}: {count} images")
     
+    if not embeddings_dict:
+        raise ValueError(f"No images could be embedded from {dataset_path}, nothing to index")
+    
     # Save processed data
     processed_data_path = f"{save_dir}/processed_data.pkl"
     with open(processed_data_path, "wb") as f:
@@ -94,23 +325,106 @@ def process_dataset(dataset_path, encoder, save_dir="./data"):
             'class_stats': dict(class_stats)
         }, f)
     
-    # Build and save index
-    logger.info("Building Annoy index...")
-    first_embedding = next(iter(embeddings_dict.values()))
-    embedding_dim = len(first_embedding)
-    index = AnnoyIndex(embedding_dim, 'angular')
+    # Columnar copy that the API memory-maps at startup
+    store = EmbeddingStore.from_arrays(
+        np.stack(list(embeddings_dict.values())),
+        list(file_mapping.values()),
+        list(class_mapping.values())
+    )
+    store.save(save_dir, dtype=store_dtype)
+    CategoryPostings.build(
+        store.embeddings, store.category_ids, len(store.categories)
+    ).save(save_dir)
+    CategoryPrototypes.build(
+        store.embeddings, store.category_ids, len(store.categories), per_category=prototypes
+    ).save(save_dir)
     
-    for idx, embedding in embeddings_dict.items():
-        index.add_item(idx, embedding)
+    if thumbnails:
+        logger.info("Building thumbnails...")
+        build_thumbnails(index_paths, save_dir, num_workers=num_workers)
     
-    logger.info("Building index with 100 trees...")
-    index.build(100)
-    index.save(f"{save_dir}/image_index.ann")
+    if hybrid:
+        # Imported here, text_embeddings depends on this module
+        from text_embeddings import build_text_embeddings
+        logger.info("Captioning images for hybrid search...")
+        build_text_embeddings(index_paths, save_dir, pca_dim=text_pca_dim)
+    
+    # Build and save index
+    if shards > 1:
+        logger.info(f"Building {shards} {index_backend} shards by {shard_by}...")
+        manifest = build_shards(
+            store.embeddings, store.file_names, store.category_ids, save_dir, shards,
+            by=shard_by, backend=index_backend, **(index_params or {})
+        )
+        logger.info(f"Shard sizes: {manifest['sizes']}")
+        # Shards are served by the sharded backend, which starts its own workers
+        index = None
+    else:
+        logger.info(f"Building {index_backend} index...")
+        index = build_backend(
+            index_backend, np.stack(list(embeddings_dict.values())), save_dir,
+            **(index_params or {})
+        )
     
     logger.info("Index saved successfully")
     
     return embeddings_dict, file_mapping, class_mapping, reverse_class_mapping, index
 
 if __name__ == "__main__":
-    encoder = ImageEncoder()
-    process_dataset("dataset", encoder)
+    logging.basicConfig(level=logging.DEBUG)
+    parser = argparse.ArgumentParser(description="Build the image search index")
+    parser.add_argument("--dataset", default="dataset")
+    parser.add_argument("--save-dir", default="./data")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="decode worker processes, 0 decodes in the main process")
+    parser.add_argument("--queue-size", type=int, default=256,
+                        help="max decoded images waiting for the model")
+    parser.add_argument("--cache", default=None,
+                        help="embedding cache file for incremental rebuilds, e.g. ./data/embedding_cache.db")
+    parser.add_argument("--float16", action="store_true",
+                        help="store the mmap embeddings matrix as float16")
+    parser.add_argument("--backend", default="annoy", choices=["annoy", "ivf", "exact", "compressed"],
+                        help="search backend to build")
+    parser.add_argument("--trees", type=int, default=100, help="Annoy tree count")
+    parser.add_argument("--n-lists", type=int, default=None, help="IVF list count")
+    parser.add_argument("--codec", default="pq", choices=["pq", "float16"],
+                        help="compressed backend vector codec")
+    parser.add_argument("--pca-dim", type=int, default=None,
+                        help="compressed backend PCA dimension")
+    parser.add_argument("--whiten", action="store_true", help="whiten the PCA output")
+    parser.add_argument("--subvectors", type=int, default=16,
+                        help="bytes per vector for product quantization")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="split the index into this many shards")
+    parser.add_argument("--shard-by", default="hash", choices=["hash", "category"],
+                        help="shard by file name hash or keep categories together")
+    parser.add_argument("--prototypes", type=int, default=1,
+                        help="k-means prototypes per category for classify-only search, 1 uses centroids")
+    parser.add_argument("--thumbnails", action="store_true",
+                        help="precompute preview thumbnails into the data dir")
+    parser.add_argument("--hybrid", action="store_true",
+                        help="also store BLIP caption embeddings for hybrid search")
+    parser.add_argument("--text-pca-dim", type=int, default=None,
+                        help="reduce caption embeddings to this many dimensions")
+    parser.add_argument("--encoder-mode", default="eager", choices=ENCODER_MODES)
+    parser.add_argument("--threads", type=int, default=None, help="PyTorch intra-op threads")
+    parser.add_argument("--channels-last", action="store_true")
+    args = parser.parse_args()
+    
+    # --batch-size 1 --workers 0 reproduces the old one-image-at-a-time loop
+    encoder = ImageEncoder(mode=args.encoder_mode, num_threads=args.threads,
+                           channels_last=args.channels_last)
+    process_dataset(args.dataset, encoder, save_dir=args.save_dir,
+                    batch_size=args.batch_size, num_workers=args.workers,
+                    queue_size=args.queue_size, cache_path=args.cache,
+                    store_dtype=np.float16 if args.float16 else np.float32,
+                    index_backend=args.backend,
+                    index_params={"annoy": {"n_trees": args.trees},
+                                  "ivf": {"n_lists": args.n_lists},
+                                  "compressed": {"codec": args.codec, "dim": args.pca_dim,
+                                                 "whiten": args.whiten,
+                                                 "n_subvectors": args.subvectors}}.get(args.backend),
+                    thumbnails=args.thumbnails, hybrid=args.hybrid,
+                    text_pca_dim=args.text_pca_dim,
+                    shards=args.shards, shard_by=args.shard_by, prototypes=args.prototypes)
@@ -0,0 +1,220 @@
+from concurrent.futures import ThreadPoolExecutor
+from search_backends import load_backend, load_build_params
+from embedding_store import EmbeddingStore
+from thumbnails import ThumbnailStore
+from text_embeddings import HybridIndex
+import numpy as np
+import argparse
+import logging
+import shutil
+import json
+import math
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES_REPORT = "duplicates.json"
+# Representative row id for every row, the row itself when it has no duplicates,
+# saved with the fingerprint of the store rows it refers to
+DUPLICATE_CLUSTERS_FILE = "duplicate_clusters.npz"
+
+def find_duplicate_pairs(embeddings, index, radius=0.15, k=20, chunk_size=1024, workers=None):
+    """Self-join of the catalog: every pair of rows within `radius` angular
+    distance of each other, found by querying the index with the catalog
+    itself in chunks searched on a thread pool.
+
+    Returns (pairs, saturated): pairs as an (n, 2) array with i < j, and
+    the number of rows whose k-th neighbour was still inside the radius,
+    meaning k was too small to see all of their duplicates directly.
+    """
+    def join(start):
+        vectors = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        pairs, saturated = [], 0
+        for row, (ids, row_distances) in enumerate(index.search_batch(vectors, k + 1), start):
+            ids = np.asarray(ids, dtype=np.int64)
+            row_distances = np.asarray(row_distances, dtype=np.float32)
+            close = (row_distances <= radius) & (ids != row)
+            saturated += len(ids) == k + 1 and bool(row_distances[-1] <= radius)
+            pairs.append(np.stack([np.minimum(ids[close], row), np.maximum(ids[close], row)], axis=1))
+        return np.concatenate(pairs), saturated
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(join, range(0, len(embeddings), chunk_size)))
+
+    pairs = np.concatenate([pairs for pairs, _ in results]).reshape(-1, 2)
+    # Each pair is usually found from both ends
+    return np.unique(pairs, axis=0), sum(saturated for _, saturated in results)
+
+def cluster_pairs(n, pairs):
+    """Greedy star clustering: the row with the most duplicates keeps its
+    image and takes its unassigned duplicates, and so on. Unlike connected
+    components this does not chain similar-looking but distinct images
+    together, every member is within the radius of the row that is kept.
+
+    Returns the representative row id of every row.
+    """
+    representative = np.full(n, -1, dtype=np.int64)
+    if not len(pairs):
+        return np.arange(n, dtype=np.int64)
+    # Adjacency lists in CSR form, both directions of every pair
+    edges = np.concatenate([pairs, pairs[:, ::-1]])
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(edges[:, 0], minlength=n))])
+    for row in np.argsort(-np.diff(offsets), kind="stable"):
+        if representative[row] >= 0:
+            continue
+        representative[row] = row
+        neighbours = edges[offsets[row]:offsets[row + 1], 1]
+        neighbours = neighbours[representative[neighbours] < 0]
+        representative[neighbours] = row
+    return representative
+
+def build_report(store, representative, pairs, radius, k, saturated):
+    file_names = store.file_names
+    class_names = store.category_names()
+    duplicated = np.flatnonzero(representative != np.arange(len(representative)))
+    clusters = []
+    for keep in np.unique(representative[duplicated]):
+        members = np.flatnonzero(representative == keep)
+        vectors = np.asarray(store.embeddings[members], dtype=np.float32)
+        scores = vectors @ np.asarray(store.embeddings[keep], dtype=np.float32)
+        clusters.append({
+            "keep": str(file_names[keep]),
+            "category": str(class_names[keep]),
+            "members": [
+                {"file": str(file_names[i]), "category": str(class_names[i]),
+                 "distance": round(float(np.sqrt(max(2 - 2 * score, 0))), 4)}
+                for i, score in zip(members, scores) if i != keep
+            ],
+        })
+    clusters.sort(key=lambda cluster: -len(cluster["members"]))
+    return {
+        "radius": radius,
+        # The similarity scale /predict reports, for picking a radius
+        "min_similarity": round(1 - radius * 2 / math.pi, 4),
+        "k": k,
+        "n_items": len(store),
+        "n_pairs": len(pairs),
+        "n_clusters": len(clusters),
+        "n_duplicates": len(duplicated),
+        "cross_category_clusters": sum(
+            any(member["category"] != cluster["category"] for member in cluster["members"])
+            for cluster in clusters
+        ),
+        "saturated_rows": saturated,
+        "clusters": clusters,
+    }
+
+def detect_duplicates(data_dir, backend="annoy", radius=0.15, k=20, chunk_size=1024,
+                      workers=None, **params):
+    """Find duplicate clusters in an indexed catalog and write the report and
+    the row -> representative mapping next to the index"""
+    store = EmbeddingStore.load(data_dir)
+    index = load_backend(backend, data_dir, store.embeddings, **params)
+
+    start = time.perf_counter()
+    pairs, saturated = find_duplicate_pairs(
+        store.embeddings, index, radius, k, chunk_size, workers
+    )
+    representative = cluster_pairs(len(store), pairs)
+    logger.info(f"Self-join of {len(store)} items took {time.perf_counter() - start:.1f}s")
+    if saturated:
+        logger.warning(f"{saturated} items had {k} neighbours inside the radius, "
+                       f"raise k to see all of their duplicates")
+
+    report = build_report(store, representative, pairs, radius, k, saturated)
+    save_duplicate_clusters(data_dir, representative, store)
+    with open(os.path.join(data_dir, DUPLICATES_REPORT), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"{report['n_duplicates']} duplicates in {report['n_clusters']} clusters")
+    return representative, report
+
+def write_deduplicated(data_dir, output_dir, representative, backend="annoy", **params):
+    """Copy of the index in output_dir keeping one row per duplicate cluster,
+    rebuilt with the parameters the original was built with unless params
+    override them"""
+    # live_index reads and rewrites the duplicate clusters when compacting
+    from live_index import Delta, write_compacted
+
+    if os.path.abspath(output_dir) != os.path.abspath(data_dir):
+        shutil.copytree(data_dir, output_dir, dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns("shards", ".compact"))
+    store = EmbeddingStore.load(output_dir)
+    thumbnails = ThumbnailStore(output_dir) if ThumbnailStore.exists(output_dir) else None
+    hybrid = HybridIndex(output_dir) if HybridIndex.exists(output_dir) else None
+    dropped = np.flatnonzero(representative != np.arange(len(representative)))
+    params = {**load_build_params(output_dir, load_backend(backend, output_dir, store.embeddings)),
+              **params}
+    write_compacted(output_dir, store, Delta.empty(store.embedding_dim), dropped, backend, params,
+                    thumbnails=thumbnails, hybrid=hybrid)
+    # Every remaining row is its own representative now
+    path = os.path.join(output_dir, DUPLICATE_CLUSTERS_FILE)
+    if os.path.exists(path):
+        os.remove(path)
+    logger.info(f"Deduplicated index with {len(store) - len(dropped)} items written to {output_dir}")
+
+def save_duplicate_clusters(data_dir, representative, store):
+    np.savez(os.path.join(data_dir, DUPLICATE_CLUSTERS_FILE),
+             representative=representative, fingerprint=store.fingerprint())
+
+def load_duplicate_clusters(data_dir, store):
+    """The row -> representative mapping if it was built for these store rows"""
+    path = os.path.join(data_dir, DUPLICATE_CLUSTERS_FILE)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as saved:
+        representative, fingerprint = saved["representative"], str(saved["fingerprint"])
+    if len(representative) != len(store) or fingerprint != store.fingerprint():
+        logger.warning("Duplicate clusters do not match the index, rerun dedup.py")
+        return None
+    return representative
+
+def remap_duplicate_clusters(representative, remap, size):
+    """Clusters under the ids a compaction gave the rows, see remap_ids.
+
+    Surviving rows stay in their cluster. A cluster whose representative
+    was deleted is represented by its first surviving member instead, and
+    added rows, which were never checked for duplicates, by themselves.
+    """
+    clusters = np.arange(size, dtype=np.int64)
+    kept = np.flatnonzero(remap[:len(representative)] >= 0)
+    labels = representative[kept]
+    alive = remap[labels] >= 0
+    clusters[remap[kept[alive]]] = remap[labels[alive]]
+
+    orphans, orphan_labels = kept[~alive], labels[~alive]
+    if len(orphans):
+        # kept is sorted and remap keeps the order, so the first row seen is the lowest id
+        unique_labels, first = np.unique(orphan_labels, return_index=True)
+        new_representative = remap[orphans[first]]
+        clusters[remap[orphans]] = new_representative[np.searchsorted(unique_labels, orphan_labels)]
+    return clusters
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Find duplicate and near-duplicate catalog images")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--backend", default="annoy", choices=["annoy", "ivf", "exact", "compressed"],
+                        help="index used to find candidate pairs, and to rebuild --output-dir")
+    parser.add_argument("--radius", type=float, default=0.15,
+                        help="largest angular distance between duplicates")
+    parser.add_argument("--k", type=int, default=20, help="neighbours checked per image")
+    parser.add_argument("--search-k", type=int, default=-1, help="annoy search_k for the self-join")
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output-dir", default=None,
+                        help="also write a deduplicated copy of the index here")
+    parser.add_argument("--trees", type=int, default=None,
+                        help="Annoy tree count for --output-dir, the index's own by default")
+    args = parser.parse_args()
+
+    search_params = {"search_k": args.search_k} if args.backend == "annoy" else {}
+    representative, report = detect_duplicates(
+        args.data_dir, args.backend, args.radius, args.k, args.chunk_size, args.workers,
+        **search_params
+    )
+    print(json.dumps({key: value for key, value in report.items() if key != "clusters"}, indent=2))
+    if args.output_dir:
+        build_params = {"n_trees": args.trees} if args.backend == "annoy" and args.trees else {}
+        write_deduplicated(args.data_dir, args.output_dir, representative, args.backend, **build_params)
@@ -0,0 +1,103 @@
+import numpy as np
+import sqlite3
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def file_content_hash(path, chunk_size=1 << 20):
+    """SHA-1 of the file contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by file content hash and model version.
+
+    Every write is committed straight away, so an interrupted index build
+    resumes from the last finished batch on the next run.
+    """
+
+    def __init__(self, path, model_version):
+        self.path = path
+        self.model_version = model_version
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model_version TEXT, content_hash TEXT, embedding BLOB, "
+            "PRIMARY KEY (model_version, content_hash))"
+        )
+        # Lets unchanged files skip re-hashing on the next run
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, content_hash TEXT)"
+        )
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def content_hash(self, path):
+        """Hash a file, reusing the stored hash when size and mtime match"""
+        stat = os.stat(path)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, content_hash FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        content_hash = file_content_hash(path)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (path, stat.st_size, stat.st_mtime_ns, content_hash)
+        )
+        return content_hash
+
+    def get(self, content_hash):
+        """Return the cached embedding or None"""
+        row = self.conn.execute(
+            "SELECT embedding FROM embeddings WHERE model_version = ? AND content_hash = ?",
+            (self.model_version, content_hash)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def put_many(self, items):
+        """Store (content_hash, embedding) pairs and commit"""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+            [
+                (self.model_version, content_hash, np.asarray(embedding, dtype=np.float32).tobytes())
+                for content_hash, embedding in items
+            ]
+        )
+        self.conn.commit()
+
+    def prune(self, live_paths, live_hashes):
+        """Drop entries for deleted files and for other model versions"""
+        self.conn.execute("CREATE TEMP TABLE live_paths (path TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TEMP TABLE live_hashes (content_hash TEXT PRIMARY KEY)")
+        self.conn.executemany("INSERT OR IGNORE INTO live_paths VALUES (?)", [(p,) for p in live_paths])
+        self.conn.executemany("INSERT OR IGNORE INTO live_hashes VALUES (?)", [(h,) for h in live_hashes])
+        removed_files = self.conn.execute(
+            "DELETE FROM files WHERE path NOT IN (SELECT path FROM live_paths)"
+        ).rowcount
+        removed_embeddings = self.conn.execute(
+            "DELETE FROM embeddings WHERE model_version != ? "
+            "OR content_hash NOT IN (SELECT content_hash FROM live_hashes)",
+            (self.model_version,)
+        ).rowcount
+        self.conn.execute("DROP TABLE live_paths")
+        self.conn.execute("DROP TABLE live_hashes")
+        self.conn.commit()
+        logger.info(f"Pruned {removed_embeddings} cached embeddings and {removed_files} stale files")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,174 @@
+import numpy as np
+import argparse
+import hashlib
+import logging
+import pickle
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.npy"
+FILE_NAMES_FILE = "file_names.npy"
+CATEGORY_IDS_FILE = "category_ids.npy"
+CATEGORIES_FILE = "categories.json"
+
+class EmbeddingStore:
+    """Columnar embeddings store: one matrix row per indexed image.
+
+    Row i holds the embedding of file_names[i], whose category is
+    categories[category_ids[i]]. Loaded with mmap, the matrix pages are
+    shared between all processes through the OS page cache.
+    """
+
+    def __init__(self, embeddings, file_names, category_ids, categories):
+        self.embeddings = embeddings
+        self.file_names = file_names
+        self.category_ids = category_ids
+        self.categories = list(categories)
+
+    def __len__(self):
+        return len(self.file_names)
+
+    @property
+    def embedding_dim(self):
+        return self.embeddings.shape[1]
+
+    def fingerprint(self):
+        """SHA-1 of the file names in row order; files keyed by row id store
+        it to detect that rows were renumbered since they were written"""
+        names = np.ascontiguousarray(np.asarray(self.file_names, dtype=str))
+        digest = hashlib.sha1(names.dtype.str.encode())
+        digest.update(names.tobytes())
+        return digest.hexdigest()
+
+    def category_names(self):
+        """Category name for every row"""
+        return np.asarray(self.categories)[self.category_ids]
+
+    @classmethod
+    def from_arrays(cls, embeddings, file_names, class_names):
+        """Build a store from parallel per-item sequences"""
+        categories = sorted(set(class_names))
+        category_index = {name: i for i, name in enumerate(categories)}
+        return cls(
+            np.asarray(embeddings, dtype=np.float32),
+            np.asarray(file_names, dtype=str),
+            np.asarray([category_index[name] for name in class_names], dtype=np.int32),
+            categories
+        )
+
+    @classmethod
+    def from_processed_data(cls, data):
+        """Build a store from the processed_data.pkl dict layout"""
+        ids = sorted(data['embeddings'])
+        if ids != list(range(len(ids))):
+            raise ValueError("processed data ids must be contiguous and start at 0")
+        return cls.from_arrays(
+            np.stack([data['embeddings'][i] for i in ids]) if ids else np.zeros((0, 0)),
+            [data['file_mapping'][i] for i in ids],
+            [data['class_mapping'][i] for i in ids]
+        )
+
+    def save(self, data_dir, dtype=np.float32):
+        """Write the store as .npy columns plus a categories list"""
+        os.makedirs(data_dir, exist_ok=True)
+        np.save(os.path.join(data_dir, EMBEDDINGS_FILE), np.asarray(self.embeddings, dtype=dtype))
+        np.save(os.path.join(data_dir, FILE_NAMES_FILE), np.asarray(self.file_names, dtype=str))
+        np.save(os.path.join(data_dir, CATEGORY_IDS_FILE), np.asarray(self.category_ids, dtype=np.int32))
+        with open(os.path.join(data_dir, CATEGORIES_FILE), "w") as f:
+            json.dump(self.categories, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, data_dir, mmap=True):
+        """Open a saved store, memory-mapping the embeddings matrix"""
+        mmap_mode = "r" if mmap else None
+        with open(os.path.join(data_dir, CATEGORIES_FILE)) as f:
+            categories = json.load(f)
+        return cls(
+            np.load(os.path.join(data_dir, EMBEDDINGS_FILE), mmap_mode=mmap_mode),
+            np.load(os.path.join(data_dir, FILE_NAMES_FILE), mmap_mode=mmap_mode),
+            np.load(os.path.join(data_dir, CATEGORY_IDS_FILE), mmap_mode=mmap_mode),
+            categories
+        )
+
+def store_exists(data_dir):
+    return all(
+        os.path.exists(os.path.join(data_dir, name))
+        for name in (EMBEDDINGS_FILE, FILE_NAMES_FILE, CATEGORY_IDS_FILE, CATEGORIES_FILE)
+    )
+
+def convert_pickle(data_dir, dtype=np.float32):
+    """One-shot conversion of processed_data.pkl into the columnar store"""
+    with open(os.path.join(data_dir, "processed_data.pkl"), "rb") as f:
+        data = pickle.load(f)
+    store = EmbeddingStore.from_processed_data(data)
+    store.save(data_dir, dtype=dtype)
+    logger.info(f"Converted {len(store)} embeddings to {data_dir}/{EMBEDDINGS_FILE} "
+                f"({np.dtype(dtype).name})")
+    return store
+
+def _memory_usage():
+    """Resident memory in MB, split into private and file-backed pages where available"""
+    usage = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "RssAnon", "RssFile"):
+                    usage[key] = int(value.split()[0]) / 1024
+    except OSError:
+        import resource
+        usage["VmRSS"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return usage
+
+def _measure_load(data_dir, fmt, results):
+    before = _memory_usage()
+    start = time.perf_counter()
+    if fmt == "pickle":
+        with open(os.path.join(data_dir, "processed_data.pkl"), "rb") as f:
+            data = pickle.load(f)
+        matrix = np.stack(list(data['embeddings'].values()))
+    else:
+        store = EmbeddingStore.load(data_dir)
+        store.category_names()
+        matrix = store.embeddings
+    load_time = time.perf_counter() - start
+    after_load = _memory_usage()
+    # Touch every vector, as a full scan or index build would
+    float(np.asarray(matrix, dtype=np.float32).sum())
+    after_scan = _memory_usage()
+    results.put({
+        "format": fmt,
+        "load_seconds": round(load_time, 4),
+        "rss_mb_after_load": {k: round(v - before.get(k, 0), 1) for k, v in after_load.items()},
+        "rss_mb_after_scan": {k: round(v - before.get(k, 0), 1) for k, v in after_scan.items()},
+    })
+
+def compare_formats(data_dir):
+    """Report startup time and memory of the pickle vs the mmap store, each in a fresh process"""
+    import multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    report = []
+    for fmt in ("pickle", "store"):
+        results = ctx.Queue()
+        proc = ctx.Process(target=_measure_load, args=(data_dir, fmt, results))
+        proc.start()
+        report.append(results.get())
+        proc.join()
+    return report
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Embeddings store tools")
+    parser.add_argument("command", choices=["convert", "compare"])
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--float16", action="store_true", help="store the matrix as float16")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_pickle(args.data_dir, dtype=np.float16 if args.float16 else np.float32)
+    else:
+        for row in compare_formats(args.data_dir):
+            print(json.dumps(row))
@@ -0,0 +1,85 @@
+from convnext_init import ImageEncoder, ENCODER_MODES, IMAGE_EXTENSIONS, load_image
+from pathlib import Path
+import numpy as np
+import argparse
+import logging
+import torch
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+def load_sample_batch(image_dir, encoder, n_images=32, seed=0):
+    """Transformed images from image_dir, or random pixels when no folder is given"""
+    if image_dir:
+        paths = sorted(p for p in Path(image_dir).rglob("*.*") if p.suffix.lower() in IMAGE_EXTENSIONS)
+        paths = paths[:n_images]
+        return torch.stack([encoder.transform(load_image(str(p))) for p in paths])
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(n_images, 3, 224, 224, generator=generator)
+
+def check_parity(reference, candidate, batch):
+    """Cosine similarity between reference and candidate embeddings of the same images"""
+    expected = reference.get_embeddings(batch)
+    actual = candidate.get_embeddings(batch)
+    cosine = np.sum(expected * actual, axis=1)
+    return {
+        "min_cosine": round(float(cosine.min()), 6),
+        "mean_cosine": round(float(cosine.mean()), 6),
+    }
+
+def measure_latency(encoder, batch, batch_sizes=(1, 8, 32), repeats=5):
+    """Per-batch latency and throughput for each batch size, after one warm-up pass"""
+    results = []
+    for batch_size in batch_sizes:
+        inputs = batch[:batch_size]
+        if len(inputs) < batch_size:
+            inputs = inputs.repeat((batch_size + len(inputs) - 1) // len(inputs), 1, 1, 1)[:batch_size]
+        encoder.get_embeddings(inputs)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            encoder.get_embeddings(inputs)
+            timings.append(time.perf_counter() - start)
+        mean = float(np.mean(timings))
+        results.append({
+            "batch_size": batch_size,
+            "mean_ms": round(mean * 1000, 2),
+            "images_per_sec": round(batch_size / mean, 2),
+        })
+    return results
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Parity and latency of optimized encoder modes")
+    parser.add_argument("--images", default=None, help="folder of sample images, random input if omitted")
+    parser.add_argument("--n-images", type=int, default=32)
+    parser.add_argument("--modes", default=",".join(ENCODER_MODES))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--batch-sizes", default="1,8,32")
+    parser.add_argument("--min-cosine", type=float, default=0.99,
+                        help="fail when a mode drifts further than this from fp32")
+    args = parser.parse_args()
+
+    reference = ImageEncoder(num_threads=args.threads)
+    batch = load_sample_batch(args.images, reference, args.n_images)
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    failed = False
+    for mode in args.modes.split(","):
+        encoder = reference if mode == "eager" and not args.channels_last else ImageEncoder(
+            mode=mode, num_threads=args.threads, channels_last=args.channels_last
+        )
+        parity = check_parity(reference, encoder, batch)
+        failed |= parity["min_cosine"] < args.min_cosine
+        print(json.dumps({
+            "mode": mode,
+            "channels_last": args.channels_last,
+            "threads": torch.get_num_threads(),
+            **parity,
+            "latency": measure_latency(encoder, batch, batch_sizes),
+        }))
+
+    if failed:
+        raise SystemExit(f"Embedding parity below {args.min_cosine}")
@@ -0,0 +1,209 @@
+from search_backends import SearchBackend, angular_distance, top_k, build_backend
+from embedding_store import EmbeddingStore
+from category_index import CategoryPostings, CategoryPrototypes
+from thumbnails import write_thumbnails, make_thumbnail
+from text_embeddings import write_text_embeddings, CAPTIONS_FILE, TEXT_PCA_FILE
+from dedup import (load_duplicate_clusters, save_duplicate_clusters, remap_duplicate_clusters,
+                   DUPLICATE_CLUSTERS_FILE)
+import numpy as np
+import logging
+import shutil
+import json
+import copy
+import os
+
+logger = logging.getLogger(__name__)
+
+class Delta:
+    """Rows added since the base index was built.
+
+    Never modified in place: append() and tail() return new objects, so a
+    query holding the old one keeps a consistent view.
+    """
+
+    def __init__(self, embeddings, file_names=(), class_names=(), paths=()):
+        self.embeddings = embeddings
+        self.file_names = list(file_names)
+        self.class_names = list(class_names)
+        self.paths = list(paths)
+
+    @classmethod
+    def empty(cls, dim):
+        return cls(np.zeros((0, dim), dtype=np.float32))
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def append(self, embeddings, file_names, class_names, paths):
+        return Delta(
+            np.concatenate([self.embeddings, np.asarray(embeddings, dtype=np.float32)]),
+            self.file_names + list(file_names),
+            self.class_names + list(class_names),
+            self.paths + list(paths),
+        )
+
+    def tail(self, start):
+        """Rows from start on, as a new Delta"""
+        return Delta(self.embeddings[start:], self.file_names[start:],
+                     self.class_names[start:], self.paths[start:])
+
+class LiveIndex(SearchBackend):
+    """A built backend searched together with added rows, minus deleted ones.
+
+    Ids below base_size are rows of the base index; added rows take the ids
+    from base_size on, in insertion order. Deleted ids are kept in a sorted
+    array of tombstones and filtered out of both result lists: the base is
+    asked for extra neighbours to make up for them, and added rows are
+    scored exactly since there are few of them until the next compaction.
+    """
+    name = "live"
+
+    def __init__(self, base, base_embeddings, delta, deleted):
+        self.base = base
+        self.base_embeddings = base_embeddings
+        self.base_size = len(base_embeddings)
+        self.delta = delta
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+
+    def search(self, vector, k):
+        vector = np.asarray(vector, dtype=np.float32)
+        base_deleted = int(np.searchsorted(self.deleted, self.base_size))
+        ids, distances = self.base.search(vector, k + base_deleted)
+        ids = np.asarray(ids, dtype=np.int64)
+        distances = np.asarray(distances, dtype=np.float32)
+
+        if len(self.delta):
+            scores = self.delta.embeddings @ vector
+            top = top_k(scores, k)
+            ids = np.concatenate([ids, top + self.base_size])
+            distances = np.concatenate([distances, angular_distance(scores[top])])
+
+        if len(self.deleted):
+            live = ~np.isin(ids, self.deleted)
+            ids, distances = ids[live], distances[live]
+        order = np.argsort(distances, kind="stable")[:k]
+        return ids[order].tolist(), distances[order].tolist()
+
+    def with_search_params(self, **params):
+        tuned = copy.copy(self)
+        tuned.base = self.base.with_search_params(**params)
+        return tuned
+
+    def reduced_search_params(self, k, fraction):
+        return self.base.reduced_search_params(k, fraction)
+
+    def rows(self, ids):
+        """Embeddings of any mix of base and added ids"""
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.empty((len(ids), self.delta.embeddings.shape[1]), dtype=np.float32)
+        in_base = ids < self.base_size
+        rows[in_base] = self.base_embeddings[ids[in_base]]
+        rows[~in_base] = self.delta.embeddings[ids[~in_base] - self.base_size]
+        return rows
+
+    def memory_bytes(self):
+        return self.base.memory_bytes() + self.delta.embeddings.nbytes + self.deleted.nbytes
+
+    def __len__(self):
+        return self.base_size + len(self.delta) - len(self.deleted)
+
+class LiveRows:
+    """Row accessor over a LiveIndex, indexable like the embeddings matrix"""
+
+    def __init__(self, index):
+        self.index = index
+        self.shape = (index.base_size + len(index.delta), index.delta.embeddings.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, ids):
+        return self.index.rows(np.atleast_1d(ids))
+
+def remap_ids(base_size, n_added, deleted):
+    """Old id -> id after compaction, -1 for deleted rows"""
+    keep = np.ones(base_size + n_added, dtype=bool)
+    keep[deleted[deleted < len(keep)]] = False
+    remap = np.full(len(keep), -1, dtype=np.int64)
+    remap[keep] = np.arange(int(keep.sum()))
+    return remap
+
+def write_compacted(data_dir, store, delta, deleted, backend, backend_params,
+                    thumbnails=None, hybrid=None, caption_embedder=None):
+    """Rewrite the store and index in data_dir without deleted rows and with
+    added rows folded in. Returns the old -> new id remapping.
+
+    Everything is written to a scratch directory first and then moved over
+    the live files one by one; readers that still map the old files keep
+    their (unlinked) copies until they let go of them.
+    """
+    remap = remap_ids(len(store), len(delta), deleted)
+    keep = np.flatnonzero(remap[:len(store)] >= 0)
+    keep_added = np.flatnonzero(remap[len(store):] >= 0)
+    added_paths = [delta.paths[i] for i in keep_added]
+
+    compacted = EmbeddingStore.from_arrays(
+        np.concatenate([np.asarray(store.embeddings[keep], dtype=np.float32),
+                        delta.embeddings[keep_added]]),
+        [str(name) for name in store.file_names[keep]] + [delta.file_names[i] for i in keep_added],
+        list(store.category_names()[keep]) + [delta.class_names[i] for i in keep_added],
+    )
+
+    scratch = os.path.join(data_dir, ".compact")
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+    try:
+        compacted.save(scratch, dtype=store.embeddings.dtype)
+        CategoryPostings.build(
+            compacted.embeddings, compacted.category_ids, len(compacted.categories)
+        ).save(scratch)
+        if CategoryPrototypes.exists(data_dir):
+            per_category = CategoryPrototypes.load(data_dir, len(store.categories)).per_category
+            CategoryPrototypes.build(
+                compacted.embeddings, compacted.category_ids, len(compacted.categories), per_category
+            ).save(scratch)
+        build_backend(backend, compacted.embeddings, scratch, **backend_params)
+
+        # Duplicate clusters refer to rows by id, carry them over to the new ids
+        duplicate_of = load_duplicate_clusters(data_dir, store)
+        if duplicate_of is not None:
+            save_duplicate_clusters(
+                scratch, remap_duplicate_clusters(duplicate_of, remap, len(compacted)), compacted
+            )
+
+        if thumbnails is not None:
+            write_thumbnails(
+                [thumbnails.get(int(i)) or b"" for i in keep]
+                + [make_thumbnail(path) for path in added_paths],
+                scratch,
+            )
+
+        if hybrid is not None:
+            with open(os.path.join(data_dir, CAPTIONS_FILE)) as f:
+                captions = json.load(f)
+            captions = [captions[i] for i in keep]
+            vectors = np.asarray(hybrid.text_embeddings[keep], dtype=np.float32)
+            if added_paths:
+                new_captions, new_vectors = caption_embedder.embed_images(added_paths)
+                captions += new_captions
+                vectors = np.concatenate([vectors, hybrid.project(new_vectors)])
+            if hybrid.pca is not None:
+                shutil.copy(os.path.join(data_dir, TEXT_PCA_FILE), scratch)
+            write_text_embeddings(captions, vectors, scratch, hybrid.index_backend or "annoy",
+                                  hybrid.index_params)
+
+        for name in os.listdir(scratch):
+            target = os.path.join(data_dir, name)
+            if os.path.isdir(target):
+                # Index directories cannot be replaced in one step
+                shutil.rmtree(target)
+            os.replace(os.path.join(scratch, name), target)
+        if duplicate_of is None and os.path.exists(os.path.join(data_dir, DUPLICATE_CLUSTERS_FILE)):
+            # Stale clusters from an older index, they cannot be mapped to the new rows
+            os.remove(os.path.join(data_dir, DUPLICATE_CLUSTERS_FILE))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    logger.info(f"Compacted index: {len(store)} + {len(delta)} added - {len(deleted)} deleted "
+                f"-> {len(compacted)} rows")
+    return remap
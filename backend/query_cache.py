@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from PIL import Image
+import numpy as np
+import threading
+import hashlib
+import time
+
+def content_hash(data):
+    """Exact-match key for uploaded bytes"""
+    return hashlib.sha1(data).hexdigest()
+
+def perceptual_hash(image, hash_size=8):
+    """64-bit difference hash: survives re-encoding and resizing, so
+    near-duplicate uploads share a key"""
+    pixels = np.asarray(
+        image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16
+    )
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+class QueryCache:
+    """Thread-safe LRU with a per-entry time to live.
+
+    Entries may carry a version; a get() with a different version treats
+    the entry as stale and drops it, which is how results computed against
+    an older index are invalidated without walking the cache.
+    """
+
+    def __init__(self, max_entries=10000, ttl_seconds=3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stale = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key, version=None):
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, entry_version = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            if entry_version != version:
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl_seconds, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "stale": self.stale,
+                "evictions": self.evictions,
+            }
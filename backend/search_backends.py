@@ -0,0 +1,474 @@
+from annoy import AnnoyIndex
+from compression import PCAReducer, ProductQuantizer
+import numpy as np
+import argparse
+import logging
+import json
+import copy
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Per-backend parameters that only affect search and can differ from build time
+SEARCH_PARAMS = {
+    "annoy": ("search_k",),
+    "ivf": ("nprobe",),
+    "compressed": ("rerank",),
+}
+
+# Build parameters recorded next to the index, so compaction can rebuild it the same way
+BUILD_PARAMS_FILE = "index_params.json"
+
+def search_params_for(backend, params):
+    return {name: value for name, value in params.items() if name in SEARCH_PARAMS.get(backend, ())}
+
+def angular_distance(cosine):
+    """Annoy's 'angular' distance, sqrt(2 - 2 cos), for unit vectors"""
+    return np.sqrt(np.maximum(2.0 - 2.0 * cosine, 0.0))
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+def _dot_chunked(matrix, vectors, chunk_size=65536):
+    """matrix @ vectors.T in row chunks, so float16 or mmap matrices are
+    upcast a slice at a time instead of all at once"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scores = np.empty((len(matrix), len(vectors)), dtype=np.float32)
+    for start in range(0, len(matrix), chunk_size):
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        scores[start:start + len(block)] = block @ vectors.T
+    return scores
+
+class SearchBackend:
+    """Nearest-neighbour search over the rows of the embeddings matrix.
+
+    search() returns (ids, distances) like AnnoyIndex.get_nns_by_vector with
+    include_distances=True: row ids best first and angular distances.
+    """
+    name = None
+
+    def build(self, embeddings):
+        raise NotImplementedError
+
+    def save(self, data_dir):
+        pass
+
+    def load(self, data_dir, embeddings):
+        raise NotImplementedError
+
+    def search(self, vector, k):
+        raise NotImplementedError
+
+    def search_batch(self, vectors, k):
+        return [self.search(vector, k) for vector in vectors]
+
+    def with_search_params(self, **params):
+        """Shallow copy searching with other search-time parameters.
+
+        Parameters the backend does not have are ignored, so one dict can
+        carry search_k, nprobe and rerank whatever the backend is. The copy
+        shares the index, making this cheap enough to do per request.
+        """
+        params = search_params_for(self.name, params)
+        if not params:
+            return self
+        tuned = copy.copy(self)
+        for name, value in params.items():
+            setattr(tuned, name, value)
+        return tuned
+
+    def reduced_search_params(self, k, fraction):
+        """Search parameters spending about `fraction` of this backend's usual
+        effort on a k-neighbour search, {} when it has nothing to turn down"""
+        return {}
+
+    def build_params(self):
+        """Build parameters that can be read back from a loaded index, for
+        indexes saved without BUILD_PARAMS_FILE"""
+        return {}
+
+    def memory_bytes(self):
+        """Bytes the index keeps resident (or mapped) to answer queries"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+class ExactBackend(SearchBackend):
+    """Brute-force matrix product against every vector; exact, fine for small catalogs"""
+    name = "exact"
+
+    def __init__(self, chunk_size=65536):
+        self.chunk_size = chunk_size
+        self.embeddings = None
+
+    def build(self, embeddings):
+        self.embeddings = embeddings
+
+    def load(self, data_dir, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, vector, k):
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors, k):
+        scores = _dot_chunked(self.embeddings, vectors, self.chunk_size)
+        results = []
+        for column in scores.T:
+            top = top_k(column, k)
+            results.append((top.tolist(), angular_distance(column[top]).tolist()))
+        return results
+
+    def memory_bytes(self):
+        return self.embeddings.nbytes
+
+    def __len__(self):
+        return len(self.embeddings)
+
+class AnnoyBackend(SearchBackend):
+    """Random-projection forest from the annoy package"""
+    name = "annoy"
+    index_file = "image_index.ann"
+
+    def __init__(self, n_trees=100, search_k=-1):
+        self.n_trees = n_trees
+        self.search_k = search_k
+        self.index = None
+        self.index_path = None
+
+    def build(self, embeddings):
+        self.index = AnnoyIndex(embeddings.shape[1], 'angular')
+        for idx, embedding in enumerate(embeddings):
+            self.index.add_item(idx, embedding)
+        logger.info(f"Building index with {self.n_trees} trees...")
+        self.index.build(self.n_trees)
+
+    def save(self, data_dir):
+        self.index_path = os.path.join(data_dir, self.index_file)
+        self.index.save(self.index_path)
+
+    def load(self, data_dir, embeddings):
+        self.index = AnnoyIndex(embeddings.shape[1], 'angular')
+        self.index_path = os.path.join(data_dir, self.index_file)
+        self.index.load(self.index_path)
+        self.n_trees = self.index.get_n_trees()
+
+    def memory_bytes(self):
+        # Annoy keeps its own copy of every vector inside the index file
+        return os.path.getsize(self.index_path)
+
+    def search(self, vector, k):
+        return self.index.get_nns_by_vector(
+            vector, k, search_k=self.search_k, include_distances=True
+        )
+
+    def reduced_search_params(self, k, fraction):
+        # search_k=-1 is annoy's n_trees * k
+        search_k = self.search_k if self.search_k > 0 else self.n_trees * k
+        return {"search_k": max(k, int(search_k * fraction))}
+
+    def build_params(self):
+        return {"n_trees": self.n_trees}
+
+    def __len__(self):
+        return self.index.get_n_items()
+
+class IVFBackend(SearchBackend):
+    """Inverted file index: k-means coarse quantizer, exact scoring inside the
+    nprobe closest lists. Raise nprobe for recall, lower it for speed."""
+    name = "ivf"
+
+    def __init__(self, n_lists=None, nprobe=8, train_size=100000, n_iter=20, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.n_iter = n_iter
+        self.seed = seed
+        self.embeddings = None
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+
+    def _train_centroids(self, embeddings, n_lists):
+        """Spherical k-means on a sample of the vectors"""
+        rng = np.random.default_rng(self.seed)
+        sample_ids = rng.choice(len(embeddings), min(len(embeddings), self.train_size), replace=False)
+        sample = np.asarray(embeddings[np.sort(sample_ids)], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=n_lists)
+            empty = counts == 0
+            # Restart empty lists from random points
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        return centroids
+
+    def build(self, embeddings):
+        self.embeddings = embeddings
+        n_lists = self.n_lists or int(4 * np.sqrt(len(embeddings)))
+        n_lists = max(1, min(n_lists, len(embeddings)))
+        logger.info(f"Training IVF coarse quantizer with {n_lists} lists...")
+        self.centroids = self._train_centroids(embeddings, n_lists)
+        assignment = np.argmax(_dot_chunked(embeddings, self.centroids), axis=1)
+        self.list_ids = np.argsort(assignment, kind="stable").astype(np.int64)
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignment, minlength=n_lists))]
+        ).astype(np.int64)
+
+    def save(self, data_dir):
+        np.save(os.path.join(data_dir, "ivf_centroids.npy"), self.centroids)
+        np.save(os.path.join(data_dir, "ivf_list_offsets.npy"), self.list_offsets)
+        np.save(os.path.join(data_dir, "ivf_list_ids.npy"), self.list_ids)
+
+    def load(self, data_dir, embeddings):
+        self.embeddings = embeddings
+        self.centroids = np.load(os.path.join(data_dir, "ivf_centroids.npy"))
+        self.list_offsets = np.load(os.path.join(data_dir, "ivf_list_offsets.npy"))
+        self.list_ids = np.load(os.path.join(data_dir, "ivf_list_ids.npy"), mmap_mode="r")
+
+    def _probe(self, vector):
+        """Candidate row ids from the nprobe closest lists"""
+        lists = top_k(self.centroids @ vector, self.nprobe)
+        return np.concatenate([
+            self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists
+        ])
+
+    def search(self, vector, k):
+        vector = np.asarray(vector, dtype=np.float32)
+        candidates = np.sort(self._probe(vector))
+        scores = np.asarray(self.embeddings[candidates], dtype=np.float32) @ vector
+        top = top_k(scores, k)
+        return candidates[top].tolist(), angular_distance(scores[top]).tolist()
+
+    def reduced_search_params(self, k, fraction):
+        return {"nprobe": max(1, int(self.nprobe * fraction))}
+
+    def build_params(self):
+        return {"n_lists": len(self.centroids)}
+
+    def memory_bytes(self):
+        return self.embeddings.nbytes + self.centroids.nbytes + self.list_ids.nbytes
+
+    def __len__(self):
+        return len(self.list_ids)
+
+class CompressedBackend(SearchBackend):
+    """Scan of compressed vectors followed by an exact re-rank.
+
+    Vectors are optionally reduced with PCA (dim, whiten), then kept either
+    as float16 or as product-quantized codes (n_subvectors bytes per vector)
+    scored by asymmetric distance computation. The best `rerank` candidates
+    are re-scored against the full embeddings, which stay on disk behind
+    mmap and are only touched for those rows.
+    """
+    name = "compressed"
+
+    def __init__(self, codec="pq", dim=None, whiten=False, n_subvectors=16, rerank=100):
+        if codec not in ("pq", "float16"):
+            raise ValueError(f"Unknown codec {codec!r}, expected 'pq' or 'float16'")
+        self.codec = codec
+        self.dim = dim
+        self.whiten = whiten
+        self.n_subvectors = n_subvectors
+        self.rerank = rerank
+        self.embeddings = None
+        self.reducer = None
+        self.quantizer = None
+        self.codes = None
+
+    def _reduce(self, vectors, chunk_size=65536):
+        if self.reducer is None:
+            return vectors
+        reduced = np.empty((len(vectors), self.reducer.dim), dtype=np.float32)
+        for start in range(0, len(vectors), chunk_size):
+            reduced[start:start + chunk_size] = self.reducer.transform(vectors[start:start + chunk_size])
+        return reduced
+
+    def build(self, embeddings):
+        self.embeddings = embeddings
+        if self.dim and self.dim < embeddings.shape[1]:
+            self.reducer = PCAReducer.fit(embeddings, self.dim, whiten=self.whiten)
+        reduced = self._reduce(embeddings)
+        if self.codec == "pq":
+            logger.info(f"Training product quantizer with {self.n_subvectors} subvectors...")
+            self.quantizer = ProductQuantizer.fit(reduced, self.n_subvectors)
+            self.codes = self.quantizer.encode(reduced)
+        else:
+            self.codes = np.asarray(reduced, dtype=np.float16)
+
+    def save(self, data_dir):
+        np.save(os.path.join(data_dir, "compressed_codes.npy"), self.codes)
+        arrays = self.reducer.to_arrays() if self.reducer is not None else {}
+        if self.quantizer is not None:
+            arrays["codebooks"] = self.quantizer.codebooks
+        np.savez(os.path.join(data_dir, "compressed_model.npz"), **arrays)
+
+    def load(self, data_dir, embeddings):
+        self.embeddings = embeddings
+        self.codes = np.load(os.path.join(data_dir, "compressed_codes.npy"), mmap_mode="r")
+        arrays = dict(np.load(os.path.join(data_dir, "compressed_model.npz")))
+        self.reducer = PCAReducer.from_arrays(arrays) if "components" in arrays else None
+        self.quantizer = ProductQuantizer(arrays["codebooks"]) if "codebooks" in arrays else None
+        self.codec = "pq" if self.quantizer is not None else "float16"
+
+    def search(self, vector, k):
+        vector = np.asarray(vector, dtype=np.float32)
+        query = self.reducer.transform(vector) if self.reducer is not None else vector
+        if self.quantizer is not None:
+            approximate = self.quantizer.scores(self.codes, query)
+        else:
+            approximate = _dot_chunked(self.codes, query[None, :])[:, 0]
+
+        candidates = np.sort(top_k(approximate, max(self.rerank, k)))
+        scores = np.asarray(self.embeddings[candidates], dtype=np.float32) @ vector
+        top = top_k(scores, k)
+        return candidates[top].tolist(), angular_distance(scores[top]).tolist()
+
+    def reduced_search_params(self, k, fraction):
+        return {"rerank": max(k, int(max(self.rerank, k) * fraction))}
+
+    def build_params(self):
+        params = {"codec": self.codec}
+        if self.reducer is not None:
+            params.update(dim=self.reducer.dim, whiten=self.reducer.scale is not None)
+        if self.quantizer is not None:
+            params["n_subvectors"] = len(self.quantizer.codebooks)
+        return params
+
+    def memory_bytes(self):
+        size = self.codes.nbytes
+        if self.reducer is not None:
+            size += sum(array.nbytes for array in self.reducer.to_arrays().values())
+        if self.quantizer is not None:
+            size += self.quantizer.codebooks.nbytes
+        return size
+
+    def __len__(self):
+        return len(self.codes)
+
+BACKENDS = {
+    ExactBackend.name: ExactBackend,
+    AnnoyBackend.name: AnnoyBackend,
+    IVFBackend.name: IVFBackend,
+    CompressedBackend.name: CompressedBackend,
+}
+
+def create_backend(name, **params):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown search backend {name!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name](**params)
+
+def build_backend(name, embeddings, data_dir, **params):
+    """Build a backend over the embeddings matrix and save it to data_dir"""
+    backend = create_backend(name, **params)
+    backend.build(embeddings)
+    backend.save(data_dir)
+    with open(os.path.join(data_dir, BUILD_PARAMS_FILE), "w") as f:
+        build_params = {key: value for key, value in params.items()
+                        if key not in SEARCH_PARAMS.get(name, ())}
+        json.dump({"backend": name, "params": build_params}, f)
+    return backend
+
+def load_backend(name, data_dir, embeddings, **params):
+    backend = create_backend(name, **params)
+    backend.load(data_dir, embeddings)
+    return backend
+
+def load_build_params(data_dir, backend):
+    """Parameters the loaded backend's index in data_dir was built with,
+    falling back to what the index itself tells for ones saved before
+    BUILD_PARAMS_FILE was written"""
+    path = os.path.join(data_dir, BUILD_PARAMS_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest["backend"] == backend.name:
+            return manifest["params"]
+    return backend.build_params()
+
+def make_queries(embeddings, n_queries=200, noise=0.05, seed=0):
+    """Perturbed copies of random catalog vectors, so a query is never an exact hit"""
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(len(embeddings), min(n_queries, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[np.sort(ids)], dtype=np.float32)
+    queries = queries + rng.normal(0, noise, queries.shape).astype(np.float32) / np.sqrt(queries.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def benchmark(backends, embeddings, queries, k=10):
+    """recall@k against exact search and per-query latency for each backend"""
+    exact = ExactBackend()
+    exact.build(embeddings)
+    truth = [set(ids) for ids, _ in exact.search_batch(queries, k)]
+
+    report = []
+    for name, backend in backends.items():
+        latencies = []
+        hits = 0
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            ids, _ = backend.search(query, k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(expected.intersection(ids))
+        latencies_ms = np.array(latencies) * 1000
+        report.append({
+            "backend": name,
+            "index_mb": round(backend.memory_bytes() / 1e6, 2),
+            f"recall@{k}": round(hits / (k * len(queries)), 4),
+            "mean_ms": round(float(latencies_ms.mean()), 3),
+            "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        })
+    return report
+
+if __name__ == "__main__":
+    from embedding_store import EmbeddingStore
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or benchmark search backends")
+    parser.add_argument("command", choices=["build", "bench"])
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--backend", default="annoy", help="backend(s), comma separated")
+    parser.add_argument("--trees", type=int, default=100)
+    parser.add_argument("--search-k", type=int, default=-1)
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--codec", default="pq", choices=["pq", "float16"])
+    parser.add_argument("--dim", type=int, default=None, help="PCA dimension for the compressed backend")
+    parser.add_argument("--whiten", action="store_true")
+    parser.add_argument("--subvectors", type=int, default=16)
+    parser.add_argument("--rerank", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    store = EmbeddingStore.load(args.data_dir)
+    params = {
+        "annoy": {"n_trees": args.trees, "search_k": args.search_k},
+        "ivf": {"n_lists": args.n_lists, "nprobe": args.nprobe},
+        "exact": {},
+        "compressed": {"codec": args.codec, "dim": args.dim, "whiten": args.whiten,
+                       "n_subvectors": args.subvectors, "rerank": args.rerank},
+    }
+    names = args.backend.split(",")
+
+    if args.command == "build":
+        for name in names:
+            build_backend(name, store.embeddings, args.data_dir, **params[name])
+    else:
+        backends = {}
+        for name in names:
+            backend_params = {k: v for k, v in params[name].items()
+                              if k in ("search_k", "nprobe", "rerank")}
+            backends[name] = load_backend(name, args.data_dir, store.embeddings, **backend_params)
+        queries = make_queries(store.embeddings, args.queries)
+        for row in benchmark(backends, store.embeddings, queries, k=args.k):
+            print(json.dumps(row))
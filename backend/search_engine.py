@@ -0,0 +1,730 @@
+from PIL import Image
+from pydantic import BaseModel
+from typing import Optional, List, NamedTuple
+from embedding_store import EmbeddingStore, store_exists, convert_pickle
+from search_backends import load_backend, load_build_params, angular_distance
+from sharding import ShardedBackend
+from convnext_init import IMAGE_EXTENSIONS
+from thumbnails import ThumbnailStore, PreviewCache, to_data_uri, make_thumbnail
+from category_index import CategoryPostings, CategoryPrototypes
+from dedup import load_duplicate_clusters
+from text_embeddings import HybridIndex, CaptionEmbedder
+from live_index import Delta, LiveIndex, LiveRows, write_compacted
+from metrics import REGISTRY, timed
+from vlm import VLMLoader
+from urllib.parse import quote
+from pathlib import Path
+import numpy as np
+import threading
+import logging
+import traceback
+import itertools
+import copy
+import json
+import time
+import base64
+import math
+import io
+import os
+
+logger = logging.getLogger(__name__)
+
+# Nearest-neighbour backend: "annoy", "exact", "ivf", "compressed" or "sharded"
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "annoy")
+SEARCH_BACKEND_PARAMS = {
+    "annoy": {"search_k": int(os.getenv("ANNOY_SEARCH_K", "-1"))},
+    "ivf": {"nprobe": int(os.getenv("IVF_NPROBE", "8"))},
+    "compressed": {"rerank": int(os.getenv("COMPRESSED_RERANK", "100"))},
+    "exact": {},
+}
+# Sharded search: one worker "process" per shard, "thread"s in this process,
+# or shard servers listed in SHARD_URLS
+SEARCH_BACKEND_PARAMS["sharded"] = {
+    "workers": os.getenv("SHARD_WORKERS", "process"),
+    "urls": [url for url in os.getenv("SHARD_URLS", "").split(",") if url],
+    **SEARCH_BACKEND_PARAMS["annoy"],
+    **SEARCH_BACKEND_PARAMS["ivf"],
+    **SEARCH_BACKEND_PARAMS["compressed"],
+}
+
+# Search budget per query, all overridable per request: results returned,
+# candidates the category-aware mode re-ranks (raised to at least the results)
+PREDICT_RESULTS = int(os.getenv("PREDICT_RESULTS", "10"))
+PREDICT_CANDIDATES = int(os.getenv("PREDICT_CANDIDATES", "30"))
+
+# Adaptive search: a first pass at ADAPTIVE_BUDGET of the backend's usual effort for
+# the requested number of neighbours (e.g. search_k = 0.25 * n_trees * n on annoy),
+# widened to the full budget only when the top matches are ambiguous, that is the
+# top-1 similarity or the share of the top 10 in the majority category is low.
+# ADAPTIVE_SEARCH_PARAMS (JSON) replaces the derived first-pass parameters
+ADAPTIVE_SEARCH = os.getenv("ADAPTIVE_SEARCH", "0") == "1"
+ADAPTIVE_BUDGET = float(os.getenv("ADAPTIVE_BUDGET", "0.25"))
+ADAPTIVE_SEARCH_PARAMS = json.loads(os.getenv("ADAPTIVE_SEARCH_PARAMS", "{}"))
+ADAPTIVE_MIN_SIMILARITY = float(os.getenv("ADAPTIVE_MIN_SIMILARITY", "0.7"))
+ADAPTIVE_MIN_MAJORITY = float(os.getenv("ADAPTIVE_MIN_MAJORITY", "0.8"))
+
+# Query-time duplicate collapse, using the clusters written by dedup.py: only the
+# best match of every duplicate cluster is returned, searching this many times
+# deeper to make up for the collapsed rows
+COLLAPSE_DUPLICATES = os.getenv("COLLAPSE_DUPLICATES", "0") == "1"
+COLLAPSE_OVERFETCH = int(os.getenv("COLLAPSE_OVERFETCH", "3"))
+
+# Category-filtered search scores categories of up to this many rows exactly;
+# larger ones go through the ANN index, searched deep enough to hold about
+# CATEGORY_OVERFETCH times the results from the category
+CATEGORY_EXACT_MAX = int(os.getenv("CATEGORY_EXACT_MAX", "50000"))
+CATEGORY_OVERFETCH = float(os.getenv("CATEGORY_OVERFETCH", "2"))
+
+# Compaction rebuilds the index with the parameters it was built with; these
+# (JSON, e.g. {"n_trees": 100}) override them
+INDEX_BUILD_PARAMS = json.loads(os.getenv("INDEX_BUILD_PARAMS", "{}"))
+
+# Previews of top matches: "inline" base64 thumbnails or "url" links into /dataset
+PREVIEW_MODE = os.getenv("PREVIEW_MODE", "inline")
+PREVIEW_CACHE_MB = float(os.getenv("PREVIEW_CACHE_MB", "32"))
+
+# Qwen2-VL checkpoint loaded for /describe, see VLM_LOAD in app.py
+VLM_MODEL = os.getenv("VLM_MODEL", "Qwen/Qwen2-VL-2B-Instruct")
+VLM_DTYPE = os.getenv("VLM_DTYPE", "float32")
+
+# Default /predict mode: "raw" top matches or "category" aware re-ranking
+PREDICT_MODE = os.getenv("PREDICT_MODE", "raw")
+
+class ImagePreview(BaseModel):
+    image_path: str
+    preview_path: str
+    category: str
+    similarity: float
+    distance: float
+
+class PredictionResult(BaseModel):
+    image_path: str
+    recs: str
+    model_used: str
+    confidence_score: float
+    top_matches: List[ImagePreview]
+    category: str
+    closest_distance: float
+    category_count: int
+
+# Exported on /metrics along with the rest of the registry
+ADAPTIVE_SEARCHES = REGISTRY.counter(
+    "adaptive_searches_total", "Adaptive searches settled by the first pass or widened", ["outcome"]
+)
+
+class SearchOptions(NamedTuple):
+    """Search budget of one request; hashable, so it is part of result cache keys"""
+    k: int = PREDICT_RESULTS
+    candidates: int = max(PREDICT_CANDIDATES, PREDICT_RESULTS)
+    # (name, value) pairs overriding the backend's search parameters
+    search_params: tuple = ()
+    adaptive: bool = ADAPTIVE_SEARCH
+    collapse: bool = COLLAPSE_DUPLICATES
+    # Category id the search is restricted to
+    category: Optional[int] = None
+
+# Every change to the searchable data gets a new number, cached results carry it
+INDEX_GENERATIONS = itertools.count(1)
+
+def majority_category(category_ids):
+    """(category, count) of the most common category, ties going to the one ranked first"""
+    categories, first_seen, counts = np.unique(category_ids, return_index=True, return_counts=True)
+    if not len(counts):
+        return None, 0
+    best = np.argmin(np.where(counts == counts.max(), first_seen, len(category_ids)))
+    return int(categories[best]), int(counts[best])
+
+def find_dataset_file(category, stem):
+    """Path under dataset/ of an indexed image, the index only keeps its stem"""
+    for extension in IMAGE_EXTENSIONS:
+        for name in (f"{category}/{stem}{extension}", f"{category}/{stem}{extension.upper()}"):
+            if os.path.exists(os.path.join("dataset", name)):
+                return name
+    return f"{category}/{stem}.jpg"
+
+class ImageSearchEngine:
+    def __init__(self):
+        self.encoder = None
+        self.index = None
+        self.vlm = VLMLoader(VLM_MODEL, dtype=VLM_DTYPE)
+        self.startup_timings = {}
+        self.store = None
+        self.embeddings = None
+        self.file_mapping = []
+        self.category_ids = None
+        self.categories = []
+        self.postings = None
+        self.prototypes = None
+        self.duplicate_of = None
+        self.duplicate_rows = np.zeros(0, dtype=np.int64)
+        self.embedding_dim = None
+        self.thumbnails = None
+        self.hybrid = None
+        self.caption_embedder = CaptionEmbedder()
+        self.preview_cache = PreviewCache(int(PREVIEW_CACHE_MB * 1024 * 1024))
+        self.data_dir = None
+        self.base_index = None
+        self.delta = None
+        self.deleted = np.zeros(0, dtype=np.int64)
+        self.lock = threading.Lock()
+        self.compaction = {"state": "idle", "runs": 0, "last_seconds": None, "error": None}
+        self.generation = 0
+        
+    def load_search_data(self, data_dir="./data"):
+        """Load search index and mappings"""
+        try:
+            self.data_dir = data_dir
+            # Load the memory-mapped store, converting a legacy pickle once
+            if not store_exists(data_dir):
+                logger.info(f"No embeddings store in {data_dir}, converting processed_data.pkl")
+                convert_pickle(data_dir)
+            self.store = EmbeddingStore.load(data_dir)
+            self.embeddings = self.store.embeddings
+            self.file_mapping = self.store.file_names
+            self.category_ids = self.store.category_ids
+            self.categories = self.store.categories
+            
+            # Posting lists for category padding, built here for indexes predating them
+            if CategoryPostings.exists(data_dir):
+                self.postings = CategoryPostings.load(data_dir)
+            else:
+                self.postings = CategoryPostings.build(
+                    self.embeddings, self.category_ids, len(self.categories)
+                )
+            
+            # Category prototypes for classify-only requests, centroids when none were built
+            if CategoryPrototypes.exists(data_dir):
+                self.prototypes = CategoryPrototypes.load(data_dir, len(self.categories))
+            else:
+                self.prototypes = CategoryPrototypes.from_centroids(self.postings.centroids)
+            
+            # Duplicate clusters from dedup.py for collapsing results
+            self.duplicate_of = load_duplicate_clusters(data_dir, self.store)
+            self.duplicate_rows = (
+                np.flatnonzero(self.duplicate_of != np.arange(len(self.duplicate_of)))
+                if self.duplicate_of is not None else np.zeros(0, dtype=np.int64)
+            )
+            
+            # Initialize search index
+            self.embedding_dim = self.store.embedding_dim
+            self.base_index = load_backend(
+                SEARCH_BACKEND, data_dir, self.embeddings,
+                **SEARCH_BACKEND_PARAMS.get(SEARCH_BACKEND, {})
+            )
+            self.index = self.base_index
+            self.delta = Delta.empty(self.embedding_dim)
+            self.deleted = np.zeros(0, dtype=np.int64)
+            self.generation = next(INDEX_GENERATIONS)
+            
+            # Precomputed thumbnails are optional, previews fall back to the dataset
+            self.thumbnails = None
+            self.preview_cache.clear()
+            if ThumbnailStore.exists(data_dir):
+                thumbnails = ThumbnailStore(data_dir)
+                if len(thumbnails) == len(self.store):
+                    self.thumbnails = thumbnails
+                else:
+                    logger.warning("Thumbnail store does not match the index, ignoring it")
+            
+            # Caption embeddings for hybrid visual + text search, if they were built
+            self.hybrid = None
+            if HybridIndex.exists(data_dir):
+                hybrid = HybridIndex(data_dir)
+                if len(hybrid) == len(self.store):
+                    self.hybrid = hybrid
+                else:
+                    logger.warning("Text embeddings do not match the index, hybrid search disabled")
+            
+            return True
+        except Exception as e:
+            logger.error(f"Error loading search data: {str(e)}")
+            return False
+
+    def snapshot(self):
+        """Shallow copy for one request, unaffected by later updates or index swaps"""
+        with self.lock:
+            return copy.copy(self)
+
+    def _publish_live(self, delta, deleted):
+        """Point the index and mappings at base + delta - deleted; call with the lock held"""
+        self.delta, self.deleted = delta, deleted
+        self.generation = next(INDEX_GENERATIONS)
+        if not len(delta) and not len(deleted):
+            self.index = self.base_index
+            self.embeddings = self.store.embeddings
+            self.file_mapping = self.store.file_names
+            self.category_ids = self.store.category_ids
+            self.categories = self.store.categories
+            return
+        
+        # New arrays every time, requests holding the old ones are not affected
+        self.index = LiveIndex(self.base_index, self.store.embeddings, delta, deleted)
+        self.embeddings = LiveRows(self.index)
+        self.file_mapping = np.concatenate([self.store.file_names, np.asarray(delta.file_names, dtype=str)])
+        new_categories = sorted(set(delta.class_names) - set(self.store.categories))
+        self.categories = self.store.categories + new_categories
+        category_index = {name: i for i, name in enumerate(self.categories)}
+        self.category_ids = np.concatenate([
+            self.store.category_ids,
+            np.asarray([category_index[name] for name in delta.class_names], dtype=np.int32),
+        ])
+
+    def is_live(self, file_name):
+        with self.lock:
+            ids = np.flatnonzero(self.file_mapping == file_name)
+            return bool(len(np.setdiff1d(ids, self.deleted)))
+
+    def add_items(self, embeddings, file_names, class_names, paths):
+        """Make new images searchable right away; returns their ids"""
+        with self.lock:
+            first = len(self.store) + len(self.delta)
+            self._publish_live(self.delta.append(embeddings, file_names, class_names, paths), self.deleted)
+            return list(range(first, first + len(file_names)))
+
+    def delete_items(self, file_names):
+        """Tombstone every live row with one of these file names; returns their ids"""
+        with self.lock:
+            ids = np.setdiff1d(np.flatnonzero(np.isin(self.file_mapping, file_names)), self.deleted)
+            if len(ids):
+                self._publish_live(self.delta, np.union1d(self.deleted, ids))
+            return ids.tolist()
+
+    def pending_changes(self):
+        return len(self.delta) + len(self.deleted)
+
+    def compact(self):
+        """Rebuild the store and index with pending changes folded in, then swap it in.
+
+        Building happens outside the lock, so searches and updates keep going;
+        updates that arrive meanwhile are carried over to the new ids.
+        """
+        if isinstance(self.base_index, ShardedBackend):
+            raise ValueError("Sharded indexes are rebuilt with sharding.py, not compacted")
+        state = self.snapshot()
+        remap = write_compacted(
+            state.data_dir, state.store, state.delta, state.deleted, SEARCH_BACKEND,
+            {**load_build_params(state.data_dir, state.base_index), **INDEX_BUILD_PARAMS},
+            thumbnails=state.thumbnails, hybrid=state.hybrid,
+            caption_embedder=state.caption_embedder,
+        )
+        
+        fresh = copy.copy(state)
+        fresh.preview_cache = PreviewCache(int(PREVIEW_CACHE_MB * 1024 * 1024))
+        if not fresh.load_search_data(state.data_dir):
+            raise RuntimeError("Failed to load the compacted index")
+        
+        with self.lock:
+            compacted = len(state.store) + len(state.delta)
+            later = np.setdiff1d(self.deleted, state.deleted)
+            moved = remap[later[later < compacted]]
+            deleted = np.union1d(
+                moved[moved >= 0],
+                later[later >= compacted] - compacted + len(fresh.store),
+            )
+            fresh._publish_live(self.delta.tail(len(state.delta)), deleted)
+            self.__dict__.update(fresh.__dict__)
+
+    def start_compaction(self):
+        """Compact in a background thread unless one is already running"""
+        with self.lock:
+            if self.compaction["state"] == "running":
+                return False
+            self.compaction["state"] = "running"
+        threading.Thread(target=self._compact_quietly, name="index-compaction", daemon=True).start()
+        return True
+
+    def _compact_quietly(self):
+        start = time.perf_counter()
+        try:
+            self.compact()
+            self.compaction.update(state="idle", error=None, runs=self.compaction["runs"] + 1,
+                                   last_seconds=round(time.perf_counter() - start, 2))
+        except Exception as e:
+            logger.error(f"Error compacting index: {str(e)}")
+            logger.error(traceback.format_exc())
+            self.compaction.update(state="failed", error=str(e))
+
+    def live_stats(self):
+        return {
+            "base_size": len(self.store) if self.store is not None else 0,
+            "added": len(self.delta) if self.delta is not None else 0,
+            "deleted": len(self.deleted),
+            "compaction": dict(self.compaction),
+        }
+
+    def get_image_preview(self, image_path: str, size=(150, 150)) -> Optional[str]:
+        """Create thumbnail and return base64 encoded image"""
+        try:
+            with Image.open(os.path.join("dataset", image_path)) as img:
+                img.thumbnail(size)
+                buffered = io.BytesIO()
+                img.save(buffered, format="JPEG")
+                img_str = base64.b64encode(buffered.getvalue()).decode()
+                return f"data:image/jpeg;base64,{img_str}"
+        except Exception as e:
+            logger.error(f"Error creating preview for {image_path}: {e}")
+            return None
+
+    def category_of(self, idx):
+        """Category name of a row; rows only keep the id, names are looked up
+        for the rows a response returns"""
+        return self.categories[int(self.category_ids[idx])]
+
+    def dataset_file(self, idx):
+        """Path of an indexed image under dataset/, as served by the /dataset mount"""
+        idx = int(idx)
+        if idx >= len(self.store):
+            # Added since the last build, saved where the upload went
+            return Path(os.path.relpath(self.delta.paths[idx - len(self.store)], "dataset")).as_posix()
+        return find_dataset_file(self.category_of(idx), self.file_mapping[idx])
+
+    def get_preview(self, idx, mode=PREVIEW_MODE) -> Optional[str]:
+        """Preview of an indexed image, as a data URI or a /dataset URL"""
+        if mode == "url":
+            return f"/dataset/{quote(self.dataset_file(idx))}"
+        
+        idx = int(idx)
+        preview = self.preview_cache.get(idx)
+        if preview is None:
+            with timed("preview"):
+                if idx >= len(self.store):
+                    # Added since the last build, thumbnail the saved upload
+                    thumbnail = make_thumbnail(self.delta.paths[idx - len(self.store)])
+                else:
+                    thumbnail = self.thumbnails.get(idx) if self.thumbnails is not None else None
+                preview = (to_data_uri(thumbnail) if thumbnail
+                           else self.get_image_preview(self.dataset_file(idx)))
+            if preview:
+                self.preview_cache.put(idx, preview)
+        return preview
+
+    def nearest(self, embedding, n_results, text_embedding=None, text_weight=0.0,
+                search_params=None):
+        """Nearest rows from the image index, fused with caption similarity when asked"""
+        index = self.index.with_search_params(**search_params) if search_params else self.index
+        with timed("search"):
+            if text_embedding is not None and text_weight > 0 and self.hybrid is not None:
+                return self.hybrid.search(
+                    index, self.embeddings, embedding, text_embedding, n_results, text_weight,
+                    deleted=self.deleted
+                )
+            return index.search(embedding, n_results)
+
+    def nearest_batch(self, embeddings, n_results, search_params=None):
+        """nearest() for many query vectors in one backend call, image index only"""
+        index = self.index.with_search_params(**search_params) if search_params else self.index
+        with timed("search"):
+            return index.search_batch(np.asarray(embeddings, dtype=np.float32), n_results)
+
+    def is_ambiguous(self, ids, distances, n_results):
+        """Whether a cheap first pass needs a wider search: too few results, a
+        weak top match, or top matches split across categories"""
+        if len(ids) < n_results:
+            return True
+        if 1 - (distances[0] * 2 / math.pi) < ADAPTIVE_MIN_SIMILARITY:
+            return True
+        top = np.asarray(self.category_ids[np.asarray(ids[:10], dtype=np.int64)])
+        return majority_category(top)[1] < ADAPTIVE_MIN_MAJORITY * len(top)
+
+    def category_nearest(self, embedding, category_id, n_results, search_params=None):
+        """Nearest rows of one category: scored exactly over its posting list,
+        or filtered out of a deeper index search for categories above
+        CATEGORY_EXACT_MAX rows"""
+        base_size = len(self.store)
+        added = base_size + np.flatnonzero(np.asarray(self.category_ids[base_size:]) == category_id)
+        size = self.postings.size(category_id) + len(added)
+        if size > CATEGORY_EXACT_MAX:
+            # The category's share of the index says how deep to look for n_results of it
+            depth = int(math.ceil(n_results * len(self.index) / size * CATEGORY_OVERFETCH))
+            depth = min(depth, len(self.index))
+            ids, distances = self.nearest(embedding, depth, search_params=search_params)
+            ids, distances = np.asarray(ids, dtype=np.int64), np.asarray(distances)
+            keep = np.asarray(self.category_ids[ids]) == category_id
+            return ids[keep][:n_results].tolist(), distances[keep][:n_results].tolist()
+        with timed("search"):
+            ids, scores = self.postings.search(
+                self.embeddings, category_id, embedding, n_results, extra_ids=added, exclude=self.deleted
+            )
+        return ids.tolist(), angular_distance(scores).tolist()
+
+    def collapse_duplicates(self, ids, distances):
+        """Keep the best ranked row of every duplicate cluster"""
+        ids_array = np.asarray(ids, dtype=np.int64)
+        labels = ids_array.copy()
+        # Rows added since dedup.py ran are clusters of their own
+        known = ids_array < len(self.duplicate_of)
+        labels[known] = self.duplicate_of[ids_array[known]]
+        first = np.sort(np.unique(labels, return_index=True)[1])
+        return [ids[i] for i in first], [distances[i] for i in first]
+
+    def padding_exclude(self, collapse=False):
+        """Rows category padding must skip: deleted ones, and duplicates when collapsing"""
+        if collapse and len(self.duplicate_rows):
+            return np.union1d(self.deleted, self.duplicate_rows)
+        return self.deleted
+
+    def nearest_with_options(self, embedding, n_results, options, text_embedding=None,
+                             text_weight=0.0):
+        """nearest() within a request's search budget and filters.
+
+        Category-filtered searches only return that category's rows. Collapsed
+        searches look deeper and keep one row per duplicate cluster.
+        """
+        collapse = options.collapse and self.duplicate_of is not None
+        n_search = n_results * COLLAPSE_OVERFETCH if collapse else n_results
+        if options.category is not None:
+            ids, distances = self.category_nearest(embedding, options.category, n_search,
+                                                   dict(options.search_params))
+        else:
+            ids, distances = self.budgeted_nearest(embedding, n_search, options,
+                                                   text_embedding, text_weight)
+        if collapse:
+            ids, distances = self.collapse_duplicates(ids, distances)
+        return list(ids[:n_results]), list(distances[:n_results])
+
+    def budgeted_nearest(self, embedding, n_results, options, text_embedding=None,
+                         text_weight=0.0):
+        """nearest() with the request's search parameters.
+
+        Adaptive searches first run at ADAPTIVE_BUDGET of the full budget and
+        repeat with the full budget only when that pass looks ambiguous, so
+        easy queries stay cheap.
+        """
+        search_params = dict(options.search_params)
+        cheap_params = None
+        if options.adaptive:
+            cheap_params = ADAPTIVE_SEARCH_PARAMS or self.index.with_search_params(
+                **search_params
+            ).reduced_search_params(n_results, ADAPTIVE_BUDGET)
+        if cheap_params:
+            ids, distances = self.nearest(embedding, n_results, text_embedding, text_weight,
+                                          cheap_params)
+            if not self.is_ambiguous(ids, distances, n_results):
+                ADAPTIVE_SEARCHES.inc(outcome="settled")
+                return ids, distances
+            ADAPTIVE_SEARCHES.inc(outcome="widened")
+        return self.nearest(embedding, n_results, text_embedding, text_weight, search_params)
+
+    def search_raw(self, embedding, image_path, preview_mode=PREVIEW_MODE,
+                   text_embedding=None, text_weight=0.0, options=SearchOptions()) -> PredictionResult:
+        """Top matches for an embedding without category post-processing"""
+        similar_idx, distances = self.nearest_with_options(
+            embedding, options.k, options, text_embedding, text_weight
+        )
+        
+        # Convert distances to similarities
+        similarities = [1 - (dist * 2 / math.pi) for dist in distances]
+        
+        # Get recommendations and categories
+        recommendations = [self.file_mapping[idx] for idx in similar_idx]
+        categories = [self.category_of(idx) for idx in similar_idx]
+        
+        # Create preview info for top 3
+        top_previews = []
+        for idx, sim, cat in list(zip(similar_idx, similarities, categories))[:3]:
+            preview = self.get_preview(idx, preview_mode)
+            if preview:
+                top_previews.append(ImagePreview(
+                    image_path=self.file_mapping[idx],
+                    preview_path=preview,
+                    category=cat,
+                    similarity=float(sim),
+                    distance=float(1 - sim)
+                ))
+        
+        return PredictionResult(
+            image_path=image_path,
+            recs=",".join(recommendations),
+            model_used=self.model_used(text_embedding, text_weight),
+            confidence_score=float(similarities[0]) if similarities else 0.0,
+            top_matches=top_previews,
+            category=categories[0] if categories else "",
+            closest_distance=float(distances[0]) if distances else 1.0,
+            category_count=len(set(categories))
+        )
+
+    def search_category_aware(self, embedding, image_path, preview_mode=PREVIEW_MODE,
+                              text_embedding=None, text_weight=0.0,
+                              options=SearchOptions()) -> PredictionResult:
+        """Top matches re-ranked towards the dominant category"""
+        # Find similar images
+        candidates, similarities = self.find_similar_images(
+            embedding, options.candidates, text_embedding=text_embedding, text_weight=text_weight,
+            options=options
+        )
+        
+        # Select recommendations
+        with timed("rerank"):
+            (recommendations, category, confidence_score, 
+             closest_distance, majority_count) = self.select_recommendations(
+                candidates, similarities, limit=options.k, exclude=self.padding_exclude(options.collapse)
+            )
+        
+        # Create previews
+        top_previews = self.create_preview_candidates(
+            candidates, category, majority_count, preview_mode=preview_mode
+        )
+        
+        return PredictionResult(
+            image_path=image_path,
+            recs=",".join(recommendations),
+            model_used=self.model_used(text_embedding, text_weight),
+            confidence_score=float(confidence_score),
+            top_matches=top_previews,
+            category=category or "",
+            closest_distance=float(closest_distance),
+            category_count=majority_count
+        )
+
+    def model_used(self, text_embedding=None, text_weight=0.0):
+        hybrid = text_embedding is not None and text_weight > 0 and self.hybrid is not None
+        return 'convnext+text' if hybrid else 'convnext'
+
+    def classify(self, embedding, image_path) -> PredictionResult:
+        """Category only, from the category prototypes without a neighbour search"""
+        with timed("classify"):
+            ranked = self.prototypes.classify(embedding, top=1)
+        if not ranked:
+            raise ValueError("No category prototypes loaded")
+        category_id, score = ranked[0]
+        similarity = 1 - float(angular_distance(score)) * 2 / math.pi
+        return PredictionResult(
+            image_path=image_path,
+            recs="",
+            model_used="convnext-prototypes",
+            confidence_score=similarity,
+            top_matches=[],
+            category=self.categories[category_id],
+            closest_distance=1 - similarity,
+            category_count=0
+        )
+
+    def search(self, embedding, image_path, mode=PREDICT_MODE, preview_mode=PREVIEW_MODE,
+               text_embedding=None, text_weight=0.0, options=SearchOptions()) -> PredictionResult:
+        if mode == "classify":
+            return self.classify(embedding, image_path)
+        search = self.search_category_aware if mode == "category" else self.search_raw
+        return search(embedding, image_path, preview_mode=preview_mode,
+                      text_embedding=text_embedding, text_weight=text_weight, options=options)
+
+    def find_similar_images(self, embedding, n_candidates=30,
+                            text_embedding=None, text_weight=0.0, options=SearchOptions()) -> tuple:
+        """Get similar images using the search index"""
+        similar_idx, distances = self.nearest_with_options(
+            embedding, n_candidates, options, text_embedding, text_weight
+        )
+        return self.to_candidates(similar_idx, distances)
+
+    def to_candidates(self, similar_idx, distances) -> tuple:
+        """(id, class, similarity) candidates and similarities for search results"""
+        similarities = [1 - (dist * 2 / math.pi) for dist in distances]
+        
+        candidates = [
+            (idx, self.category_of(idx), sim) 
+            for idx, sim in zip(similar_idx, similarities)
+        ]
+        
+        return candidates, similarities
+
+    def select_recommendations(self, candidates, similarities, limit=10, exclude=None) -> tuple:
+        """Select top `limit` recommendations using improved strategy; padding
+        skips the exclude ids, deleted rows by default"""
+        ids = np.fromiter((idx for idx, _, _ in candidates), dtype=np.int64, count=len(candidates))
+        sims = np.asarray(similarities, dtype=np.float32)
+        category_ids = np.asarray(self.category_ids[ids])
+        
+        # Get category distribution in top 10, ties go to the better ranked category
+        top_category, majority_count = majority_category(category_ids[:10])
+        
+        # Initialize result variables
+        result_category = None
+        confidence_score = sims[0] if len(sims) else 0
+        
+        # Strategy selection based on similarity and category pattern
+        if len(sims) and sims[0] > 0.7:
+            # Very close visual match - use same category
+            result_category = int(category_ids[0])
+            confidence_score = sims[0]
+            selected = self._get_category_recommendations(
+                ids, category_ids, result_category, limit=limit, exclude=exclude
+            )
+            
+        elif majority_count > 7:
+            # Strong category pattern - use majority category
+            result_category = top_category
+            selected = self._get_category_recommendations(
+                ids, category_ids, top_category, limit=limit, exclude=exclude
+            )
+            
+            # Adjust confidence based on category matches
+            top_sims = sims[:10]
+            confidence_score = np.mean(top_sims[category_ids[:10] == top_category])
+            
+        else:
+            # Mixed case - use top matches regardless of category
+            result_category = int(category_ids[0]) if len(ids) else None
+            selected = ids[:limit]
+        
+        # Ensure we have exactly `limit` recommendations
+        selected_recommendations = self._pad_recommendations(
+            selected, result_category,
+            majority_count > 7 or (len(sims) > 0 and sims[0] > 0.7),
+            limit=limit, exclude=exclude
+        )
+            
+        return (
+            selected_recommendations[:limit], 
+            self.categories[result_category] if result_category is not None else None,
+            confidence_score,
+            1 - sims[0] if len(sims) else 1.0,
+            majority_count
+        )
+
+    def _get_category_recommendations(self, ids, category_ids, category_id, limit=10, exclude=None):
+        """Get recommendations from specific category"""
+        # First, get matches from candidates, then the category's most central items
+        selected = ids[category_ids == category_id][:limit]
+        exclude = self.deleted if exclude is None else exclude
+        return self.postings.fill(category_id, selected, limit, exclude=exclude)
+
+    def _pad_recommendations(self, selected, category_id, use_category_padding=True, limit=10,
+                             exclude=None):
+        """Pad recommendations to ensure exactly `limit` items"""
+        if use_category_padding and category_id is not None and len(selected) < limit:
+            # Add more from same category
+            exclude = self.deleted if exclude is None else exclude
+            selected = self.postings.fill(category_id, selected, limit, exclude=exclude)
+        recommendations = [self.file_mapping[idx] for idx in selected]
+            
+        # If still not enough, duplicate last item
+        while len(recommendations) < limit:
+            recommendations.append(
+                recommendations[-1] if recommendations else "placeholder"
+            )
+            
+        return recommendations
+
+    def create_preview_candidates(self, candidates, result_category, 
+                                majority_count, similarity_threshold=0.7,
+                                preview_mode=PREVIEW_MODE):
+        """Create preview candidates for top matches"""
+        preview_candidates = (
+            [(idx, cat, sim) for idx, cat, sim in candidates[:3] 
+             if cat == result_category]
+            if (majority_count > 7 or candidates[0][2] > similarity_threshold)
+            else candidates[:3]
+        )
+        
+        top_previews = []
+        for idx, cat, sim in preview_candidates:
+            preview = self.get_preview(idx, preview_mode)
+            if preview:
+                top_previews.append(ImagePreview(
+                    image_path=self.file_mapping[idx],
+                    preview_path=preview,
+                    category=cat,
+                    similarity=float(sim),
+                    distance=float(1 - sim)
+                ))
+                
+        return top_previews
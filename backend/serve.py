@@ -0,0 +1,129 @@
+import traceback
+import argparse
+import logging
+import signal
+import socket
+import time
+import gc
+import os
+
+logger = logging.getLogger(__name__)
+
+def bind_socket(host, port, backlog=2048):
+    """Listening socket shared by every worker; the kernel spreads connections"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+def preload(service):
+    """Load the models and index in this process, before any worker exists.
+
+    Weights and unpickled objects are then shared copy-on-write by the
+    forked workers, and the mmap'd embeddings and index files through the
+    page cache as before. gc.freeze() keeps the collector from writing to
+    the shared objects, which would copy their pages into every worker.
+    """
+    import torch
+
+    # A forked child hangs in its first parallel op if the parent already
+    # started an OpenMP thread pool, so load with a single thread
+    torch.set_num_threads(1)
+    service.load_models()
+    if service.VLM_LOAD == "background":
+        # Workers would each load their own copy in the background otherwise
+        service.search_engine.vlm.load()
+    gc.collect()
+    gc.freeze()
+
+def run_worker(service, sock, threads, log_level):
+    import torch
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the first inter-op parallel work
+        pass
+    # The startup event finds everything loaded and only starts the batchers
+    config = uvicorn.Config(service.app, log_level=log_level)
+    uvicorn.Server(config).run(sockets=[sock])
+
+def spawn_worker(service, sock, threads, log_level):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        run_worker(service, sock, threads, log_level)
+    except BaseException:
+        logger.error(traceback.format_exc())
+        code = 1
+    finally:
+        os._exit(code)
+
+def serve(host="0.0.0.0", port=8000, workers=2, threads=None, log_level="info"):
+    """Preload once, then fork `workers` uvicorn servers and restart any that die"""
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    # Read by app at import: single-threaded loading, updates refused with several workers
+    os.environ["SERVE_WORKERS"] = str(workers)
+    os.environ["ENCODER_THREADS"] = "1"
+    import app as service
+    from search_engine import SEARCH_BACKEND, SEARCH_BACKEND_PARAMS
+
+    if SEARCH_BACKEND == "sharded" and not SEARCH_BACKEND_PARAMS["sharded"]["urls"]:
+        # Local shard pools hold threads or child processes that do not survive a fork
+        raise SystemExit("Local shards cannot be preforked, serve them with sharding.py "
+                         "and set SHARD_URLS, or run a single uvicorn process")
+
+    start = time.perf_counter()
+    preload(service)
+    logger.info(f"Preloaded models and index in {time.perf_counter() - start:.1f}s, "
+                f"starting {workers} workers with {threads} threads each")
+
+    sock = bind_socket(host, port)
+    pids = {spawn_worker(service, sock, threads, log_level) for _ in range(workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        pids.discard(pid)
+        if not stopping:
+            logger.warning(f"Worker {pid} exited with status {status}, restarting it")
+            time.sleep(1)
+            pids.add(spawn_worker(service, sock, threads, log_level))
+    sock.close()
+    logger.info("All workers stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the API from several forked workers sharing one copy of the models"
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=int(os.getenv("ENCODER_THREADS", "0")) or None,
+                        help="PyTorch threads per worker, default cores / workers")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.threads, args.log_level)
@@ -0,0 +1,432 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from search_backends import (SearchBackend, BACKENDS, build_backend, load_backend,
+                             search_params_for, make_queries, benchmark)
+import multiprocessing as mp
+import urllib.request
+import numpy as np
+import subprocess
+import argparse
+import logging
+import json
+import copy
+import time
+import zlib
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+SHARDS_DIR = "shards"
+SHARDS_MANIFEST = "shards.json"
+SHARD_IDS_FILE = "ids.npy"
+SHARD_EMBEDDINGS_FILE = "embeddings.npy"
+
+def assign_shards(file_names, category_ids, n_shards, by="hash"):
+    """Shard number for every row.
+
+    "hash" spreads rows by a stable hash of the file name, so an image keeps
+    its shard across rebuilds. "category" keeps whole categories together,
+    placing the largest categories first on the least loaded shard.
+    """
+    if by == "hash":
+        return np.array([zlib.crc32(str(name).encode()) % n_shards for name in file_names],
+                        dtype=np.int64)
+    if by == "category":
+        category_ids = np.asarray(category_ids)
+        sizes = np.bincount(category_ids)
+        loads = np.zeros(n_shards, dtype=np.int64)
+        category_shard = np.zeros(len(sizes), dtype=np.int64)
+        for category_id in np.argsort(-sizes, kind="stable"):
+            shard = int(np.argmin(loads))
+            category_shard[category_id] = shard
+            loads[shard] += sizes[category_id]
+        return category_shard[category_ids]
+    raise ValueError(f"Unknown shard assignment {by!r}, expected 'hash' or 'category'")
+
+def shard_dir(data_dir, shard):
+    return os.path.join(data_dir, SHARDS_DIR, f"shard_{shard:03d}")
+
+def shards_exist(data_dir):
+    return os.path.exists(os.path.join(data_dir, SHARDS_DIR, SHARDS_MANIFEST))
+
+def load_manifest(data_dir):
+    with open(os.path.join(data_dir, SHARDS_DIR, SHARDS_MANIFEST)) as f:
+        return json.load(f)
+
+def build_shards(embeddings, file_names, category_ids, data_dir, n_shards,
+                 by="hash", backend="annoy", **params):
+    """Split the catalog into n_shards self-contained directories.
+
+    Each shard holds its rows' global ids, their embeddings and its own
+    backend index, so it can be served by a local worker process or copied
+    to another machine and served by `sharding.py serve`.
+    """
+    assignment = assign_shards(file_names, category_ids, n_shards, by)
+    sizes = []
+    for shard in range(n_shards):
+        ids = np.flatnonzero(assignment == shard).astype(np.int64)
+        if not len(ids):
+            raise ValueError(f"Shard {shard} is empty, use fewer shards")
+        directory = shard_dir(data_dir, shard)
+        os.makedirs(directory, exist_ok=True)
+        shard_embeddings = np.asarray(embeddings[ids])
+        np.save(os.path.join(directory, SHARD_IDS_FILE), ids)
+        np.save(os.path.join(directory, SHARD_EMBEDDINGS_FILE), shard_embeddings)
+        logger.info(f"Building {backend} index for shard {shard} ({len(ids)} items)...")
+        build_backend(backend, shard_embeddings, directory, **params)
+        sizes.append(len(ids))
+
+    manifest = {"n_shards": n_shards, "by": by, "backend": backend, "sizes": sizes}
+    with open(os.path.join(data_dir, SHARDS_DIR, SHARDS_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+class Shard:
+    """One shard's backend, answering with global row ids"""
+
+    def __init__(self, directory, backend, **params):
+        self.ids = np.load(os.path.join(directory, SHARD_IDS_FILE))
+        embeddings = np.load(os.path.join(directory, SHARD_EMBEDDINGS_FILE), mmap_mode="r")
+        self.backend = load_backend(backend, directory, embeddings, **params)
+
+    def info(self):
+        return {"size": len(self.backend), "memory_bytes": self.backend.memory_bytes(),
+                "n_trees": getattr(self.backend, "n_trees", None)}
+
+    def search_batch(self, vectors, k, params=None):
+        """Results for every vector plus the time spent searching, in ms.
+        params overrides the shard's search parameters for this call."""
+        start = time.perf_counter()
+        backend = self.backend.with_search_params(**params) if params else self.backend
+        results = [(self.ids[ids].tolist(), distances)
+                   for ids, distances in backend.search_batch(vectors, k)]
+        return results, (time.perf_counter() - start) * 1000
+
+# Shard loaded by each worker process of a ProcessShard
+_worker_shard = None
+
+def _init_shard_worker(directory, backend, params):
+    global _worker_shard
+    _worker_shard = Shard(directory, backend, **params)
+
+def _worker_info():
+    return _worker_shard.info()
+
+def _worker_search(vectors, k, params=None):
+    return _worker_shard.search_batch(vectors, k, params)
+
+class ProcessShard:
+    """A shard served by its own worker process"""
+
+    def __init__(self, directory, backend, **params):
+        self.name = os.path.basename(directory)
+        # Spawned rather than forked, the API process already runs threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=1, mp_context=mp.get_context("spawn"),
+            initializer=_init_shard_worker, initargs=(directory, backend, params),
+        )
+
+    def info(self):
+        return self.executor.submit(_worker_info).result()
+
+    def submit(self, vectors, k, params=None):
+        return self.executor.submit(_worker_search, np.asarray(vectors, dtype=np.float32), k, params)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+class ThreadShard:
+    """A shard searched in-process on a thread; annoy and numpy release the GIL"""
+
+    def __init__(self, directory, backend, executor, **params):
+        self.name = os.path.basename(directory)
+        self.shard = Shard(directory, backend, **params)
+        self.executor = executor
+
+    def info(self):
+        return self.shard.info()
+
+    def submit(self, vectors, k, params=None):
+        return self.executor.submit(self.shard.search_batch, np.asarray(vectors, dtype=np.float32), k, params)
+
+    def close(self):
+        pass
+
+class RemoteShard:
+    """A shard behind a `sharding.py serve` HTTP server"""
+
+    def __init__(self, url, executor, timeout=10.0):
+        self.name = url
+        self.url = url.rstrip("/")
+        self.executor = executor
+        self.timeout = timeout
+
+    def _post(self, path, payload):
+        request = urllib.request.Request(
+            f"{self.url}{path}", data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def info(self):
+        with urllib.request.urlopen(f"{self.url}/info", timeout=self.timeout) as response:
+            return json.load(response)
+
+    def _search(self, vectors, k, params=None):
+        response = self._post("/search", {"vectors": np.asarray(vectors).tolist(), "k": k,
+                                          "params": params or {}})
+        return [tuple(result) for result in response["results"]], response["elapsed_ms"]
+
+    def submit(self, vectors, k, params=None):
+        return self.executor.submit(self._search, vectors, k, params)
+
+    def close(self):
+        pass
+
+class ShardLatency:
+    """Round-trip and in-shard search times over the most recent queries"""
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.round_trip_ms = deque(maxlen=window)
+        self.search_ms = deque(maxlen=window)
+
+    def record(self, round_trip_ms, search_ms):
+        self.requests += 1
+        self.round_trip_ms.append(round_trip_ms)
+        self.search_ms.append(search_ms)
+
+    def stats(self):
+        round_trip = np.array(self.round_trip_ms)
+        search = np.array(self.search_ms)
+        return {
+            "requests": self.requests,
+            "mean_ms": round(float(round_trip.mean()), 3) if len(round_trip) else 0.0,
+            "p95_ms": round(float(np.percentile(round_trip, 95)), 3) if len(round_trip) else 0.0,
+            "search_mean_ms": round(float(search.mean()), 3) if len(search) else 0.0,
+        }
+
+class ShardedBackend(SearchBackend):
+    """Fans every query out to all shards and merges their top-k by distance.
+
+    workers="process" gives each shard its own process so searches use
+    every core, "thread" searches shards on a thread pool in this process,
+    and urls points at shard servers instead of local shards.
+    """
+    name = "sharded"
+
+    def __init__(self, workers="process", urls=None, search_k=-1, nprobe=8, rerank=100):
+        if workers not in ("process", "thread"):
+            raise ValueError(f"Unknown shard workers {workers!r}, expected 'process' or 'thread'")
+        self.workers = workers
+        self.urls = urls or []
+        self.search_params = {"search_k": search_k, "nprobe": nprobe, "rerank": rerank}
+        # Set on copies made by with_search_params, sent along with every query
+        self.overrides = {}
+        self.shards = []
+        self.latency = []
+        self.executor = None
+        self.size = 0
+        self.index_bytes = 0
+        # Annoy shards' tree count, for the default search_k
+        self.n_trees = None
+
+    def build(self, embeddings):
+        raise NotImplementedError("Sharded indexes are built with build_shards()")
+
+    def load(self, data_dir, embeddings):
+        if self.urls:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.urls), thread_name_prefix="shard")
+            self.shards = [RemoteShard(url, self.executor) for url in self.urls]
+        else:
+            manifest = load_manifest(data_dir)
+            backend = manifest["backend"]
+            params = search_params_for(backend, self.search_params)
+            directories = [shard_dir(data_dir, shard) for shard in range(manifest["n_shards"])]
+            if self.workers == "process":
+                self.shards = [ProcessShard(directory, backend, **params) for directory in directories]
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=len(directories), thread_name_prefix="shard")
+                self.shards = [ThreadShard(directory, backend, self.executor, **params)
+                               for directory in directories]
+        self.latency = [ShardLatency() for _ in self.shards]
+
+        infos = [shard.info() for shard in self.shards]
+        self.size = sum(info["size"] for info in infos)
+        self.index_bytes = sum(info["memory_bytes"] for info in infos)
+        self.n_trees = max((info.get("n_trees") or 0 for info in infos), default=0) or None
+        logger.info(f"Loaded {len(self.shards)} shards with {self.size} items")
+
+    def search(self, vector, k):
+        return self.search_batch([vector], k)[0]
+
+    def search_batch(self, vectors, k):
+        start = time.perf_counter()
+        futures = [shard.submit(vectors, k, self.overrides or None) for shard in self.shards]
+        merged = [([], []) for _ in vectors]
+        for future, latency in zip(futures, self.latency):
+            results, search_ms = future.result()
+            latency.record((time.perf_counter() - start) * 1000, search_ms)
+            for (ids, distances), (shard_ids, shard_distances) in zip(merged, results):
+                ids.extend(shard_ids)
+                distances.extend(shard_distances)
+
+        output = []
+        for ids, distances in merged:
+            distances = np.asarray(distances, dtype=np.float32)
+            order = np.argsort(distances, kind="stable")[:k]
+            output.append(([ids[i] for i in order], distances[order].tolist()))
+        return output
+
+    def with_search_params(self, **params):
+        params = {name: value for name, value in params.items() if name in self.search_params}
+        if not params:
+            return self
+        tuned = copy.copy(self)
+        tuned.overrides = {**self.overrides, **params}
+        return tuned
+
+    def reduced_search_params(self, k, fraction):
+        """The shards' reduced parameters; shards ignore the ones their backend lacks"""
+        params = {**self.search_params, **self.overrides}
+        search_k = params["search_k"] if params["search_k"] > 0 else (self.n_trees or 0) * k
+        reduced = {
+            "nprobe": max(1, int(params["nprobe"] * fraction)),
+            "rerank": max(k, int(max(params["rerank"], k) * fraction)),
+        }
+        if search_k:
+            reduced["search_k"] = max(k, int(search_k * fraction))
+        return reduced
+
+    def memory_bytes(self):
+        return self.index_bytes
+
+    def stats(self):
+        return {shard.name: latency.stats() for shard, latency in zip(self.shards, self.latency)}
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def __len__(self):
+        return self.size
+
+BACKENDS[ShardedBackend.name] = ShardedBackend
+
+def create_shard_app(directory, backend, **params):
+    """FastAPI app serving a single shard over HTTP"""
+    from fastapi import FastAPI
+    from pydantic import BaseModel
+    from typing import Dict, List
+
+    class SearchRequest(BaseModel):
+        vectors: List[List[float]]
+        k: int = 10
+        params: Dict[str, int] = {}
+
+    shard = Shard(directory, backend, **params)
+    app = FastAPI()
+
+    @app.get("/info")
+    def info():
+        return shard.info()
+
+    @app.post("/search")
+    def search(request: SearchRequest):
+        results, elapsed_ms = shard.search_batch(
+            np.asarray(request.vectors, dtype=np.float32), request.k, request.params
+        )
+        return {"results": results, "elapsed_ms": elapsed_ms}
+
+    return app
+
+def serve_local(data_dir, base_port=8100, host="127.0.0.1", **params):
+    """Start one stand-in shard server process per shard; returns (processes, urls)"""
+    manifest = load_manifest(data_dir)
+    processes, urls = [], []
+    for shard in range(manifest["n_shards"]):
+        port = base_port + shard
+        command = [sys.executable, os.path.abspath(__file__), "serve",
+                   "--data-dir", data_dir, "--shard", str(shard),
+                   "--host", host, "--port", str(port)]
+        for name, value in params.items():
+            command += [f"--{name.replace('_', '-')}", str(value)]
+        processes.append(subprocess.Popen(command))
+        urls.append(f"http://{host}:{port}")
+    return processes, urls
+
+def wait_for_shards(urls, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                urllib.request.urlopen(f"{url}/info", timeout=1.0).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Shard server {url} did not come up")
+                time.sleep(0.2)
+
+if __name__ == "__main__":
+    from embedding_store import EmbeddingStore
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build, serve or benchmark a sharded index")
+    parser.add_argument("command", choices=["build", "serve", "serve-local", "bench"])
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--by", default="hash", choices=["hash", "category"])
+    parser.add_argument("--backend", default="annoy", help="per-shard backend")
+    parser.add_argument("--trees", type=int, default=100)
+    parser.add_argument("--search-k", type=int, default=-1)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--rerank", type=int, default=100)
+    parser.add_argument("--shard", type=int, default=0, help="shard to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100, help="port, or first port for serve-local")
+    parser.add_argument("--workers", default="process", choices=["process", "thread"])
+    parser.add_argument("--urls", default=None, help="comma separated shard servers to benchmark")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    search_params = {"search_k": args.search_k, "nprobe": args.nprobe, "rerank": args.rerank}
+
+    if args.command == "build":
+        store = EmbeddingStore.load(args.data_dir)
+        build_params = {"n_trees": args.trees} if args.backend == "annoy" else {}
+        print(json.dumps(build_shards(store.embeddings, store.file_names, store.category_ids,
+                                      args.data_dir, args.shards, by=args.by,
+                                      backend=args.backend, **build_params)))
+    elif args.command == "serve":
+        import uvicorn
+
+        backend = load_manifest(args.data_dir)["backend"]
+        params = search_params_for(backend, search_params)
+        app = create_shard_app(shard_dir(args.data_dir, args.shard), backend, **params)
+        uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+    elif args.command == "serve-local":
+        processes, urls = serve_local(args.data_dir, args.port, args.host, **search_params)
+        wait_for_shards(urls)
+        print(f"SEARCH_BACKEND=sharded SHARD_URLS={','.join(urls)}")
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+    else:
+        store = EmbeddingStore.load(args.data_dir)
+        urls = args.urls.split(",") if args.urls else None
+        sharded = ShardedBackend(workers=args.workers, urls=urls, **search_params)
+        sharded.load(args.data_dir, store.embeddings)
+        try:
+            queries = make_queries(store.embeddings, args.queries)
+            for row in benchmark({"sharded": sharded}, store.embeddings, queries, k=args.k):
+                print(json.dumps(row))
+            print(json.dumps({"shards": sharded.stats()}))
+        finally:
+            sharded.close()
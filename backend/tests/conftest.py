@@ -0,0 +1,39 @@
+import importlib
+import sys
+import os
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_store import EmbeddingStore
+from search_backends import build_backend
+
+def unit_vectors(n, dim, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.fixture
+def make_engine(tmp_path, monkeypatch):
+    """ImageSearchEngine over a catalog of random (or the given) vectors, row
+    i named img{i} in category cat{i % n_categories}, indexed with the given
+    backend; environment settings are read when search_engine is reloaded"""
+    def make(backend="exact", n=60, n_categories=3, env=None, vectors=None, **params):
+        vectors = unit_vectors(n, 24) if vectors is None else vectors
+        n = len(vectors)
+        data_dir = str(tmp_path / "data")
+        EmbeddingStore.from_arrays(
+            vectors, [f"img{i}" for i in range(n)], [f"cat{i % n_categories}" for i in range(n)]
+        ).save(data_dir)
+        build_backend(backend, vectors, data_dir, **params)
+
+        monkeypatch.setenv("SEARCH_BACKEND", backend)
+        for name, value in (env or {}).items():
+            monkeypatch.setenv(name, value)
+        search_engine = importlib.reload(sys.modules["search_engine"]) \
+            if "search_engine" in sys.modules else importlib.import_module("search_engine")
+        engine = search_engine.ImageSearchEngine()
+        assert engine.load_search_data(data_dir)
+        return engine
+    return make
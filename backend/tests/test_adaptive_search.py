@@ -0,0 +1,81 @@
+import importlib
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from conftest import unit_vectors
+import search_engine
+
+@pytest.fixture
+def recorded_searches(monkeypatch):
+    """Search params of every engine.nearest() call made through an engine"""
+    def record(engine):
+        searches = []
+        nearest = engine.nearest
+
+        def recording_nearest(embedding, n_results, text_embedding=None, text_weight=0.0,
+                              search_params=None):
+            searches.append(search_params or {})
+            return nearest(embedding, n_results, text_embedding, text_weight, search_params)
+
+        monkeypatch.setattr(engine, "nearest", recording_nearest)
+        return searches
+    return record
+
+def adaptive(search_params=()):
+    return search_engine.SearchOptions(k=10, adaptive=True, search_params=tuple(search_params))
+
+def test_clear_query_settles_on_the_cheap_pass(make_engine, recorded_searches):
+    engine = make_engine("annoy", n_trees=10, env={"ADAPTIVE_MIN_SIMILARITY": "0",
+                                                    "ADAPTIVE_MIN_MAJORITY": "0"})
+    searches = recorded_searches(engine)
+    ids, _ = engine.nearest_with_options(engine.store.embeddings[0], 10, adaptive())
+
+    assert len(ids) == 10
+    # A quarter of annoy's default n_trees * k, from the index's real tree count
+    assert searches == [{"search_k": 25}]
+
+def test_ambiguous_query_is_searched_again_with_the_full_budget(make_engine, recorded_searches):
+    engine = make_engine("annoy", n_trees=10, env={"ADAPTIVE_MIN_SIMILARITY": "1.1"})
+    searches = recorded_searches(engine)
+    engine.nearest_with_options(unit_vectors(1, 24, seed=4)[0], 10, adaptive([("search_k", 400)]))
+
+    # The cheap pass scales the request's own budget
+    assert searches == [{"search_k": 100}, {"search_k": 400}]
+
+def test_adaptive_override_replaces_the_derived_pass(make_engine, recorded_searches):
+    engine = make_engine("ivf", n_lists=8, env={"ADAPTIVE_MIN_SIMILARITY": "1.1",
+                                               "ADAPTIVE_SEARCH_PARAMS": '{"nprobe": 3}'})
+    searches = recorded_searches(engine)
+    engine.nearest_with_options(unit_vectors(1, 24, seed=4)[0], 10, adaptive())
+    assert searches == [{"nprobe": 3}, {}]
+
+def test_exact_backend_has_no_cheap_pass(make_engine, recorded_searches):
+    engine = make_engine("exact")
+    searches = recorded_searches(engine)
+    engine.nearest_with_options(unit_vectors(1, 24, seed=4)[0], 10, adaptive())
+    assert searches == [{}]
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # app mounts ./dataset when it is imported
+    os.makedirs(tmp_path / "dataset")
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module("app")
+
+@pytest.mark.parametrize("params", [
+    {"search_k": 0}, {"search_k": 10 ** 9}, {"nprobe": 0}, {"nprobe": 10 ** 6},
+    {"rerank": 0}, {"rerank": 10 ** 9}, {"k": 0}, {"k": 10, "candidates": 5},
+])
+def test_search_params_out_of_bounds_are_rejected(app, params):
+    arguments = {"k": None, "candidates": None, "search_k": None, "nprobe": None,
+                 "rerank": None, "adaptive": None, **params}
+    with pytest.raises(HTTPException) as error:
+        app.check_search_options(**arguments)
+    assert error.value.status_code == 400
+
+def test_search_params_within_bounds_are_passed_on(app):
+    options = app.check_search_options(5, 20, -1, app.MAX_NPROBE, 50, True)
+    assert options.k == 5 and options.candidates == 20 and options.adaptive
+    assert dict(options.search_params) == {"search_k": -1, "nprobe": app.MAX_NPROBE, "rerank": 50}
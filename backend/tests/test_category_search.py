@@ -0,0 +1,54 @@
+import numpy as np
+
+from conftest import unit_vectors
+import search_engine
+
+def category_search(engine, category, vector, k):
+    options = search_engine.SearchOptions(category=engine.categories.index(category), adaptive=False)
+    return engine.nearest_with_options(vector, k, options)
+
+def test_small_category_is_scored_exactly(make_engine):
+    engine = make_engine("exact", n=90)
+    query = unit_vectors(1, 24, seed=5)[0]
+    ids, distances = category_search(engine, "cat1", query, 5)
+
+    rows = np.arange(1, 90, 3)
+    scores = np.asarray(engine.embeddings[rows]) @ query
+    assert ids == rows[np.argsort(-scores)[:5]].tolist()
+    assert distances == sorted(distances)
+
+def test_large_category_goes_through_the_index(make_engine, monkeypatch):
+    engine = make_engine("exact", n=90, env={"CATEGORY_EXACT_MAX": "10"})
+    searched = []
+    nearest = engine.nearest
+
+    def recording_nearest(embedding, n_results, *args, **kwargs):
+        searched.append(n_results)
+        return nearest(embedding, n_results, *args, **kwargs)
+
+    monkeypatch.setattr(engine, "nearest", recording_nearest)
+    # The posting lists must not be scanned
+    monkeypatch.setattr(engine.postings, "search", None)
+
+    query = unit_vectors(1, 24, seed=5)[0]
+    ids, _ = category_search(engine, "cat1", query, 5)
+    # A third of the rows are cat1, so 5 of them take a search 15 deep, twice that with overfetch
+    assert searched == [30]
+    assert all(engine.category_of(idx) == "cat1" for idx in ids)
+
+    # The exact backend searched deep enough finds the same rows as scoring the category
+    rows = np.arange(1, 90, 3)
+    scores = np.asarray(engine.embeddings[rows]) @ query
+    assert ids == rows[np.argsort(-scores)[:5]].tolist()
+
+def test_category_search_sees_live_changes(make_engine):
+    engine = make_engine("exact", n=30)
+    query = unit_vectors(1, 24, seed=5)[0]
+    (added,) = engine.add_items(query[None], ["new"], ["cat2"], [""])
+    ids, _ = category_search(engine, "cat2", query, 3)
+    assert ids[0] == added
+
+    engine.delete_items(["new", "img2"])
+    ids, _ = category_search(engine, "cat2", query, 10)
+    assert added not in ids and 2 not in ids
+    assert len(ids) == 9
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from conftest import unit_vectors
+from dedup import (cluster_pairs, detect_duplicates, load_duplicate_clusters,
+                   remap_duplicate_clusters, DUPLICATE_CLUSTERS_FILE)
+from embedding_store import EmbeddingStore
+from live_index import remap_ids
+import search_engine
+
+def catalog_with_duplicates():
+    """30 distinct vectors; rows 30-32 are near copies of row 0 and row 33 of row 7"""
+    vectors = unit_vectors(30, 24)
+    copies = vectors[[0, 0, 0, 7]] + unit_vectors(4, 24, seed=1) * 0.01
+    vectors = np.concatenate([vectors, copies])
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def test_star_clustering_does_not_chain():
+    # 0 and 5 both look like 1 but not like each other
+    pairs = np.array([[0, 1], [0, 2], [1, 5], [3, 4]])
+    representative = cluster_pairs(6, pairs)
+    assert representative.tolist() == [0, 0, 0, 3, 3, 5]
+
+def test_detect_duplicates_finds_planted_copies(make_engine):
+    engine = make_engine("exact", vectors=catalog_with_duplicates())
+    representative, report = detect_duplicates(engine.data_dir, backend="exact", radius=0.1)
+
+    assert representative[[0, 30, 31, 32]].tolist() == [0] * 4
+    assert representative[7] == representative[33]
+    other = np.setdiff1d(np.arange(34), [0, 7, 30, 31, 32, 33])
+    assert (representative[other] == other).all()
+    assert report["n_clusters"] == 2 and report["n_duplicates"] == 4
+    assert (load_duplicate_clusters(engine.data_dir, engine.store) == representative).all()
+
+def test_collapse_returns_one_row_per_cluster(make_engine):
+    engine = make_engine("exact", vectors=catalog_with_duplicates())
+    detect_duplicates(engine.data_dir, backend="exact", radius=0.1)
+    assert engine.load_search_data(engine.data_dir)
+
+    query = engine.store.embeddings[0]
+    options = search_engine.SearchOptions(k=5, adaptive=False, collapse=False)
+    ids, _ = engine.nearest_with_options(query, 5, options)
+    assert sorted(ids[:4]) == [0, 30, 31, 32]
+
+    ids, _ = engine.nearest_with_options(query, 5, options._replace(collapse=True))
+    assert len(ids) == 5
+    assert len(set(ids) & {0, 30, 31, 32}) == 1
+
+def test_remap_keeps_clusters_and_replaces_deleted_representatives():
+    representative = np.array([0, 0, 0, 3, 3, 5])
+    # Delete row 0, a representative, and row 4; one row was added
+    remap = remap_ids(6, 1, np.array([0, 4]))
+    assert remap.tolist() == [-1, 0, 1, 2, -1, 3, 4]
+    assert remap_duplicate_clusters(representative, remap, 5).tolist() == [0, 0, 2, 3, 4]
+
+def test_compaction_carries_clusters_to_the_new_rows(make_engine):
+    engine = make_engine("exact", vectors=catalog_with_duplicates())
+    detect_duplicates(engine.data_dir, backend="exact", radius=0.1)
+    assert engine.load_search_data(engine.data_dir)
+    engine.delete_items(["img0", "img5"])
+    engine.add_items(unit_vectors(1, 24, seed=2), ["new"], ["cat0"], [""])
+    engine.compact()
+
+    names = [str(name) for name in engine.store.file_names]
+    clusters = {}
+    for row, label in enumerate(engine.duplicate_of):
+        clusters.setdefault(names[label], set()).add(names[row])
+    duplicates = [members for members in clusters.values() if len(members) > 1]
+    assert sorted(map(sorted, duplicates)) == [["img30", "img31", "img32"], ["img33", "img7"]]
+    assert engine.duplicate_of[names.index("new")] == names.index("new")
+
+def test_clusters_of_other_rows_are_ignored(make_engine):
+    engine = make_engine("exact", vectors=catalog_with_duplicates())
+    detect_duplicates(engine.data_dir, backend="exact", radius=0.1)
+
+    # Same number of rows, in another order
+    store = engine.store
+    order = np.arange(len(store))[::-1]
+    EmbeddingStore.from_arrays(
+        np.asarray(store.embeddings)[order], list(store.file_names[order]),
+        list(store.category_names()[order]),
+    ).save(engine.data_dir)
+    reordered = EmbeddingStore.load(engine.data_dir)
+    assert os.path.exists(os.path.join(engine.data_dir, DUPLICATE_CLUSTERS_FILE))
+    assert load_duplicate_clusters(engine.data_dir, reordered) is None
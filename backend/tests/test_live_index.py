@@ -0,0 +1,125 @@
+import json
+import os
+
+import pytest
+
+from conftest import unit_vectors
+from search_backends import BUILD_PARAMS_FILE
+
+@pytest.mark.parametrize("backend, params, expected", [
+    ("compressed", {"codec": "float16", "dim": 12}, {"codec": "float16", "dim": 12}),
+    ("annoy", {"n_trees": 10}, {"n_trees": 10}),
+    ("ivf", {"n_lists": 5}, {"n_lists": 5}),
+])
+def test_compaction_keeps_build_params(make_engine, backend, params, expected):
+    engine = make_engine(backend, **params)
+    engine.add_items(unit_vectors(2, 24, seed=1), ["new0", "new1"], ["cat0", "cat1"], ["", ""])
+    engine.delete_items(["img3"])
+    engine.compact()
+
+    assert len(engine.store) == 61
+    index = engine.base_index
+    for name, value in expected.items():
+        assert index.build_params()[name] == value
+    with open(os.path.join(engine.data_dir, BUILD_PARAMS_FILE)) as f:
+        assert json.load(f) == {"backend": backend, "params": params}
+
+def test_compaction_of_index_without_build_params(make_engine):
+    """Indexes saved before the params file take them from the loaded index"""
+    engine = make_engine("compressed", codec="float16", dim=12)
+    os.remove(os.path.join(engine.data_dir, BUILD_PARAMS_FILE))
+    engine.delete_items(["img0"])
+    engine.compact()
+
+    assert engine.base_index.build_params() == {"codec": "float16", "dim": 12, "whiten": False}
+
+def names(engine, ids):
+    return [str(engine.file_mapping[idx]) for idx in ids]
+
+def test_added_and_deleted_rows_are_searchable_right_away(make_engine):
+    engine = make_engine("annoy", n_trees=10)
+    vector = unit_vectors(1, 24, seed=1)[0]
+    (added,) = engine.add_items(vector[None], ["new"], ["cat9"], [""])
+
+    ids, distances = engine.nearest(vector, 5)
+    assert ids[0] == added and distances[0] == pytest.approx(0, abs=1e-3)
+    assert engine.category_of(added) == "cat9"
+    assert engine.is_live("new")
+
+    assert engine.delete_items(["new", "img0"]) == [0, added]
+    ids, _ = engine.nearest(vector, 10)
+    assert added not in ids and 0 not in ids
+    assert not engine.is_live("new")
+    # Deleting again changes nothing
+    assert engine.delete_items(["new"]) == []
+
+def test_category_padding_skips_deleted_rows(make_engine):
+    engine = make_engine("exact")
+    # Padding starts from the most central rows of the category
+    central = names(engine, engine.postings.items(0, 3))
+    engine.delete_items(central[:2])
+    candidates, similarities = engine.to_candidates([int(engine.postings.items(0)[-1])], [0.0])
+    recommendations, category, *_ = engine.select_recommendations(candidates, similarities, limit=10)
+    assert category == "cat0"
+    assert central[2] in recommendations
+    assert not set(central[:2]) & set(recommendations)
+    assert len(recommendations) == 10
+
+def test_compaction_round_trip(make_engine):
+    engine = make_engine("exact")
+    added = unit_vectors(2, 24, seed=1)
+    engine.add_items(added, ["new0", "new1"], ["cat1", "cat9"], ["", ""])
+    engine.delete_items(["img3", "new0"])
+    queries = unit_vectors(5, 24, seed=2)
+    before = [names(engine, engine.nearest(query, 8)[0]) for query in queries]
+    generation = engine.generation
+
+    engine.compact()
+
+    assert engine.pending_changes() == 0
+    assert engine.generation != generation
+    expected = [f"img{i}" for i in range(60) if i != 3] + ["new1"]
+    assert [str(name) for name in engine.store.file_names] == expected
+    assert engine.category_of(len(expected) - 1) == "cat9"
+    assert [names(engine, engine.nearest(query, 8)[0]) for query in queries] == before
+
+def test_updates_during_compaction_are_carried_over(make_engine, monkeypatch):
+    import search_engine
+    engine = make_engine("exact")
+    engine.add_items(unit_vectors(1, 24, seed=1), ["new0"], ["cat0"], [""])
+    engine.delete_items(["img1"])
+    late = unit_vectors(1, 24, seed=3)
+    write_compacted = search_engine.write_compacted
+
+    def write_compacted_with_updates(*args, **kwargs):
+        remap = write_compacted(*args, **kwargs)
+        # Requests keep coming in while the new index is built
+        engine.add_items(late, ["late"], ["cat2"], [""])
+        engine.delete_items(["img5"])
+        return remap
+
+    monkeypatch.setattr(search_engine, "write_compacted", write_compacted_with_updates)
+    engine.compact()
+
+    assert len(engine.store) == 60
+    assert engine.pending_changes() == 2
+    assert engine.is_live("late") and not engine.is_live("img5") and not engine.is_live("img1")
+    assert names(engine, engine.nearest(late[0], 1)[0]) == ["late"]
+    assert "img5" not in names(engine, engine.nearest(engine.store.embeddings[4], 60)[0])
+
+def test_live_changes_invalidate_cached_results(make_engine):
+    from query_cache import QueryCache
+    engine = make_engine("exact")
+    cache = QueryCache()
+    cache.put("query", "result", engine.generation)
+    assert cache.get("query", engine.generation) == "result"
+
+    for change in (lambda: engine.add_items(unit_vectors(1, 24), ["new"], ["cat0"], [""]),
+                   lambda: engine.delete_items(["img0"]),
+                   engine.compact):
+        generation = engine.generation
+        change()
+        assert engine.generation != generation
+        assert cache.get("query", engine.generation) is None
+        cache.put("query", "result", engine.generation)
+    assert cache.stats()["stale"] == 3
@@ -0,0 +1,56 @@
+import importlib
+import sys
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_store import EmbeddingStore
+from search_backends import build_backend
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    """Two indexed images with different extensions, in the dataset/<category>/ layout"""
+    for category, name in (("shoes", "a1.png"), ("hats", "b 2.jpeg")):
+        os.makedirs(tmp_path / "dataset" / category)
+        Image.new("RGB", (8, 8), "red").save(tmp_path / "dataset" / category / name)
+
+    vectors = np.random.default_rng(0).normal(size=(2, 8)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    data_dir = tmp_path / "data"
+    EmbeddingStore.from_arrays(vectors, ["a1", "b 2"], ["shoes", "hats"]).save(data_dir)
+    build_backend("exact", vectors, str(data_dir))
+
+    # app mounts ./dataset when it is imported
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("SEARCH_BACKEND", "exact")
+    search_engine, app = (
+        importlib.reload(sys.modules[name]) if name in sys.modules else importlib.import_module(name)
+        for name in ("search_engine", "app")
+    )
+    engine = search_engine.ImageSearchEngine()
+    assert engine.load_search_data(str(data_dir))
+    return app, engine, tmp_path
+
+def test_preview_urls_are_served(catalog):
+    app, engine, root = catalog
+    client = TestClient(app.app)
+    for idx, path in ((0, "shoes/a1.png"), (1, "hats/b 2.jpeg")):
+        url = engine.get_preview(idx, "url")
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert response.content == (root / "dataset" / path).read_bytes()
+
+def test_preview_url_of_added_image(catalog):
+    app, engine, root = catalog
+    path = os.path.join("dataset", "hats", "c3.png")
+    Image.new("RGB", (8, 8), "blue").save(path)
+    (idx,) = engine.add_items(engine.embeddings[:1], ["c3"], ["hats"], [path])
+
+    response = TestClient(app.app).get(engine.get_preview(idx, "url"))
+    assert response.status_code == 200
+    assert response.content == (root / path).read_bytes()
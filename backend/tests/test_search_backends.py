@@ -0,0 +1,38 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_backends import build_backend, load_backend
+
+def unit_vectors(n, dim, seed=0):
+    vectors = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.mark.parametrize("n_trees", [10, 250])
+def test_annoy_reduced_budget_uses_loaded_tree_count(tmp_path, n_trees):
+    vectors = unit_vectors(200, 16)
+    build_backend("annoy", vectors, str(tmp_path), n_trees=n_trees)
+
+    index = load_backend("annoy", str(tmp_path), vectors)
+    assert index.n_trees == n_trees
+    k = 10
+    # -1 searches n_trees * k nodes, the cheap pass must stay below that
+    reduced = index.reduced_search_params(k, 0.25)["search_k"]
+    assert k <= reduced < n_trees * k
+    assert reduced == int(n_trees * k * 0.25)
+
+def test_reduced_budget_scales_explicit_search_params(tmp_path):
+    vectors = unit_vectors(200, 16)
+    build_backend("ivf", vectors, str(tmp_path), n_lists=16)
+    ivf = load_backend("ivf", str(tmp_path), vectors, nprobe=8)
+    assert ivf.reduced_search_params(10, 0.25) == {"nprobe": 2}
+
+    build_backend("compressed", vectors, str(tmp_path), codec="float16")
+    compressed = load_backend("compressed", str(tmp_path), vectors, rerank=200)
+    assert compressed.reduced_search_params(10, 0.25) == {"rerank": 50}
+    # Never below the number of results asked for
+    assert compressed.reduced_search_params(100, 0.25) == {"rerank": 100}
@@ -0,0 +1,225 @@
+from search_backends import angular_distance, top_k, build_backend, load_backend
+from convnext_init import load_image, IMAGE_EXTENSIONS
+import numpy as np
+import threading
+import argparse
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+CAPTIONS_FILE = "captions.json"
+TEXT_EMBEDDINGS_FILE = "text_embeddings.npy"
+TEXT_PCA_FILE = "text_pca.npz"
+# Nearest-neighbour index over the caption vectors, in its own directory since
+# backends save under fixed file names, with a manifest naming the backend
+TEXT_INDEX_DIR = "text_index"
+TEXT_INDEX_MANIFEST = "manifest.json"
+
+CAPTION_MODEL = "Salesforce/blip-image-captioning-base"
+TEXT_MODEL = "all-MiniLM-L6-v2"
+
+class CaptionEmbedder:
+    """BLIP captions turned into SentenceTransformer vectors, both in batches.
+
+    Models are loaded on first use; sentence-transformers is only needed
+    when hybrid search is in use.
+    """
+
+    def __init__(self, caption_model=CAPTION_MODEL, text_model=TEXT_MODEL, max_new_tokens=30):
+        self.caption_model_name = caption_model
+        self.text_model_name = text_model
+        self.max_new_tokens = max_new_tokens
+        self.caption_model = None
+        self.caption_processor = None
+        self.text_model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.text_model is not None:
+                return
+            import torch
+            from transformers import BlipProcessor, BlipForConditionalGeneration
+            from sentence_transformers import SentenceTransformer
+
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+            logger.info(f"Loading {self.caption_model_name} and {self.text_model_name}...")
+            self.caption_processor = BlipProcessor.from_pretrained(self.caption_model_name)
+            self.caption_model = BlipForConditionalGeneration.from_pretrained(
+                self.caption_model_name
+            ).to(self.device).eval()
+            self.text_model = SentenceTransformer(self.text_model_name, device=self.device)
+
+    def caption(self, images):
+        """Captions for a list of paths, bytes or PIL images"""
+        import torch
+
+        self.load()
+        images = [load_image(image, draft=False) for image in images]
+        inputs = self.caption_processor(images=images, return_tensors="pt").to(self.device)
+        with torch.no_grad():
+            outputs = self.caption_model.generate(**inputs, max_new_tokens=self.max_new_tokens)
+        return [text.strip() for text in
+                self.caption_processor.batch_decode(outputs, skip_special_tokens=True)]
+
+    def embed_texts(self, texts, batch_size=64):
+        self.load()
+        return self.text_model.encode(
+            texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True
+        ).astype(np.float32)
+
+    def embed_images(self, images):
+        """Caption images and embed the captions in one go"""
+        captions = self.caption(images)
+        return captions, self.embed_texts(captions)
+
+class TextPCA:
+    """Mean-centred PCA projection, re-normalized so dot products stay cosines"""
+
+    def __init__(self, mean, components):
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def fit(cls, vectors, dim, sample_size=50000, seed=0):
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(len(vectors), min(len(vectors), sample_size), replace=False)]
+        mean = sample.mean(axis=0)
+        _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        return cls(mean.astype(np.float32), vt[:dim].astype(np.float32))
+
+    def transform(self, vectors):
+        projected = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+        return projected / np.maximum(np.linalg.norm(projected, axis=-1, keepdims=True), 1e-12)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["mean"], data["components"])
+
+def build_text_embeddings(image_paths, data_dir, embedder=None, batch_size=16, pca_dim=None,
+                          index_backend="annoy", index_params=None):
+    """Caption every indexed image and store the caption vectors row-aligned
+    with the store, plus an index_backend index over them"""
+    embedder = embedder or CaptionEmbedder()
+    captions = []
+    start = time.perf_counter()
+    for i in range(0, len(image_paths), batch_size):
+        captions.extend(embedder.caption(image_paths[i:i + batch_size]))
+    logger.info(f"Captioned {len(captions)} images in {time.perf_counter() - start:.1f}s")
+
+    vectors = embedder.embed_texts(captions)
+    if pca_dim and pca_dim < vectors.shape[1]:
+        pca = TextPCA.fit(vectors, pca_dim)
+        pca.save(os.path.join(data_dir, TEXT_PCA_FILE))
+        vectors = pca.transform(vectors)
+    elif os.path.exists(os.path.join(data_dir, TEXT_PCA_FILE)):
+        os.remove(os.path.join(data_dir, TEXT_PCA_FILE))
+
+    write_text_embeddings(captions, vectors, data_dir, index_backend, index_params)
+
+def write_text_embeddings(captions, vectors, data_dir, index_backend="annoy", index_params=None):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    with open(os.path.join(data_dir, CAPTIONS_FILE), "w") as f:
+        json.dump(captions, f, ensure_ascii=False)
+    np.save(os.path.join(data_dir, TEXT_EMBEDDINGS_FILE), vectors)
+    logger.info(f"Saved {vectors.shape[1]}-d text embeddings")
+
+    directory = os.path.join(data_dir, TEXT_INDEX_DIR)
+    os.makedirs(directory, exist_ok=True)
+    build_backend(index_backend, vectors, directory, **(index_params or {}))
+    with open(os.path.join(directory, TEXT_INDEX_MANIFEST), "w") as f:
+        json.dump({"backend": index_backend, "params": index_params or {}}, f)
+
+class HybridIndex:
+    """Caption vectors stored next to the image vectors.
+
+    Fusion happens at query time: candidates from the image index and from
+    the text index are re-scored with
+    (1 - text_weight) * image cosine + text_weight * text cosine, so the
+    weight can change per request without rebuilding anything. With
+    text_weight=0.5 this ranks like the notebook's concatenated embedding.
+    """
+
+    def __init__(self, data_dir):
+        self.text_embeddings = np.load(os.path.join(data_dir, TEXT_EMBEDDINGS_FILE), mmap_mode="r")
+        pca_path = os.path.join(data_dir, TEXT_PCA_FILE)
+        self.pca = TextPCA.load(pca_path) if os.path.exists(pca_path) else None
+
+        directory = os.path.join(data_dir, TEXT_INDEX_DIR)
+        manifest_path = os.path.join(directory, TEXT_INDEX_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            self.index_backend, self.index_params = manifest["backend"], manifest["params"]
+            self.text_index = load_backend(
+                self.index_backend, directory, self.text_embeddings, **self.index_params
+            )
+        else:
+            # Built before text indexes existed; the next compaction adds one
+            logger.warning(f"No text index in {data_dir}, hybrid searches scan every caption "
+                           f"until text_embeddings.py is rerun")
+            self.index_backend, self.index_params = None, {}
+            self.text_index = load_backend("exact", directory, self.text_embeddings)
+
+    @staticmethod
+    def exists(data_dir):
+        return os.path.exists(os.path.join(data_dir, TEXT_EMBEDDINGS_FILE))
+
+    def __len__(self):
+        return len(self.text_embeddings)
+
+    def project(self, text_vector):
+        """Map a raw caption vector into the stored text space"""
+        return self.pca.transform(text_vector) if self.pca is not None else np.asarray(text_vector, dtype=np.float32)
+
+    def search(self, image_index, image_embeddings, image_vector, text_vector, k, text_weight=0.5,
+               deleted=None):
+        text_vector = self.project(text_vector)
+        image_ids, _ = image_index.search(image_vector, k)
+        n_deleted = len(deleted) if deleted is not None else 0
+        text_ids, _ = self.text_index.search(text_vector, k + n_deleted)
+        text_ids = np.asarray(text_ids, dtype=np.int64)
+        if n_deleted:
+            text_ids = text_ids[~np.isin(text_ids, deleted)]
+
+        ids = np.unique(np.concatenate([np.asarray(image_ids, dtype=np.int64), text_ids[:k]]))
+        image_scores = np.asarray(image_embeddings[ids], dtype=np.float32) @ np.asarray(image_vector, dtype=np.float32)
+        # Rows added since captioning have no text vector yet, they rank on the image alone
+        captioned = ids < len(self.text_embeddings)
+        text_scores = image_scores.copy()
+        text_scores[captioned] = np.asarray(self.text_embeddings[ids[captioned]], dtype=np.float32) @ text_vector
+        scores = (1 - text_weight) * image_scores + text_weight * text_scores
+        top = top_k(scores, k)
+        return ids[top].tolist(), angular_distance(scores[top]).tolist()
+
+if __name__ == "__main__":
+    from embedding_store import EmbeddingStore
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Caption an indexed dataset for hybrid search")
+    parser.add_argument("--dataset", default="dataset")
+    parser.add_argument("--data-dir", default="./data")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--pca-dim", type=int, default=None)
+    parser.add_argument("--index-backend", default="annoy", choices=["annoy", "ivf", "exact"],
+                        help="nearest-neighbour index over the caption vectors")
+    args = parser.parse_args()
+
+    def find_image(category, name):
+        for extension in IMAGE_EXTENSIONS:
+            path = os.path.join(args.dataset, category, f"{name}{extension}")
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"No image for {category}/{name} in {args.dataset}")
+
+    store = EmbeddingStore.load(args.data_dir)
+    paths = [find_image(category, name) for name, category in zip(store.file_names, store.category_names())]
+    build_text_embeddings(paths, args.data_dir, batch_size=args.batch_size, pca_dim=args.pca_dim,
+                          index_backend=args.index_backend)
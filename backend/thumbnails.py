@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from PIL import Image
+import multiprocessing as mp
+import numpy as np
+import threading
+import logging
+import base64
+import io
+import os
+
+logger = logging.getLogger(__name__)
+
+THUMBNAILS_FILE = "thumbnails.bin"
+THUMBNAIL_OFFSETS_FILE = "thumbnail_offsets.npy"
+THUMBNAIL_SIZE = (150, 150)
+
+def make_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    """JPEG thumbnail bytes for one image, b"" if it cannot be read"""
+    try:
+        with Image.open(image_path) as img:
+            img.draft('RGB', size)
+            img = img.convert('RGB')
+            img.thumbnail(size)
+            buffered = io.BytesIO()
+            img.save(buffered, format="JPEG")
+            return buffered.getvalue()
+    except Exception as e:
+        logger.error(f"Error creating thumbnail for {image_path}: {e}")
+        return b""
+
+def build_thumbnails(image_paths, data_dir, num_workers=None):
+    """Thumbnail images in parallel into one packed file.
+
+    Thumbnail i is thumbnails.bin[offsets[i]:offsets[i + 1]], in the same
+    row order as the embeddings store.
+    """
+    num_workers = num_workers or max(1, (os.cpu_count() or 2) - 1)
+    with mp.Pool(num_workers) as pool:
+        write_thumbnails(pool.imap(make_thumbnail, image_paths, chunksize=16), data_dir)
+
+def write_thumbnails(thumbnails, data_dir):
+    """Pack an iterable of JPEG bytes (b"" for missing) into thumbnails.bin"""
+    offsets = [0]
+    with open(os.path.join(data_dir, THUMBNAILS_FILE), "wb") as f:
+        for thumbnail in thumbnails:
+            f.write(thumbnail)
+            offsets.append(offsets[-1] + len(thumbnail))
+    np.save(os.path.join(data_dir, THUMBNAIL_OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    logger.info(f"Saved {len(offsets) - 1} thumbnails ({offsets[-1] / 1e6:.1f} MB)")
+
+class ThumbnailStore:
+    """Read-only, memory-mapped view of thumbnails.bin"""
+
+    def __init__(self, data_dir):
+        self.offsets = np.load(os.path.join(data_dir, THUMBNAIL_OFFSETS_FILE))
+        path = os.path.join(data_dir, THUMBNAILS_FILE)
+        # np.memmap refuses empty files
+        self.data = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else b""
+
+    @staticmethod
+    def exists(data_dir):
+        return (os.path.exists(os.path.join(data_dir, THUMBNAILS_FILE))
+                and os.path.exists(os.path.join(data_dir, THUMBNAIL_OFFSETS_FILE)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, idx):
+        """JPEG bytes of thumbnail idx, or None if it is missing"""
+        if idx >= len(self):
+            return None
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return bytes(self.data[start:end]) if end > start else None
+
+class PreviewCache:
+    """Thread-safe LRU of encoded previews, bounded by total size in bytes"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+def to_data_uri(jpeg_bytes):
+    return f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode()}"
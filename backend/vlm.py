@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from vision_process import process_vision_info
+import threading
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class VLMLoader:
+    """Loads Qwen2-VL and its processor once, in the background or on first use.
+
+    transformers is only imported when loading starts, so processes that
+    never touch the VLM do not pay for it.
+    """
+
+    def __init__(self, model_name="Qwen/Qwen2-VL-2B-Instruct", dtype="float32", device="cpu"):
+        self.model_name = model_name
+        self.dtype = dtype
+        self.device = device
+        self.model = None
+        self.processor = None
+        self.state = "not_loaded"
+        self.error = None
+        self.load_seconds = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def load(self):
+        """Load the model if needed; safe to call from several threads"""
+        with self.lock:
+            if self.state == "ready":
+                return self.model, self.processor
+
+            import torch
+            from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+
+            self.state = "loading"
+            start = time.perf_counter()
+            try:
+                logger.info(f"Loading {self.model_name} ({self.dtype})...")
+                model = Qwen2VLForConditionalGeneration.from_pretrained(
+                    self.model_name, torch_dtype=getattr(torch, self.dtype),
+                ).to(self.device)
+                model.eval()
+                processor = AutoProcessor.from_pretrained(self.model_name)
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                raise
+
+            self.model, self.processor = model, processor
+            self.load_seconds = time.perf_counter() - start
+            self.state = "ready"
+            self.error = None
+            logger.info(f"{self.model_name} loaded in {self.load_seconds:.1f}s")
+            return self.model, self.processor
+
+    def _load_quietly(self):
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Error loading {self.model_name}: {str(e)}")
+
+    def start_background(self):
+        """Begin loading in a daemon thread and return immediately"""
+        thread = threading.Thread(target=self._load_quietly, name="vlm-loader", daemon=True)
+        thread.start()
+        return thread
+
+    def status(self):
+        return {
+            "model": self.model_name,
+            "dtype": self.dtype,
+            "state": self.state,
+            "load_seconds": round(self.load_seconds, 2) if self.load_seconds is not None else None,
+            "error": self.error,
+        }
+
+CAPTION_PROMPT = "Describe this image in one sentence."
+CATEGORY_QUESTION = "Which category does this image belong to?"
+
+def build_choice_prompt(question, choices):
+    """Multiple-choice prompt answered by option number"""
+    prompt = f"{question}\nChoices:\n"
+    for i, choice in enumerate(choices, 1):
+        prompt += f"{i}. {choice}\n"
+    prompt += "Please select the most appropriate answer by number."
+    return prompt
+
+def parse_choice(answer, choices):
+    """Map a numbered answer back to its choice, None if it is not a valid number"""
+    digits = "".join(ch for ch in answer.strip().split(".")[0] if ch.isdigit())
+    if digits and 1 <= int(digits) <= len(choices):
+        return choices[int(digits) - 1]
+    return None
+
+def describe_cache_key(image_bytes, prompt, max_new_tokens):
+    digest = hashlib.sha1(image_bytes)
+    digest.update(f"\0{max_new_tokens}\0{prompt}".encode())
+    return digest.hexdigest()
+
+class VLMDescriber:
+    """Batched Qwen2-VL generation with an LRU cache of finished answers.
+
+    generate_batch is meant to run in a MicroBatcher: it turns every queued
+    (image, prompt, max_new_tokens) item into one left-padded generate call.
+    """
+
+    def __init__(self, loader, max_new_tokens=64, cache_size=4096):
+        self.loader = loader
+        self.max_new_tokens = max_new_tokens
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.generated_tokens = 0
+        self.generate_seconds = 0.0
+
+    def cap_tokens(self, max_new_tokens=None):
+        return max(1, min(max_new_tokens or self.max_new_tokens, self.max_new_tokens))
+
+    def get_cached(self, key):
+        with self.lock:
+            self.requests += 1
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+            return result
+
+    def put_cached(self, key, result):
+        with self.lock:
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def generate_batch(self, items):
+        """Answer (image, prompt, max_new_tokens) items; returns (text, n_tokens) per item"""
+        import torch
+
+        model, processor = self.loader.load()
+        messages = [
+            [{"role": "user", "content": [
+                {"type": "image", "image": image, "max_pixels": 360 * 420},
+                {"type": "text", "text": prompt},
+            ]}]
+            for image, prompt, _ in items
+        ]
+        texts = [
+            processor.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+            for message in messages
+        ]
+        images = [process_vision_info(message)[0][0] for message in messages]
+        # Decoder-only generation needs the padding on the left
+        processor.tokenizer.padding_side = "left"
+        inputs = processor(text=texts, images=images, padding=True, return_tensors="pt").to(model.device)
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            generated_ids = model.generate(
+                **inputs,
+                max_new_tokens=max(max_new_tokens for _, _, max_new_tokens in items),
+                do_sample=False,
+            )
+        elapsed = time.perf_counter() - start
+
+        prompt_length = inputs.input_ids.shape[1]
+        pad_token_id = processor.tokenizer.pad_token_id
+        results = []
+        for output_ids, (_, _, max_new_tokens) in zip(generated_ids, items):
+            new_ids = output_ids[prompt_length:prompt_length + max_new_tokens]
+            if pad_token_id is not None:
+                new_ids = new_ids[new_ids != pad_token_id]
+            text = processor.batch_decode(
+                [new_ids], skip_special_tokens=True, clean_up_tokenization_spaces=False
+            )[0]
+            results.append((text.strip(), len(new_ids)))
+
+        with self.lock:
+            self.batches += 1
+            self.generated_tokens += sum(n_tokens for _, n_tokens in results)
+            self.generate_seconds += elapsed
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "cache_hits": self.cache_hits,
+                "cache_entries": len(self.cache),
+                "batches": self.batches,
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_sec": round(self.generated_tokens / self.generate_seconds, 2)
+                if self.generate_seconds else 0.0,
+            }